@@ -1,15 +1,13 @@
 #%% Importing libraries
-from itertools import product
 import time
 import numpy as np
 import pandas as pd
-import itertools
 import logging
-import time
-from tqdm import tqdm
 from pyDOE2 import lhs
 import matplotlib.pyplot as plt
 from datetime import datetime
+from design_space import param_values, init_cond_values, scale_samples
+from pair_design import write_design
 
 
 #%% Defining functions
@@ -40,32 +38,6 @@ from datetime import datetime
 
 #%% Generate LHS for parameters and initial conditions
 start_time = time.time()
-param_values = [
-    ('(basal_fos).v', (0.08, 0.8, 80)), # increased range for FOS from 8 to 80
-    ('(basal_jun).v', (0.08, 0.8, 8)),
-    ('(basal_fra1).v', (0.08, 0.8, 8)),
-    ('(basal_fra2).v', (0.08, 0.8, 8)),
-    ('(basal_jund).v', (0.08, 0.8, 8)),
-    ('(jun_by_junjun).beta', (2, 20, 200)),
-    ('(jun_by_junfos).beta', (2, 20, 200)),
-    ('(fra1_by_junfra1).beta', (2, 20, 200)),
-    ('(fra1_by_jundfos).beta', (2, 20, 200)),
-    ('(fra2_by_junfra2).beta', (2, 20, 200)),
-    ('(degradation_fos).k1', (0.426, 0.852, 1.704)),
-    ('(degradation_jun).k1', (0.417, 0.834, 1.668)),
-    ('(degradation_fra1).k1', (0.174, 0.347, 0.694)),
-    ('(degradation_fra2).k1', (0.08, 0.16, 0.32)),
-    ('(degradation_jund).k1', (0.058, 0.116, 0.232))
-]
-
-init_cond_values = [ 
-    ('fos', (0.316, 10,316.228)), # mid value is 10 taking the geometric mean of 0.316 and 316.228
-    ('jun', (0.316, 10,316.228)),
-    ('fra1', (0.316,10, 316.228)),
-    ('fra2', (0.316,10, 316.228)),
-    ('jund', (0.316,10, 316.228))
-]
-
 # use lhs to sample the parameter space
 # sampling 10000 points for each parameter
 print("Generating LHS...")
@@ -77,54 +49,11 @@ lhs_initconds = lhs(len(init_cond_values), samples = init_cond_samples, random_s
 #each row in lhs_samples is a sample and the columns are the parameters
 # values are in the range of [0,1] for lhs so we need to scale them to the parameter range
 
-# adjust the formula for the parameters
-param_samples = []
-
-for i, ((param_name, param_range), sample_vals) in enumerate(zip(param_values, lhs_params.T)):
-    min_val, mid_val, max_val = param_range
-
-    # check the scaling type
-    if np.isclose(max_val/mid_val, 10, atol=1e-1) or max_val/min_val > 10:
-        
-        # If it's 100-fold logarithmic scaling:
-        log_min = np.log10(min_val)
-        log_max = np.log10(max_val)
-        log_vals = log_min + sample_vals * (log_max-log_min)
-        scaled_vals = np.power(10, log_vals)
-    else:
-        # If it's 2-fold difference:
-        log_min = np.log2(min_val)
-        log_max = np.log2(max_val)
-        log_vals = log_min + sample_vals * (log_max-log_min)
-        scaled_vals = np.power(2, log_vals)
-
-
-    param_samples.append((param_name, scaled_vals))
-
-# adjust the formula for the initial conditions
-init_cond_samples = []
-
-for i, ((init_cond_name, init_cond_range), sample_vals) in enumerate(zip(init_cond_values, lhs_initconds.T)):
-    min_val, mid_val, max_val = init_cond_range
-
-    # check the scaling type
-    if np.isclose(max_val/mid_val, mid_val/min_val, atol=1e-1) and np.isclose(max_val/mid_val, 10, atol=1e-1):
-        # If it's 100-fold logarithmic scaling:
-        log_min = np.log10(min_val)
-        log_max = np.log10(max_val)
-        log_vals = log_min + sample_vals * (log_max-log_min)
-        scaled_vals = np.power(10, log_vals)
-    else:
-        # If it's 2-fold difference:
-        log_min = np.log2(min_val)
-        log_max = np.log2(max_val)
-        log_vals = log_min + sample_vals * (log_max-log_min)
-        scaled_vals = np.power(2, log_vals)
-
-
-    init_cond_samples.append((init_cond_name, scaled_vals))
-
-
+# log10 or log2 scaling of every range, see design_space.scale_samples
+param_samples = list(zip([name for name, _ in param_values],
+                         scale_samples(lhs_params, param_values, 'param').T))
+init_cond_samples = list(zip([name for name, _ in init_cond_values],
+                             scale_samples(lhs_initconds, init_cond_values, 'init_cond').T))
 
 
 # we can transform this to a dataframe
@@ -224,84 +153,37 @@ init_cond_df.rename(columns={'index': 'init_cond_index'}, inplace=True)
 paramset_df['param_index'] = paramset_df['param_index'].astype('int64')
 init_cond_df['init_cond_index'] = init_cond_df['init_cond_index'].astype('int64')
 
-# Create a DataFrame for all combinations of parameter sets and initial conditions
-
-def process_chunk(start_row, end_row):
-    # Generate the parameter combinations for the current chunk
-    param_rows = paramset_df.reset_index().astype('int64')['index'][start_row:end_row]
-    init_rows = init_cond_df.reset_index().astype('int64')['index']
-    
-
-    print(f"Number of valid param rows in range: {len(param_rows)}")
-    print(f"Number of init_cond rows: {len(init_rows)}")
-    
-    chunk_combinations = product(param_rows, init_rows)
-
-    num_combinations = sum(1 for _ in chunk_combinations)
-    print(f"Number of combinations: {num_combinations}")
-    
-    chunk_combinations = product(param_rows, init_rows)  # Re-create the iterator
-
-    num_combinations = sum(1 for _ in chunk_combinations)
-    print(f"Number of combinations: {num_combinations}")
-    
-    chunk_combinations = product(param_rows, init_rows)  # Re-create the iterator
-
-    # Create a DataFrame for the current chunk
-    param_init_cond_df = pd.DataFrame(chunk_combinations, columns=['param_index', 'init_cond_index'])
-    param_init_cond_df = param_init_cond_df.join(paramset_df, on='param_index', rsuffix='_param')
-    param_init_cond_df = param_init_cond_df.join(init_cond_df, on='init_cond_index', rsuffix='_init')
-
-    # Drop unnecessary columns
-    if 'param_index_param' in param_init_cond_df.columns and 'init_cond_index_init' in param_init_cond_df.columns:
-        param_init_cond_df = param_init_cond_df.drop(['param_index_param', 'init_cond_index_init'], axis=1)
-    
-    return param_init_cond_df
-    #%% 
-
+# The design is written as the two tables and the chunks of index pairs of
+# pair_design.py, not as the cross product: run_simulation.py generates the
+# rows of a chunk on demand (python pair_design.py expand INPUT_DIR OUTPUT_DIR
+# writes the wide chunk CSVs, if a tool needs them). To grow the design later
+# without new indices, python pair_design.py extend INPUT_DIR N appends Sobol
+# points in new chunks.
 
 # Set up logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Set up your chunk size
-# Total number of rows
 number_samples = 10000
-total_rows = 2000000
 
 # Number of chunks
 num_chunks = 100
 
-# Chunk size (number of rows per chunk)
-chunk_size = total_rows // num_chunks
-
-if total_rows % chunk_size:
-    num_chunks += 1
-
 param_rows_per_chunk = len(paramset_df) // num_chunks
 
-#print("Dividing data into chunks...")
-# Iterate over the number of chunks
-
-logging.info(f"Dividing data into {num_chunks} chunks...")
-for chunk_idx in tqdm(range(num_chunks), desc="Processing chunks"):
-# Calculate the range of rows for the current chunk
+# every chunk: its param_index range with all initial conditions
+chunks = {}
+for chunk_idx in range(num_chunks):
     start_row = chunk_idx * param_rows_per_chunk
     end_row = min((chunk_idx+1) * param_rows_per_chunk, len(paramset_df))
-    
-    print(f"Processing chunk {chunk_idx}: start_row={start_row}, end_row={end_row}")
-
-
-    param_init_cond_df = process_chunk(start_row, end_row)
-    
-    filename = f'/scratch/njr7jk/ap1_hpc/input/chunk_{chunk_idx}_LHS_samples_{number_samples}.csv'
-    print(f"Saving to {filename}")
-
-    param_init_cond_df.to_csv(filename, index=False)
+    chunks[f'chunk_{chunk_idx}_LHS_samples_{number_samples}.csv'] = (start_row, end_row, 0, len(init_cond_df))
 
-print("Done dividing data into chunks.")
+input_dir = '/scratch/njr7jk/ap1_hpc/input'
+logging.info(f"Writing the design of {len(paramset_df)} parameter sets x {len(init_cond_df)} initial conditions "
+             f"in {num_chunks} chunks to {input_dir}...")
+write_design(input_dir, paramset_df, init_cond_df, chunks)
 
-print("All chunks have been created and saved.")
+print("Done writing the design.")
 
 
-print("Time elapsed: " + str(time.time() - start_time) + " seconds")
\ No newline at end of file
+print("Time elapsed: " + str(time.time() - start_time) + " seconds")
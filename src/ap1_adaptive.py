@@ -0,0 +1,293 @@
+"""Adaptive sampling of the parameter space toward the experimental AP-1 states.
+
+04_calibrate_model_to_experiments calibrates a parameter set to a cell line
+when one of its rows starts in a state of the cell line (initial conditions
+high at >= 10, else low) and ends in a state of the cell line. Uniform
+samples (LHS, Sobol) find few such sets for the rare cell-line states. The
+adaptive loop grows a pair design (pair_design.py) in rounds instead:
+
+    1. run_simulation.py --resume simulates the chunks without results
+    2. scan_run finds the calibrated parameter sets of every cell line and
+       retrains the surrogate of ap1_surrogate.py on the solved rows
+    3. propose_params draws the parameter sets of the next round. Every cell
+       line gets an equal share, drawn as gaussian steps (spread, in the unit
+       cube of the log-scaled ranges) from its calibrated sets, or uniformly
+       while it has none; the surrogate keeps the 1/oversample of the
+       candidates most likely to be calibrated. Cell lines with target_hits
+       calibrated sets get no more. An explore share of every round comes
+       from the Sobol/Halton sequence the design was sampled with (extend_design),
+       to keep finding new regions.
+    4. append_params adds them to the design, in new chunks
+
+until the simulated rows (parameter sets x initial conditions) reach the
+budget. BASE_DIR/adaptive/rounds.csv logs after every round the simulated
+rows and the calibrated parameter sets per cell line, for the design chunks
+and the adaptive ones, i.e. the calibrated sets per CPU time of both.
+
+    python ap1_adaptive.py run BASE_DIR --target-states ap1_singlecell_replicate_avg_frq_states_v2.csv \\
+        --budget 4000000 [--round-params 2000] [--run-args "--engine native --schedule dynamic"]
+    python ap1_adaptive.py propose BASE_DIR N --target-states ...   (one round, simulations run separately)
+
+run starts from the design in BASE_DIR/input (e.g. of LHS_params_init_conds.py),
+or from --seed-params Sobol points if there is none. Needs scikit-learn.
+"""
+import os
+import sys
+import time
+import shlex
+import argparse
+import logging
+import subprocess
+import numpy as np
+import pandas as pd
+from ap1_surrogate import (cell_line_states, solved_rows, steady_columns, state_labels, row_features,
+                           train_surrogate, target_probability)
+from design_space import param_values, init_cond_values, scale_samples, unit_scaled
+from pair_design import (DESIGN_FILE, load_design, list_chunk_files, read_chunk, design_sampler, append_params,
+                         extend_design)
+from checkpoint import pair_keys
+import result_store
+
+logger = logging.getLogger(__name__)
+
+param_names = [name for name, _ in param_values]
+init_cond_names = [name for name, _ in init_cond_values]
+ADAPTIVE_CHUNK = 'chunk_{i}_adaptive_samples.csv'
+
+
+def chunk_origin(chunk_file):
+    """'adaptive' for the chunks of propose_params, else 'design'."""
+    return 'adaptive' if '_adaptive_samples' in os.path.basename(chunk_file) else 'design'
+
+
+def simulated_chunks(base_dir, output_format='csv'):
+    """Chunk files of base_dir with results."""
+    chunk_files = list_chunk_files(os.path.join(base_dir, 'input'))
+    if output_format == 'parquet':
+        # one dataset for all chunks: a chunk has results if any of its pairs is in it
+        committed = result_store.committed_pairs(os.path.join(base_dir, 'output', 'results.parquet'))
+        return [chunk_file for chunk_file in chunk_files
+                if np.isin(chunk_keys(chunk_file), committed).any()]
+    return [chunk_file for chunk_file in chunk_files
+            if os.path.exists(os.path.join(base_dir, 'output', f'results_{os.path.basename(chunk_file)}'))]
+
+
+def chunk_keys(chunk_file):
+    """Pair keys of the rows of a chunk file."""
+    chunk = read_chunk(chunk_file, usecols=['param_index', 'init_cond_index'])
+    return pair_keys(chunk['param_index'], chunk['init_cond_index'])
+
+
+def calibrated_rows(rows, states_by_line):
+    """Calibrated (param_index, cell_line) pairs of solved rows, as in
+    04_calibrate_model_to_experiments: the row starts and ends in states of
+    the cell line
+    """
+    start = state_labels(rows[init_cond_names])
+    end = state_labels(rows[steady_columns()])
+    frames = [pd.DataFrame({'param_index': np.unique(rows['param_index'].to_numpy()[np.isin(start, states)
+                                                                                    & np.isin(end, states)]),
+                            'cell_line': cell_line})
+              for cell_line, states in states_by_line.items()]
+    return pd.concat(frames, ignore_index=True)
+
+
+def scan_run(base_dir, states_by_line, output_format='csv', max_rows=500000, seed=0):
+    """Calibrated parameter sets, simulated rows and surrogate training rows of base_dir.
+
+    Returns (calibrated: DataFrame param_index, cell_line, origin;
+    simulated: {origin: rows}; features; labels), with at most about
+    max_rows training rows, sampled evenly over the chunks
+    """
+    rng = np.random.default_rng(seed)
+    chunk_files = simulated_chunks(base_dir, output_format)
+    if not chunk_files:
+        raise ValueError(f"No results in {base_dir}/output to sample from.")
+    chunks, _, _ = load_design(os.path.join(base_dir, 'input'))
+    n_rows = {}
+    for chunk_file in chunk_files:
+        param_start, param_stop, init_cond_start, init_cond_stop = chunks[os.path.basename(chunk_file)]
+        n_rows[chunk_file] = (param_stop - param_start) * (init_cond_stop - init_cond_start)
+    fraction = min(1.0, max_rows / max(1, sum(n_rows.values())))
+    calibrated, features, labels = [], [], []
+    simulated = {'design': 0, 'adaptive': 0}
+    for chunk_file in chunk_files:
+        rows = solved_rows(base_dir, chunk_file, output_format)
+        simulated[chunk_origin(chunk_file)] += n_rows[chunk_file]
+        calibrated.append(calibrated_rows(rows, states_by_line).assign(origin=chunk_origin(chunk_file)))
+        rows = rows[rng.random(len(rows)) < fraction]
+        features.append(row_features(rows.drop(columns=steady_columns())))
+        labels.append(state_labels(rows[steady_columns()]))
+    return pd.concat(calibrated, ignore_index=True), simulated, np.concatenate(features), np.concatenate(labels)
+
+
+def calibration_probability(model, params, init_conds, states, block_size=200000):
+    """Predicted probability of every parameter set (n, 15) to be calibrated
+    with one of the initial conditions (m, 5): the highest probability, over
+    them, of ending in one of states
+    """
+    n_init = len(init_conds)
+    step = max(1, block_size // n_init)
+    p = np.empty(len(params))
+    for start in range(0, len(params), step):
+        block = params[start:start + step]
+        features = np.log10(np.hstack([np.repeat(block, n_init, axis=0), np.tile(init_conds, (len(block), 1))]))
+        p[start:start + step] = target_probability(model, features, states).reshape(len(block), n_init).max(axis=1)
+    return p
+
+
+def propose_params(model, params, init_conds, calibrated, states_by_line, n_new, spread=0.05, oversample=10,
+                   target_hits=None, max_init_conds=32, seed=0):
+    """n_new parameter sets toward the calibrated regions of every cell line,
+    as a DataFrame of the parameter columns.
+
+    params, init_conds: tables of the design (load_design)
+    calibrated: DataFrame param_index, cell_line of scan_run
+    """
+    rng = np.random.default_rng(seed)
+    unit_params = unit_scaled(params[param_names].to_numpy(), param_values)
+    init_cond_labels = state_labels(init_conds[init_cond_names])
+    lines = []
+    for cell_line, states in states_by_line.items():
+        n_hits = (calibrated['cell_line'] == cell_line).sum()
+        if not np.isin(init_cond_labels, states).any():
+            logger.warning(f"{cell_line}: no initial condition of the design starts in one of its states; skipped.")
+        elif target_hits is None or n_hits < target_hits:
+            lines.append(cell_line)
+    if not lines:
+        return pd.DataFrame(columns=param_names)
+
+    proposed = []
+    for cell_line, n_line in zip(lines, map(len, np.array_split(np.arange(n_new), len(lines)))):
+        if n_line == 0:
+            continue
+        states = states_by_line[cell_line]
+        hits = np.searchsorted(params['param_index'].to_numpy(),
+                               calibrated.loc[calibrated['cell_line'] == cell_line, 'param_index'].unique())
+        n_candidates = n_line * oversample
+        if len(hits):
+            steps = rng.normal(0, spread, (n_candidates, len(param_values)))
+            candidates = unit_params[rng.choice(hits, n_candidates)] + steps
+            # reflect the steps at the borders of the unit cube
+            candidates = 1 - np.abs(1 - np.abs(candidates))
+        else:
+            candidates = rng.random((n_candidates, len(param_values)))
+        candidates = scale_samples(np.clip(candidates, 0, 1), param_values, 'param')
+        starts = init_conds.loc[np.isin(init_cond_labels, states), init_cond_names].to_numpy()
+        if len(starts) > max_init_conds:
+            starts = starts[rng.choice(len(starts), max_init_conds, replace=False)]
+        p = calibration_probability(model, candidates, starts, states)
+        best = np.argsort(-p, kind='stable')[:n_line]
+        logger.info(f"{cell_line}: {len(hits)} calibrated parameter sets, {n_line} new ones "
+                    f"(mean predicted probability {p[best].mean():.3f}).")
+        proposed.append(candidates[best])
+    return pd.DataFrame(np.vstack(proposed), columns=param_names)
+
+
+def write_round(base_dir, calibrated, simulated, states_by_line):
+    """Append the calibrated sets per cell line and origin to BASE_DIR/adaptive/rounds.csv."""
+    counts = calibrated.groupby(['origin', 'cell_line'])['param_index'].nunique()
+    record = pd.DataFrame([{'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'origin': origin, 'cell_line': cell_line,
+                            'simulated_rows': simulated[origin], 'calibrated': int(counts.get((origin, cell_line), 0))}
+                           for origin in simulated for cell_line in states_by_line])
+    record_file = os.path.join(base_dir, 'adaptive', 'rounds.csv')
+    os.makedirs(os.path.dirname(record_file), exist_ok=True)
+    record.to_csv(record_file, mode='a', header=not os.path.exists(record_file), index=False)
+    for origin, rows in simulated.items():
+        if rows:
+            n_sets = calibrated.loc[calibrated['origin'] == origin, 'param_index'].nunique()
+            logger.info(f"{origin} chunks: {rows} simulated rows, {n_sets} calibrated parameter sets "
+                        f"({1e6 * n_sets / rows:.1f} per million rows).")
+
+
+def adaptive_round(base_dir, states_by_line, n_new, output_format='csv', explore=0.1, chunk_params=200,
+                   seed=0, **propose_args):
+    """Scan the results of base_dir, record them and append n_new parameter
+    sets to its design. Returns the new chunk names.
+    """
+    input_dir = os.path.join(base_dir, 'input')
+    calibrated, simulated, features, labels = scan_run(base_dir, states_by_line, output_format, seed=seed)
+    write_round(base_dir, calibrated, simulated, states_by_line)
+    if n_new <= 0:
+        return []
+    _, params, init_conds = load_design(input_dir)
+    n_explore = int(round(explore * n_new))
+    # continue the sequence the design was sampled with
+    sampler = design_sampler(input_dir) or {'method': 'sobol', 'seed': seed}
+    new_chunks = extend_design(input_dir, n_explore, sampler['method'], sampler['seed'],
+                               chunk_params) if n_explore else []
+    model = train_surrogate(features, labels, seed=seed)
+    # a new random stream for every round
+    proposed = propose_params(model, params, init_conds, calibrated, states_by_line, n_new - n_explore,
+                              seed=[seed, len(params)], **propose_args)
+    if len(proposed):
+        new_chunks += append_params(input_dir, [proposed], ADAPTIVE_CHUNK, chunk_params)
+    return new_chunks
+
+
+def run_simulations(base_dir, output_format='csv', run_args=''):
+    """Simulate the chunks of base_dir without results (run_simulation.py --resume)."""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_simulation.py'),
+               base_dir, '--resume', '--output-format', output_format] + shlex.split(run_args)
+    logger.info(f"Running {' '.join(command)}")
+    subprocess.run(command, check=True)
+
+
+def adaptive_loop(base_dir, states_by_line, budget, round_params=2000, output_format='csv', run_args='',
+                  **round_args):
+    """Rounds of simulation and adaptive_round until budget rows are simulated."""
+    input_dir = os.path.join(base_dir, 'input')
+    while True:
+        run_simulations(base_dir, output_format, run_args)
+        chunks, params, init_conds = load_design(input_dir)
+        n_rows = sum((p_stop - p_start) * (i_stop - i_start) for p_start, p_stop, i_start, i_stop in chunks.values())
+        n_new = min(round_params, (budget - n_rows) // len(init_conds))
+        logger.info(f"{n_rows} of {budget} rows simulated, {max(n_new, 0)} parameter sets in the next round.")
+        adaptive_round(base_dir, states_by_line, n_new, output_format, **round_args)
+        if n_new <= 0:
+            return
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Adaptive sampling of the parameter space toward the "
+                                                 "experimental AP-1 states of the cell lines.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help="simulate and propose in rounds until the budget is spent")
+    run.add_argument('base_dir')
+    run.add_argument('--budget', type=int, required=True, help="simulated rows (parameter sets x initial conditions)")
+    run.add_argument('--round-params', type=int, default=2000, help="parameter sets per round")
+    run.add_argument('--run-args', default='', help="arguments of run_simulation.py, e.g. \"--engine native\"")
+    run.add_argument('--seed-params', type=int, default=2000,
+                     help="Sobol parameter sets of the first round, without a design in BASE_DIR/input")
+    run.add_argument('--init-conds', type=int, default=200, help="initial conditions of such a new design")
+    propose = commands.add_parser('propose', help="append one round of parameter sets to a simulated design")
+    propose.add_argument('base_dir')
+    propose.add_argument('n_new', type=int)
+    for command in (run, propose):
+        command.add_argument('--target-states', required=True,
+                             help="experimental states csv (columns cell_line, state)")
+        command.add_argument('--cell-lines', nargs='+', default=None, help="only these cell lines (default: all)")
+        command.add_argument('--output-format', choices=['csv', 'parquet'], default='csv')
+        command.add_argument('--explore', type=float, default=0.1, help="share of Sobol points in every round")
+        command.add_argument('--spread', type=float, default=0.05,
+                             help="step from a calibrated set, in the unit cube of the log-scaled ranges")
+        command.add_argument('--oversample', type=int, default=10, help="candidates screened per proposed set")
+        command.add_argument('--target-hits', type=int, default=None,
+                             help="stop sampling for a cell line with this many calibrated sets")
+        command.add_argument('--chunk-params', type=int, default=200)
+        command.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    states_by_line = cell_line_states(args.target_states, args.cell_lines)
+    logger.info(f"{len(states_by_line)} cell lines, {sum(map(len, states_by_line.values()))} target states.")
+    round_args = dict(explore=args.explore, chunk_params=args.chunk_params, seed=args.seed, spread=args.spread,
+                      oversample=args.oversample, target_hits=args.target_hits)
+    if args.command == 'run':
+        if not os.path.exists(os.path.join(args.base_dir, 'input', DESIGN_FILE)):
+            extend_design(os.path.join(args.base_dir, 'input'), args.seed_params, seed=args.seed,
+                          chunk_params=args.chunk_params, n_init_conds=args.init_conds)
+        adaptive_loop(args.base_dir, states_by_line, args.budget, args.round_params, args.output_format,
+                      args.run_args, **round_args)
+    else:
+        adaptive_round(args.base_dir, states_by_line, args.n_new, args.output_format, **round_args)
@@ -0,0 +1,425 @@
+"""Pseudo-arclength continuation of the steady states of the native AP-1 model.
+
+Instead of resolving how the steady states depend on a parameter by
+sampling it densely, a branch of steady states is traced from one solution
+to the next: each point is predicted along the tangent of the branch and
+corrected by Newton, so it starts next to its solution and follows the
+branch around folds, where a parameter sweep jumps between branches.
+
+Branches are curves F(u, s) = 0 in log concentrations u = log(y) and
+s = log10 of the continued parameter, with F = rhs(y) / y, the time
+derivative of log(y); F_u is similar to the Jacobian, so its eigenvalues are
+the ones that decide stability. A fold (saddle-node) is a point of the
+branch where the s component of the tangent changes sign: the number of
+steady states changes by two there, so the folds of a parameter are the
+edges of its bistable range. Folds are refined with Newton on the
+minimally augmented system
+
+    F(u, s) = 0,  g(u, s) = 0,  where [[F_u, b], [c^T, 0]] [v; g] = [0; 1]
+
+(b, c: left and right null vectors of F_u near the fold), and the same
+system in two parameters, F(u, s1, s2) = 0, g = 0, is continued to trace
+the fold curve, i.e. the boundary of bistability in the (s1, s2) plane.
+
+Every function works on a batch of lanes, like ap1_steadystate.py: all
+lanes step together and drop out when they leave their parameter range,
+fail to converge or run out of points.
+
+run_simulation.py --mode continuation starts branches from the stored
+steady states of every param_index, in every LHS parameter over its sampled
+range (design_space.py), and writes one Parquet part per task of rows to
+
+    BASE_DIR/continuation/branches/     param_index, state (number of the
+        start steady state), parameter, point (0 at the start), value,
+        fos ... jund totals, max_real_eigenvalue, stable, fold
+    BASE_DIR/continuation/folds/        the refined folds, with value,
+        totals and converged
+    BASE_DIR/continuation/fold_curves/  with --fold-params: fold curves in
+        (parameter, parameter2), with point, value, value2 and totals
+"""
+import os
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from ap1_steadystate import lu_factor_batch, lu_solve_batch
+
+# status of a traced curve
+CURVE_BOUNDARY = 0  # left the parameter range
+CURVE_MAX_POINTS = 1  # max_points reached
+CURVE_FAILED = 2  # the corrector did not converge at the smallest step
+
+curve_status_names = {CURVE_BOUNDARY: 'boundary', CURVE_MAX_POINTS: 'max_points', CURVE_FAILED: 'failed'}
+
+Curve = namedtuple('Curve', ['lane', 'point', 'x', 'tangent', 'status'])
+Branch = namedtuple('Branch', ['lane', 'point', 'y', 'value', 'max_real_eigenvalue', 'fold', 'status'])
+Fold = namedtuple('Fold', ['lane', 'y', 'value', 'converged'])
+FoldCurve = namedtuple('FoldCurve', ['lane', 'point', 'y', 'values', 'status'])
+
+steady_state_species_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
+
+
+def _parameters(p, columns, s):
+    """Parameter arrays with the continued columns set to 10**s."""
+    p = np.array(p, dtype=float, copy=True)
+    p[np.arange(len(p))[:, None], columns] = 10.0 ** s
+    return p
+
+
+def steady_state_residual(model, p, columns, x):
+    """F = rhs(y) / y and its derivatives (F_u, F_s) for x = (log(y), s).
+
+    p: full parameter arrays of the lanes; columns: (n_lanes, k) indices of
+    the continued parameters, k = x.shape[-1] - n_species
+    """
+    n_species = len(model.species_names)
+    y = np.exp(x[:, :n_species])
+    s = x[:, n_species:]
+    pa = _parameters(p, columns, s)
+    f = model.rhs(y, pa) / y
+    # d (rhs_i / y_i) / d u_j = J_ij y_j / y_i - delta_ij f_i
+    f_u = model.jacobian(y, pa) * y[:, None, :] / y[:, :, None] - f[:, :, None] * np.eye(n_species)
+    # d (rhs_i / y_i) / d s_k = d rhs_i / d p_k * p_k log(10) / y_i
+    f_s = np.take_along_axis(model.parameter_jacobian(y, pa), columns[:, None, :], axis=-1)
+    f_s *= (np.log(10.0) * 10.0 ** s)[:, None, :] / y[:, :, None]
+    return f, f_u, f_s
+
+
+def _bordered_g(f_u, b, c):
+    """Fold test function g and null vector v of the bordered system
+    [[F_u, b], [c^T, 0]] [v; g] = [0; 1] for every lane
+    """
+    n_lanes, n = f_u.shape[:2]
+    bordered = np.zeros((n_lanes, n + 1, n + 1))
+    bordered[:, :n, :n] = f_u
+    bordered[:, :n, n] = b
+    bordered[:, n, :n] = c
+    rhs = np.zeros((n_lanes, n + 1))
+    rhs[:, n] = 1.0
+    solution = lu_solve_batch(lu_factor_batch(bordered), rhs)
+    return solution[:, n], solution[:, :n]
+
+
+def null_vectors(f_u):
+    """Left and right singular vectors of the smallest singular value of F_u."""
+    u, _, vt = np.linalg.svd(f_u)
+    return u[..., -1], vt[..., -1, :]
+
+
+def fold_residual(model, p, columns, x, b, c, step=1e-7):
+    """Residual (F, g) and its Jacobian for x = (log(y), s...) of a batch of lanes.
+
+    g is differentiated by central differences in all components of x, for
+    all lanes and components in one batched solve.
+    """
+    n_lanes, n_x = x.shape
+    n_species = len(model.species_names)
+    f, f_u, f_s = steady_state_residual(model, p, columns, x)
+    g, _ = _bordered_g(f_u, b, c)
+
+    shifted = (x[:, None, :] + step * np.concatenate([np.eye(n_x), -np.eye(n_x)])).reshape(-1, n_x)
+    repeat = np.repeat(np.arange(n_lanes), 2 * n_x)
+    y = np.exp(shifted[:, :n_species])
+    pa = _parameters(p[repeat], columns[repeat], shifted[:, n_species:])
+    f_shift = model.rhs(y, pa) / y
+    f_u_shift = model.jacobian(y, pa) * y[:, None, :] / y[:, :, None] - f_shift[:, :, None] * np.eye(n_species)
+    g_shift, _ = _bordered_g(f_u_shift, b[repeat], c[repeat])
+    g_shift = g_shift.reshape(n_lanes, 2, n_x)
+    g_x = (g_shift[:, 0] - g_shift[:, 1]) / (2 * step)
+
+    residual = np.concatenate([f, g[:, None]], axis=-1)
+    jacobian = np.concatenate([np.concatenate([f_u, f_s], axis=-1), g_x[:, None, :]], axis=1)
+    return residual, jacobian
+
+
+def _tangent(jacobian, t_prev):
+    """Unit tangents: null vectors of the (m, m+1) Jacobians, oriented along t_prev."""
+    n_lanes, m = jacobian.shape[:2]
+    rhs = np.zeros((n_lanes, m + 1))
+    rhs[:, m] = 1.0
+    t = lu_solve_batch(lu_factor_batch(np.concatenate([jacobian, t_prev[:, None, :]], axis=1)), rhs)
+    return t / np.linalg.norm(t, axis=-1, keepdims=True)
+
+
+def newton_square(residual, x0, max_iter=20, tol=1e-10):
+    """Newton on a square system for every lane; residual(x, lanes) returns
+    (r, dr/dx). Returns the solutions and a converged flag.
+    """
+    x = np.array(x0, dtype=float, copy=True)
+    converged = np.zeros(len(x), dtype=bool)
+    active = np.arange(len(x))
+    for _ in range(max_iter):
+        r, jac = residual(x[active], active)
+        dx = -lu_solve_batch(lu_factor_batch(jac), r)
+        ok = np.all(np.isfinite(dx), axis=-1)
+        x[active[ok]] += dx[ok]
+        done = ok & (np.max(np.abs(dx), axis=-1, initial=0.0) < tol)
+        converged[active[done]] = True
+        active = active[ok & ~done]
+        if not active.size:
+            break
+    return x, converged
+
+
+def pseudo_arclength(residual, x0, t0, lower, upper, h0=0.02, h_min=1e-6, h_max=0.1, max_points=500,
+                     max_corrector=8, tol=1e-9):
+    """Trace the curves G(x) = 0, G: R^(m+1) -> R^m, of a batch of lanes.
+
+    residual(x, lanes): G and its (m, m+1) Jacobian at x for the given lanes
+    x0: points on the curves; t0: initial directions (the tangent is
+        oriented along them)
+    lower, upper: bounds of the last k components of x (the parameters);
+        a lane stops at the first point outside them
+    h0, h_min, h_max: arclength steps; a step is halved when the corrector
+        fails and grows by 1.3 after fast convergence
+
+    Returns a Curve with the accepted points of all lanes (lane, point
+    number, x, unit tangent) and the status of every lane.
+    """
+    x = np.array(x0, dtype=float, copy=True)
+    n_lanes, n_x = x.shape
+    k = np.shape(lower)[-1]
+    h = np.full(n_lanes, h0, dtype=float)
+    status = np.full(n_lanes, CURVE_MAX_POINTS)
+    n_points = np.ones(n_lanes, dtype=int)
+
+    _, jac = residual(x, np.arange(n_lanes))
+    t = _tangent(jac, np.asarray(t0, dtype=float))
+    lanes_out, points_out, x_out, t_out = [np.arange(n_lanes)], [np.zeros(n_lanes, dtype=int)], [x.copy()], [t.copy()]
+
+    active = np.arange(n_lanes)
+    while active.size:
+        xa, ta, ha = x[active], t[active], h[active]
+        predicted = xa + ha[:, None] * ta
+        z = predicted.copy()
+        converged = np.zeros(active.size, dtype=bool)
+        iterations = np.zeros(active.size, dtype=int)
+        pending = np.arange(active.size)
+        for _ in range(max_corrector):
+            r, jac = residual(z[pending], active[pending])
+            # Newton on [G(z); t . (z - predicted)] = 0
+            bordered = np.concatenate([jac, ta[pending, None, :]], axis=1)
+            rhs = np.concatenate([r, np.einsum('ij,ij->i', ta[pending], z[pending] - predicted[pending])[:, None]],
+                                 axis=-1)
+            dz = -lu_solve_batch(lu_factor_batch(bordered), rhs)
+            ok = np.all(np.isfinite(dz), axis=-1)
+            z[pending[ok]] += dz[ok]
+            iterations[pending] += 1
+            done = ok & (np.max(np.abs(dz), axis=-1, initial=0.0) < tol)
+            converged[pending[done]] = True
+            pending = pending[ok & ~done]
+            if not pending.size:
+                break
+
+        # failed corrections: halve the step and try again from the same point
+        failed = ~converged
+        h[active[failed]] *= 0.5
+        too_small = failed & (h[active] < h_min)
+        status[active[too_small]] = CURVE_FAILED
+
+        accepted = np.flatnonzero(converged)
+        lanes = active[accepted]
+        outside = np.any((z[accepted, n_x - k:] < lower[lanes]) | (z[accepted, n_x - k:] > upper[lanes]), axis=-1)
+        status[lanes[outside]] = CURVE_BOUNDARY
+        inside = accepted[~outside]
+        lanes = active[inside]
+        if lanes.size:
+            _, jac = residual(z[inside], lanes)
+            t_new = _tangent(jac, ta[inside])
+            x[lanes], t[lanes] = z[inside], t_new
+            h[lanes] = np.where(iterations[inside] <= 3, np.minimum(h[lanes] * 1.3, h_max), h[lanes])
+            lanes_out.append(lanes)
+            points_out.append(n_points[lanes].copy())
+            x_out.append(z[inside].copy())
+            t_out.append(t_new)
+            n_points[lanes] += 1
+
+        stopped = too_small | np.isin(np.arange(active.size), accepted[outside])
+        stopped |= n_points[active] >= max_points
+        active = active[~stopped]
+
+    return Curve(np.concatenate(lanes_out), np.concatenate(points_out), np.concatenate(x_out),
+                 np.concatenate(t_out), status)
+
+
+def _both_directions(trace, x0, n_species):
+    """Run trace (a pseudo_arclength call taking x0, t0 and the lanes to trace)
+    in both directions along the first parameter and number the points of
+    every lane along the curve, negative in the decreasing direction
+    """
+    n_lanes, n_x = x0.shape
+    t0 = np.zeros((2 * n_lanes, n_x))
+    t0[:n_lanes, n_species] = 1.0
+    t0[n_lanes:, n_species] = -1.0
+    curve = trace(np.concatenate([x0, x0]), t0, np.concatenate([np.arange(n_lanes)] * 2))
+    backward = curve.lane >= n_lanes
+    keep = ~(backward & (curve.point == 0))
+    point = np.where(backward, -curve.point, curve.point)
+    lane = curve.lane % n_lanes
+    # tangents along increasing point numbers
+    tangent = np.where(backward[:, None], -curve.tangent, curve.tangent)
+    order = np.lexsort((point[keep], lane[keep]))
+    status = np.stack([curve.status[:n_lanes], curve.status[n_lanes:]], axis=-1)
+    return lane[keep][order], point[keep][order], curve.x[keep][order], tangent[keep][order], status
+
+
+def continue_branches(model, p, y0, columns, bounds, max_points=500, **kwargs):
+    """Trace the branch of steady states through y0 in one parameter per lane, both ways.
+
+    p: full parameter arrays of the lanes (model.parameter_array)
+    y0: steady states of the lanes at p, e.g. from solve_steadystate_hybrid
+    columns: index of the continued parameter in p, per lane
+    bounds: (n_lanes, 2) range of the continued parameter
+    kwargs: step settings of pseudo_arclength
+
+    Returns a Branch with one entry per point (lane, point number along the
+    branch with 0 at y0, species, parameter value, largest real eigenvalue
+    part, fold flag: the tangent turns back in the parameter between this
+    point and the next) and the status of every lane in each direction.
+    """
+    p = np.asarray(p, dtype=float)
+    columns = np.asarray(columns).reshape(-1, 1)
+    n_species = len(model.species_names)
+    log_bounds = np.log10(np.asarray(bounds, dtype=float))
+    x0 = np.concatenate([np.log(np.maximum(y0, 1e-12)), np.log10(p[np.arange(len(p))[:, None], columns])], axis=-1)
+
+    def trace(x_start, t0, lanes):
+        return pseudo_arclength(lambda x, active: _branch_residual(model, p[lanes[active]], columns[lanes[active]], x),
+                                x_start, t0, log_bounds[lanes, :1], log_bounds[lanes, 1:], max_points=max_points,
+                                **kwargs)
+
+    lane, point, x, tangent, status = _both_directions(trace, x0, n_species)
+    f_u = steady_state_residual(model, p[lane], columns[lane], x)[1]
+    max_real = np.linalg.eigvals(f_u).real.max(axis=-1) if len(x) else np.empty(0)
+    # the s component of the tangent changes sign at a fold
+    same_lane = np.append(lane[1:] == lane[:-1], False)
+    t_s = tangent[:, n_species]
+    fold = same_lane & (np.sign(t_s) != np.sign(np.append(t_s[1:], 0.0)))
+    return Branch(lane, point, np.exp(x[:, :n_species]), 10.0 ** x[:, n_species], max_real, fold, status)
+
+
+def _branch_residual(model, p, columns, x):
+    f, f_u, f_s = steady_state_residual(model, p, columns, x)
+    return f, np.concatenate([f_u, f_s], axis=-1)
+
+
+def locate_folds(model, p, columns, branch):
+    """Refine the folds flagged in a Branch by Newton on (F, g) = 0.
+
+    Newton starts from the midpoint (in log coordinates) of the flagged
+    point and the next one. Returns a Fold per flagged point (lane, species,
+    parameter value, converged).
+    """
+    p = np.asarray(p, dtype=float)
+    columns = np.asarray(columns).reshape(-1, 1)
+    n_species = len(model.species_names)
+    flagged = np.flatnonzero(branch.fold)
+    lane = branch.lane[flagged]
+    if not flagged.size:
+        return Fold(lane, np.empty((0, n_species)), np.empty(0), np.empty(0, dtype=bool))
+    x = np.concatenate([np.log(branch.y), np.log10(branch.value)[:, None]], axis=-1)
+    x0 = 0.5 * (x[flagged] + x[flagged + 1])
+    f_u = steady_state_residual(model, p[lane], columns[lane], x0)[1]
+    b, c = null_vectors(f_u)
+    x_fold, converged = newton_square(
+        lambda xa, active: fold_residual(model, p[lane[active]], columns[lane[active]], xa, b[active], c[active]), x0)
+    return Fold(lane, np.exp(x_fold[:, :n_species]), 10.0 ** x_fold[:, n_species], converged)
+
+
+def continue_folds(model, p, y_fold, columns, bounds, max_points=500, **kwargs):
+    """Trace fold curves in two parameters per lane, both ways from a fold.
+
+    y_fold: species at the folds (locate_folds), with p the parameter arrays
+        at the folds (the first parameter set to its fold value)
+    columns: (n_lanes, 2) the parameter of the fold and the second parameter
+    bounds: (n_lanes, 2, 2) ranges of both parameters
+
+    Returns a FoldCurve with one entry per point (lane, point number,
+    species, values of both parameters) and the status of every lane in
+    each direction; the curve is the boundary of the bistable region.
+    """
+    p = np.asarray(p, dtype=float)
+    columns = np.asarray(columns)
+    n_species = len(model.species_names)
+    log_bounds = np.log10(np.asarray(bounds, dtype=float))
+    x0 = np.concatenate([np.log(np.maximum(y_fold, 1e-12)), np.log10(p[np.arange(len(p))[:, None], columns])],
+                        axis=-1)
+    b, c = null_vectors(steady_state_residual(model, p, columns, x0)[1])
+
+    def trace(x_start, t0, lanes):
+        # follow the curve from the direction of the second parameter
+        t0 = np.roll(t0, 1, axis=-1)
+        return pseudo_arclength(
+            lambda x, active: fold_residual(model, p[lanes[active]], columns[lanes[active]], x, b[lanes[active]],
+                                            c[lanes[active]]),
+            x_start, t0, log_bounds[lanes, :, 0], log_bounds[lanes, :, 1], max_points=max_points, **kwargs)
+
+    lane, point, x, _, status = _both_directions(trace, x0, n_species)
+    return FoldCurve(lane, point, np.exp(x[:, :n_species]), 10.0 ** x[:, n_species:], status)
+
+
+def _lane_columns(lane, param_index, state, parameter):
+    """param_index, state and parameter columns of the points of some lanes."""
+    return {'param_index': np.asarray(param_index, dtype=np.int32)[lane],
+            'state': np.asarray(state, dtype=np.int16)[lane],
+            'parameter': pd.Categorical(np.asarray(parameter, dtype=object)[lane])}
+
+
+def _with_totals(data, model, y):
+    totals = model.totals(y)
+    for i, name in enumerate(steady_state_species_names):
+        data[name] = totals[:, i]
+    return data
+
+
+def branch_frame(model, branch, param_index, state, parameter):
+    """Long-format table of a Branch, one row per point.
+
+    param_index, state, parameter: per lane, the param_index and the number
+    of the stored steady state the branch starts from, and the name of the
+    continued parameter
+    """
+    data = pd.DataFrame(_lane_columns(branch.lane, param_index, state, parameter))
+    data['point'] = branch.point.astype(np.int32)
+    data['value'] = branch.value
+    data = _with_totals(data, model, branch.y)
+    data['max_real_eigenvalue'] = branch.max_real_eigenvalue
+    data['stable'] = branch.max_real_eigenvalue < 0
+    data['fold'] = branch.fold
+    return data
+
+
+def fold_frame(model, folds, param_index, state, parameter):
+    """Table of the Folds of locate_folds, one row per fold."""
+    data = pd.DataFrame(_lane_columns(folds.lane, param_index, state, parameter))
+    data['value'] = folds.value
+    data = _with_totals(data, model, folds.y)
+    data['converged'] = folds.converged
+    return data
+
+
+def fold_curve_frame(model, curve, param_index, state, parameter, parameter2):
+    """Long-format table of a FoldCurve, one row per point."""
+    data = pd.DataFrame(_lane_columns(curve.lane, param_index, state, parameter))
+    data['parameter2'] = pd.Categorical(np.asarray(parameter2, dtype=object)[curve.lane])
+    data['point'] = curve.point.astype(np.int32)
+    data['value'] = curve.values[:, 0]
+    data['value2'] = curve.values[:, 1]
+    return _with_totals(data, model, curve.y)
+
+
+def write_continuation(directory, name, tables):
+    """Write {'branches': DataFrame, ...} as directory/<table>/name.parquet via hidden temporary files."""
+    for table, data in tables.items():
+        table_dir = os.path.join(directory, table)
+        os.makedirs(table_dir, exist_ok=True)
+        tmp_file = os.path.join(table_dir, f'.{name}.tmp')
+        data.to_parquet(tmp_file, index=False, compression='zstd')
+        os.replace(tmp_file, os.path.join(table_dir, f'{name}.parquet'))
+
+
+def load_continuation(directory, table='branches'):
+    """One table of a continuation run ('branches', 'folds' or 'fold_curves') as a DataFrame."""
+    table_dir = os.path.join(directory, table)
+    files = sorted(os.path.join(table_dir, f) for f in os.listdir(table_dir)
+                   if f.endswith('.parquet') and not f.startswith('.'))
+    return pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
@@ -0,0 +1,554 @@
+"""Native NumPy version of the AP-1 COPASI model.
+
+The reactions, kinetic functions and assignment rules in a COPASI .cps file are
+parsed and turned into generated, vectorized Python code. The resulting
+right-hand side evaluates any number of parameter sets and initial conditions
+in one call, so the steady state engines do not need a basico/COPASI round trip
+per simulation.
+
+Shapes follow the usual NumPy broadcasting rules: states are (..., n_species)
+and parameters are (..., n_parameters), where the leading dimensions are the
+simulation "lanes".
+"""
+import os
+import re
+import ast
+import copy
+import xml.etree.ElementTree as ET
+import numpy as np
+
+COPASI_NS = {'c': 'http://www.copasi.org/static/schema'}
+
+# species order used by run_simulation.py: the 5 monomers that get LHS initial
+# conditions, followed by the 9 dimers that always start at 0
+monomer_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
+dimer_names = ['junfos', 'junfra1', 'junfra2', 'junjund', 'junjun', 'jundfos', 'jundfra1', 'jundfra2', 'jundjund']
+
+DEFAULT_CPS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ap1_model_2_mod.cps')
+
+AVOGADRO = 6.02214076e23
+QUANTITY_UNITS = {'mol': 1.0, 'mmol': 1e-3, 'µmol': 1e-6, 'umol': 1e-6, 'nmol': 1e-9, 'pmol': 1e-12, 'fmol': 1e-15}
+
+CN_PATTERN = re.compile(
+    r'<CN=Root,Model=[^,>]*,(?:Vector=Compartments\[[^\]]*\],)?'
+    r'Vector=(Metabolites|Values)\[([^\]]*)\],Reference=(\w+)>')
+PRODUCT_PATTERN = re.compile(r'PRODUCT<(\w+)_[a-z]>')
+
+
+def _ident(prefix, name):
+    """Turn a COPASI object name into a valid Python identifier."""
+    return prefix + re.sub(r'\W+', '_', name).strip('_')
+
+
+class _Rename(ast.NodeTransformer):
+    """Replace variable names in an expression tree using a mapping."""
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def visit_Name(self, node):
+        if node.id in self.mapping:
+            return ast.copy_location(ast.Name(id=self.mapping[node.id], ctx=ast.Load()), node)
+        return node
+
+
+class _Substitute(ast.NodeTransformer):
+    """Replace variable names in an expression tree by expressions."""
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+
+    def visit_Name(self, node):
+        if node.id in self.mapping:
+            return copy.deepcopy(self.mapping[node.id])
+        return node
+
+
+class _Hoist(ast.NodeTransformer):
+    """Replace subexpressions by the names of precomputed temporaries."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def visit_BinOp(self, node):
+        key = ast.dump(node)
+        if key in self.names:
+            return ast.Name(id=self.names[key], ctx=ast.Load())
+        return self.generic_visit(node)
+
+
+def _hoist_powers(expressions):
+    """Find power terms used more than once, e.g. substrate^hill in the Hill laws.
+
+    Returns the temporaries as (name, expression) pairs and the expressions
+    rewritten to use them, so every power is evaluated only once.
+    """
+    counts = {}
+    for expression in expressions:
+        for node in ast.walk(expression):
+            if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+                key = ast.dump(node)
+                counts[key] = (counts[key][0] + 1, node) if key in counts else (1, node)
+    repeated = [(key, node) for key, (count, node) in counts.items() if count > 1]
+    names = {key: f'_pow{i}' for i, (key, _) in enumerate(repeated)}
+    temporaries = [(names[key], node) for key, node in repeated]
+    hoist = _Hoist(names)
+    return temporaries, [hoist.visit(copy.deepcopy(expression)) for expression in expressions]
+
+
+def _is_number(node, value=None):
+    return isinstance(node, ast.Constant) and (value is None or node.value == value)
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return ast.BinOp(left=a, op=ast.Add(), right=b)
+
+
+def _sub(a, b):
+    if b is None:
+        return a
+    if a is None:
+        return ast.UnaryOp(op=ast.USub(), operand=b)
+    return ast.BinOp(left=a, op=ast.Sub(), right=b)
+
+
+def _mul(a, b):
+    if a is None or b is None:
+        return None
+    if _is_number(a, 1):
+        return b
+    if _is_number(b, 1):
+        return a
+    return ast.BinOp(left=a, op=ast.Mult(), right=b)
+
+
+def _derivative(node, var):
+    """Symbolic derivative of an expression tree with respect to the name var.
+
+    Only the operations that occur in COPASI rate laws and assignment rules are
+    supported (+, -, *, /, ^; an exponent that depends on var, e.g. a Hill
+    coefficient, needs a positive base).
+    Returns None when the derivative is identically zero, so that the generated
+    Jacobian only contains the structurally nonzero entries.
+    """
+    if isinstance(node, ast.Name):
+        return ast.Constant(1.0) if node.id == var else None
+    if isinstance(node, ast.Constant):
+        return None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        d = _derivative(node.operand, var)
+        if d is None or isinstance(node.op, ast.UAdd):
+            return d
+        return ast.UnaryOp(op=ast.USub(), operand=d)
+    if isinstance(node, ast.BinOp):
+        u, w = node.left, node.right
+        du, dw = _derivative(u, var), _derivative(w, var)
+        if du is None and dw is None:
+            return None
+        if isinstance(node.op, ast.Add):
+            return _add(du, dw)
+        if isinstance(node.op, ast.Sub):
+            return _sub(du, dw)
+        if isinstance(node.op, ast.Mult):
+            return _add(_mul(du, w), _mul(u, dw))
+        if isinstance(node.op, ast.Div):
+            if dw is None:
+                return ast.BinOp(left=du, op=ast.Div(), right=w)
+            # (u'w - uw') / w^2
+            numerator = _sub(_mul(du, w), _mul(u, dw))
+            return ast.BinOp(left=numerator, op=ast.Div(),
+                             right=ast.BinOp(left=w, op=ast.Pow(), right=ast.Constant(2)))
+        if isinstance(node.op, ast.Pow):
+            if dw is not None:
+                # u^w * (w' log(u) + w u' / u)
+                log_u = ast.Call(func=ast.Attribute(value=ast.Name(id='np', ctx=ast.Load()), attr='log',
+                                                    ctx=ast.Load()), args=[u], keywords=[])
+                inner = _mul(dw, log_u)
+                if du is not None:
+                    inner = _add(inner, ast.BinOp(left=_mul(w, du), op=ast.Div(), right=u))
+                return _mul(node, inner)
+            # n * u^(n - 1) * u'
+            if _is_number(w):
+                power = u if w.value == 2 else ast.BinOp(left=u, op=ast.Pow(), right=ast.Constant(w.value - 1))
+            else:
+                power = ast.BinOp(left=u, op=ast.Pow(),
+                                  right=ast.BinOp(left=w, op=ast.Sub(), right=ast.Constant(1)))
+            return _mul(_mul(w, power), du)
+    raise ValueError(f"Cannot differentiate {ast.unparse(node)}.")
+
+
+def _parse_expression(text):
+    """Parse a COPASI infix expression ('^' for powers) into a Python AST."""
+    return ast.parse(text.strip().replace('^', '**'), mode='eval').body
+
+
+class NativeModel:
+    """Vectorized NumPy right-hand side generated from a COPASI .cps file.
+
+    cps_file: path to the COPASI model
+    species_order: names of the reaction species in the order used for state
+        arrays; species missing from the list are appended in file order
+
+    Attributes
+    ----------
+    species_names : species in state-array order
+    parameter_names : free parameters, local ones named '(reaction).parameter'
+        like basico/LHS_params_init_conds.py, global ones by their plain name
+    default_parameters : parameter values stored in the .cps file
+    default_initial_concentrations : initial concentrations stored in the file
+    total_names : assignment species (the *_total readouts)
+    reaction_names : reactions in the column order of `fluxes`
+    stoichiometry : (n_species, n_reactions) stoichiometric matrix
+    source : the generated Python code
+    """
+
+    def __init__(self, cps_file=DEFAULT_CPS_FILE, species_order=None):
+        self.cps_file = cps_file
+        root = ET.parse(cps_file).getroot()
+        model = root.find('c:Model', COPASI_NS)
+
+        self._read_objects(model)
+        self._read_initial_state(model)
+
+        order = list(monomer_names + dimer_names) if species_order is None else list(species_order)
+        reaction_species = [m['name'] for m in self.metabolites.values() if m['type'] == 'reactions']
+        self.species_names = [s for s in order if s in reaction_species]
+        self.species_names += [s for s in reaction_species if s not in self.species_names]
+        self.total_names = [m['name'] for m in self.metabolites.values() if m['type'] == 'assignment']
+
+        self._read_functions(root)
+        self._read_reactions(model)
+
+        self.default_initial_concentrations = np.array(
+            [self._initial_concentration[s] for s in self.species_names])
+        self.default_parameters = np.array(self._parameter_values)
+        self.parameter_index = {name: i for i, name in enumerate(self.parameter_names)}
+        self.species_index = {name: i for i, name in enumerate(self.species_names)}
+
+        self.source = self._generate_source()
+        namespace = {'np': np}
+        exec(compile(self.source, f'<native {os.path.basename(cps_file)}>', 'exec'), namespace)
+        self._fluxes = namespace['fluxes']
+        self._flux_jacobian = namespace['flux_jacobian']
+        self._flux_parameter_jacobian = namespace['flux_parameter_jacobian']
+        self._totals = namespace['totals']
+
+    # ------------------------------------------------------------------ parsing
+    def _read_objects(self, model):
+        self.quantity_factor = QUANTITY_UNITS[model.get('quantityUnit')]
+        self.avogadro = float(model.get('avogadroConstant', AVOGADRO))
+
+        self.compartments = {}
+        for comp in model.iterfind('c:ListOfCompartments/c:Compartment', COPASI_NS):
+            self.compartments[comp.get('key')] = comp.get('name')
+        if len(self.compartments) != 1:
+            raise ValueError("Only single-compartment models are supported by the native engine.")
+
+        self.metabolites = {}
+        for met in model.iterfind('c:ListOfMetabolites/c:Metabolite', COPASI_NS):
+            expression = met.find('c:Expression', COPASI_NS)
+            self.metabolites[met.get('key')] = {
+                'name': met.get('name'),
+                'type': met.get('simulationType'),
+                'expression': None if expression is None else expression.text,
+            }
+
+        self.model_values = {}
+        for value in model.iterfind('c:ListOfModelValues/c:ModelValue', COPASI_NS):
+            expression = value.find('c:Expression', COPASI_NS)
+            self.model_values[value.get('key')] = {
+                'name': value.get('name'),
+                'type': value.get('simulationType'),
+                'expression': None if expression is None else expression.text,
+            }
+
+    def _read_initial_state(self, model):
+        template = [v.get('objectReference') for v in
+                    model.iterfind('c:StateTemplate/c:StateTemplateVariable', COPASI_NS)]
+        values = [float(v) for v in model.find('c:InitialState', COPASI_NS).text.split()]
+        initial = dict(zip(template, values))
+
+        volume = initial[next(iter(self.compartments))]
+        self._initial_concentration = {}
+        for key, met in self.metabolites.items():
+            self._initial_concentration[met['name']] = \
+                initial[key] / (self.avogadro * self.quantity_factor * volume)
+        self._initial_value = {self.model_values[key]['name']: initial[key] for key in self.model_values}
+
+    def _read_functions(self, root):
+        self.functions = {}
+        for func in root.iterfind('c:ListOfFunctions/c:Function', COPASI_NS):
+            self.functions[func.get('key')] = {
+                'name': func.get('name'),
+                'expression': func.find('c:Expression', COPASI_NS).text,
+                'parameters': {p.get('key'): p.get('name') for p in
+                               func.iterfind('c:ListOfParameterDescriptions/c:ParameterDescription', COPASI_NS)},
+            }
+
+    def _reference_name(self, key):
+        """Identifier in the generated code for a metabolite or model value key."""
+        if key in self.metabolites:
+            return _ident('x_', self.metabolites[key]['name'])
+        return _ident('g_', self.model_values[key]['name'])
+
+    def _read_reactions(self, model):
+        metabolite_names = {key: met['name'] for key, met in self.metabolites.items()}
+        used_globals = set()
+
+        self.parameter_names = []
+        self._parameter_values = []
+        self._parameter_idents = []
+        self.reaction_names = []
+        self.rate_expressions = []
+        stoichiometry = []
+
+        for reaction in model.iterfind('c:ListOfReactions/c:Reaction', COPASI_NS):
+            name = reaction.get('name')
+            column = np.zeros(len(self.species_names))
+            for tag, sign in (('c:ListOfSubstrates/c:Substrate', -1.0), ('c:ListOfProducts/c:Product', 1.0)):
+                for species in reaction.iterfind(tag, COPASI_NS):
+                    species_name = metabolite_names[species.get('metabolite')]
+                    column[self.species_names.index(species_name)] += sign * float(species.get('stoichiometry'))
+
+            constants = {c.get('key'): (c.get('name'), float(c.get('value')))
+                         for c in reaction.iterfind('c:ListOfConstants/c:Constant', COPASI_NS)}
+            law = reaction.find('c:KineticLaw', COPASI_NS)
+            function = self.functions[law.get('function')]
+
+            # map every function argument onto the identifiers of its sources
+            mapping = {}
+            for call in law.iterfind('c:ListOfCallParameters/c:CallParameter', COPASI_NS):
+                argument = function['parameters'][call.get('functionParameter')]
+                sources = []
+                for source in call.iterfind('c:SourceParameter', COPASI_NS):
+                    key = source.get('reference')
+                    if key in constants:
+                        par_name, par_value = constants[key]
+                        full_name = f'({name}).{par_name}'
+                        sources.append(_ident('k_', full_name))
+                        self.parameter_names.append(full_name)
+                        self._parameter_values.append(par_value)
+                        self._parameter_idents.append(sources[-1])
+                    else:
+                        if key in self.model_values:
+                            used_globals.add(key)
+                        sources.append(self._reference_name(key))
+                mapping[argument] = sources
+
+            text = PRODUCT_PATTERN.sub(lambda m: '(' + '*'.join(mapping[m.group(1)]) + ')', function['expression'])
+            expression = _Rename({arg: src[0] for arg, src in mapping.items() if len(src) == 1}).visit(
+                _parse_expression(text))
+
+            self.reaction_names.append(name)
+            self.rate_expressions.append(expression)
+            stoichiometry.append(column)
+
+        self.stoichiometry = np.array(stoichiometry).T
+
+        # fixed model values become free parameters, assignments are evaluated
+        assignments = {}
+        pending = set(used_globals)
+        while pending:
+            key = pending.pop()
+            value = self.model_values[key]
+            if value['type'] == 'assignment':
+                assignments[key] = self._parse_cn_expression(value['expression'])
+                pending |= {r for r in assignments[key][1] if r in self.model_values} - used_globals
+            elif value['type'] != 'fixed':
+                raise ValueError(f"Model value {value['name']} has unsupported type {value['type']}.")
+            used_globals.add(key)
+
+        for key, value in self.model_values.items():
+            if key in used_globals and value['type'] == 'fixed':
+                self.parameter_names.append(value['name'])
+                self._parameter_values.append(self._initial_value[value['name']])
+                self._parameter_idents.append(self._reference_name(key))
+        self.assignments = self._sort_assignments(
+            [(key, expression, refs) for key, (expression, refs) in assignments.items()])
+
+    def _parse_cn_expression(self, text):
+        """Parse an assignment expression containing <CN=...> references."""
+        keys_by_name = {('Metabolites', m['name']): k for k, m in self.metabolites.items()}
+        keys_by_name.update({('Values', v['name']): k for k, v in self.model_values.items()})
+        references = []
+
+        def replace(match):
+            key = keys_by_name[(match.group(1), match.group(2))]
+            references.append(key)
+            return self._reference_name(key)
+
+        return _parse_expression(CN_PATTERN.sub(replace, text)), references
+
+    def _sort_assignments(self, assignments):
+        """Order assignment rules so that every rule follows its dependencies."""
+        remaining = {key: (expression, refs) for key, expression, refs in assignments}
+        ordered = []
+        while remaining:
+            ready = [key for key, (_, refs) in remaining.items()
+                     if not any(r in remaining and r != key for r in refs)]
+            if not ready:
+                raise ValueError("Circular assignment rules in model.")
+            for key in sorted(ready, key=list(self.model_values).index):
+                ordered.append((key, remaining.pop(key)[0]))
+        return ordered
+
+    # ---------------------------------------------------------- code generation
+    def _preamble(self):
+        """Lines unpacking states and parameters and evaluating assignments."""
+        lines = []
+        for i, species in enumerate(self.species_names):
+            lines.append(f"    {_ident('x_', species)} = y[..., {i}]")
+        for i, ident in enumerate(self._parameter_idents):
+            lines.append(f"    {ident} = p[..., {i}]")
+        for key, expression in self.assignments:
+            lines.append(f"    {self._reference_name(key)} = {ast.unparse(expression)}")
+        return lines
+
+    def _generate_source(self):
+        lines = ["def fluxes(y, p):"]
+        lines += self._preamble()
+        lines.append("    shape = np.broadcast_shapes(y.shape[:-1], p.shape[:-1])")
+        lines.append(f"    v = np.empty(shape + ({len(self.reaction_names)},))")
+        temporaries, rate_expressions = _hoist_powers(self.rate_expressions)
+        for name, expression in temporaries:
+            lines.append(f"    {name} = {ast.unparse(expression)}")
+        for i, (name, expression) in enumerate(zip(self.reaction_names, rate_expressions)):
+            lines.append(f"    v[..., {i}] = {ast.unparse(expression)}  # {name}")
+        lines.append("    return v")
+        lines.append("")
+
+        # d fluxes / d y, the species Jacobian is stoichiometry @ flux_jacobian
+        lines.append("def flux_jacobian(y, p):")
+        lines += self._preamble()
+        lines.append("    shape = np.broadcast_shapes(y.shape[:-1], p.shape[:-1])")
+        lines.append(f"    dv = np.zeros(shape + ({len(self.reaction_names)}, {len(self.species_names)}))")
+        entries = []
+        for i, expression in enumerate(self.rate_expressions):
+            for j, species in enumerate(self.species_names):
+                derivative = _derivative(expression, _ident('x_', species))
+                if derivative is not None:
+                    entries.append((i, j, derivative))
+        temporaries, derivatives = _hoist_powers([d for _, _, d in entries])
+        for name, expression in temporaries:
+            lines.append(f"    {name} = {ast.unparse(expression)}")
+        for (i, j, _), derivative in zip(entries, derivatives):
+            lines.append(f"    dv[..., {i}, {j}] = {ast.unparse(derivative)}  "
+                         f"# {self.reaction_names[i]} / {self.species_names[j]}")
+        lines.append("    return dv")
+        lines.append("")
+
+        # d fluxes / d p, with the assignment rules inlined so that global
+        # parameters reach the rates they act on through the assignments
+        lines.append("def flux_parameter_jacobian(y, p):")
+        lines += self._preamble()
+        lines.append("    shape = np.broadcast_shapes(y.shape[:-1], p.shape[:-1])")
+        lines.append(f"    dv = np.zeros(shape + ({len(self.reaction_names)}, {len(self.parameter_names)}))")
+        inlined = {}
+        for key, expression in self.assignments:
+            inlined[self._reference_name(key)] = _Substitute(inlined).visit(copy.deepcopy(expression))
+        entries = []
+        for i, expression in enumerate(self.rate_expressions):
+            expression = _Substitute(inlined).visit(copy.deepcopy(expression))
+            for k, ident in enumerate(self._parameter_idents):
+                derivative = _derivative(expression, ident)
+                if derivative is not None:
+                    entries.append((i, k, derivative))
+        temporaries, derivatives = _hoist_powers([d for _, _, d in entries])
+        for name, expression in temporaries:
+            lines.append(f"    {name} = {ast.unparse(expression)}")
+        for (i, k, _), derivative in zip(entries, derivatives):
+            lines.append(f"    dv[..., {i}, {k}] = {ast.unparse(derivative)}  "
+                         f"# {self.reaction_names[i]} / {self.parameter_names[k]}")
+        lines.append("    return dv")
+        lines.append("")
+
+        lines.append("def totals(y):")
+        for i, species in enumerate(self.species_names):
+            lines.append(f"    {_ident('x_', species)} = y[..., {i}]")
+        lines.append(f"    t = np.empty(y.shape[:-1] + ({len(self.total_names)},))")
+        total_keys = [k for k, m in self.metabolites.items() if m['type'] == 'assignment']
+        for i, key in enumerate(total_keys):
+            expression, _ = self._parse_cn_expression(self.metabolites[key]['expression'])
+            lines.append(f"    t[..., {i}] = {ast.unparse(expression)}  # {self.metabolites[key]['name']}")
+        lines.append("    return t")
+        lines.append("")
+        return "\n".join(lines)
+
+    # -------------------------------------------------------------- evaluation
+    def _parameters(self, p):
+        return self.default_parameters if p is None else np.asarray(p, dtype=float)
+
+    def fluxes(self, y, p=None):
+        """Reaction rates, shape (..., n_reactions)."""
+        return self._fluxes(np.asarray(y, dtype=float), self._parameters(p))
+
+    def rhs(self, y, p=None):
+        """Time derivative of the species concentrations, shape (..., n_species)."""
+        return self.fluxes(y, p) @ self.stoichiometry.T
+
+    def flux_jacobian(self, y, p=None):
+        """Derivatives of the reaction rates, d fluxes / d y, shape (..., n_reactions, n_species)."""
+        return self._flux_jacobian(np.asarray(y, dtype=float), self._parameters(p))
+
+    def jacobian(self, y, p=None):
+        """Analytic Jacobian d rhs / d y, shape (..., n_species, n_species).
+
+        Generated by symbolic differentiation of the rate laws, for implicit
+        integrators and Newton steps on many lanes at once.
+        """
+        return self.stoichiometry @ self.flux_jacobian(y, p)
+
+    def flux_parameter_jacobian(self, y, p=None):
+        """Derivatives of the reaction rates, d fluxes / d p, shape (..., n_reactions, n_parameters)."""
+        return self._flux_parameter_jacobian(np.asarray(y, dtype=float), self._parameters(p))
+
+    def parameter_jacobian(self, y, p=None):
+        """Analytic d rhs / d p, shape (..., n_species, n_parameters), for
+        steady state sensitivities and continuation in a parameter.
+        """
+        return self.stoichiometry @ self.flux_parameter_jacobian(y, p)
+
+    def totals(self, y):
+        """Assignment species (fos_total, ...) for the given states."""
+        return self._totals(np.asarray(y, dtype=float))
+
+    def parameter_array(self, par_names, par_values):
+        """Full parameter array with the named columns replaced.
+
+        par_names: list of parameter names, e.g. the LHS columns '(basal_fos).v'
+        par_values: array of shape (n, len(par_names)) or (len(par_names),)
+        """
+        par_values = np.asarray(par_values, dtype=float)
+        p = np.broadcast_to(self.default_parameters, par_values.shape[:-1] + self.default_parameters.shape).copy()
+        columns = [self.parameter_index[name] for name in par_names]
+        p[..., columns] = par_values
+        return p
+
+    def initial_state(self, init_cond_values, species_name=None):
+        """Full state array with every species not given set to 0.
+
+        Mirrors CopasiSession.solve in copasi_session.py, which resets the dimers
+        to 0 and sets the monomer initial concentrations.
+        init_cond_values: array of shape (n, len(species_name))
+        species_name: species the columns refer to, defaults to the monomers
+        """
+        species_name = monomer_names if species_name is None else species_name
+        init_cond_values = np.asarray(init_cond_values, dtype=float)
+        y = np.zeros(init_cond_values.shape[:-1] + (len(self.species_names),))
+        y[..., [self.species_index[s] for s in species_name]] = init_cond_values
+        return y
+
+
+_native_models = {}
+
+
+def load_native_model(cps_file=DEFAULT_CPS_FILE):
+    """Load (and cache per process) the native model for a .cps file."""
+    cps_file = os.path.abspath(cps_file)
+    if cps_file not in _native_models:
+        _native_models[cps_file] = NativeModel(cps_file)
+    return _native_models[cps_file]
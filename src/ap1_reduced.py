@@ -0,0 +1,256 @@
+"""All steady states of the AP-1 model from the reduced monomer system.
+
+At steady state every dimer equation is linear in its own dimer,
+
+    d dimer/dt = Kon * monomer_a * monomer_b - (koff + degradation) * dimer = 0,
+
+so the nine dimers are explicit functions of the five monomers. What is left is
+a 5-dimensional rational system with Hill terms, F(monomers) = 0. For one
+parameter set, all of its roots are searched with deflated Newton from a set
+of starting points, instead of integrating the full model from 200 LHS
+initial conditions.
+
+Deflation (Farrell, Birkisson and Funke 2015) multiplies F by a factor that
+blows up at every root already found, so Newton started anywhere is pushed to
+a new root or fails. Like any Newton-based method it does not prove that no
+root was missed; the number of starting points and rounds sets the effort.
+
+Usage: python ap1_reduced.py BASE_DIR
+    reads the unique parameter sets of BASE_DIR/input/chunk_* and writes all
+    steady states per param_index to BASE_DIR/steady_state_census.csv
+"""
+import os
+import sys
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from ap1_native import load_native_model, monomer_names, dimer_names
+from ap1_steadystate import lu_factor_batch, lu_solve_batch, is_steady
+from pair_design import read_chunk, list_chunk_files
+
+SteadyStates = namedtuple('SteadyStates', ['set_index', 'y', 'stable', 'max_real_eigenvalue'])
+
+
+class ReducedModel:
+    """Monomer-only steady state equations of a NativeModel.
+
+    model: NativeModel from ap1_native
+    eliminated: species solved from their own steady state equation,
+        defaults to the dimers. Each must appear linearly, with a constant
+        coefficient, in its own equation only; checked at random states.
+    """
+
+    def __init__(self, model, eliminated=None):
+        self.model = model
+        eliminated = dimer_names if eliminated is None else eliminated
+        self.eliminated = np.array([model.species_index[s] for s in eliminated])
+        self.kept = np.array([i for i in range(len(model.species_names)) if i not in self.eliminated])
+        self.kept_names = [model.species_names[i] for i in self.kept]
+        self._check_structure()
+
+    def _check_structure(self):
+        rng = np.random.default_rng(0)
+        y = rng.uniform(0.1, 100.0, (4, len(self.model.species_names)))
+        jac = self.model.jacobian(y)[:, self.eliminated][:, :, self.eliminated]
+        diagonal = np.einsum('nii->ni', jac)
+        if not (np.allclose(jac, diagonal[:, :, None] * np.eye(len(self.eliminated)))
+                and np.allclose(diagonal, diagonal[0]) and np.all(diagonal != 0)):
+            raise ValueError("Eliminated species must enter their own steady state equation linearly.")
+
+    def full_state(self, x, p):
+        """Full state with the eliminated species at their steady state value given x."""
+        y = np.zeros(x.shape[:-1] + (len(self.model.species_names),))
+        y[..., self.kept] = x
+        f0 = self.model.rhs(y, p)[..., self.eliminated]
+        y[..., self.eliminated] = 1.0
+        slope = self.model.rhs(y, p)[..., self.eliminated] - f0
+        y[..., self.eliminated] = -f0 / slope
+        return y
+
+    def residual(self, x, p):
+        """Reduced right-hand side F(x), the kept species' rates at full_state(x)."""
+        return self.model.rhs(self.full_state(x, p), p)[..., self.kept]
+
+    def jacobian(self, x, p):
+        """dF/dx = J_kk + J_ke d(eliminated)/dx, with d(eliminated)/dx = -J_ek / J_ee."""
+        y = self.full_state(x, p)
+        jac = self.model.jacobian(y, p)
+        j_kk = jac[..., self.kept, :][..., :, self.kept]
+        j_ke = jac[..., self.kept, :][..., :, self.eliminated]
+        j_ek = jac[..., self.eliminated, :][..., :, self.kept]
+        j_ee = np.einsum('...ii->...i', jac[..., self.eliminated, :][..., :, self.eliminated])
+        return j_kk - j_ke @ (j_ek / j_ee[..., None])
+
+
+def deflated_newton(reduced, p, x0, roots, roots_set, set_index, max_iter=50, tol=1e-9,
+                    shift=1.0, min_damping=1e-3, max_log_step=3.0):
+    """Newton on the reduced system in log concentrations, deflated by known roots.
+
+    p: parameter arrays, one row per parameter set
+    x0: starting points (n, n_kept); set_index gives the parameter set of each
+    roots, roots_set: log concentrations of the known roots and their sets
+    tol: convergence test on the undeflated residual, see is_steady
+    shift: deflation shift, far from the known roots F is scaled by about shift
+
+    The deflated step is the Newton step of m(u) F(u), with
+    m(u) = prod_r (1 / |u - u_r|^2 + shift) over the roots of the same set.
+    By Sherman-Morrison it is the undeflated step divided by 1 - grad(log m).step.
+    Returns (log concentrations, converged flag).
+    """
+    u = np.log(np.maximum(x0, 1e-12))
+    pl = p[set_index]
+    converged = np.zeros(len(u), dtype=bool)
+
+    def log_deflation(u, lanes):
+        """log m(u) and its gradient for the given lanes."""
+        log_m = np.zeros(len(lanes))
+        grad = np.zeros((len(lanes), u.shape[-1]))
+        for root, root_set in zip(roots, roots_set):
+            mine = set_index[lanes] == root_set
+            if not np.any(mine):
+                continue
+            diff = u[mine] - root
+            dist2 = np.maximum(np.sum(diff ** 2, axis=-1), 1e-300)
+            factor = 1.0 / dist2 + shift
+            log_m[mine] += np.log(factor)
+            grad[mine] += (-2.0 * diff / dist2[:, None] ** 2) / factor[:, None]
+        return log_m, grad
+
+    def merit(f, x, lanes, u_lanes):
+        return np.log(np.sqrt(np.mean((f / (1.0 + x)) ** 2, axis=-1))) + log_deflation(u_lanes, lanes)[0]
+
+    active = np.arange(len(u))
+    for _ in range(max_iter):
+        x = np.exp(u[active])
+        f = reduced.residual(x, pl[active])
+        done = is_steady(f, x, tol, tol)
+        converged[active[done]] = True
+        active, x, f = active[~done], x[~done], f[~done]
+        if not active.size:
+            break
+
+        jac_log = reduced.jacobian(x, pl[active]) * x[:, None, :]
+        step = -lu_solve_batch(lu_factor_batch(jac_log), f)
+        _, grad = log_deflation(u[active], active)
+        step = step / (1.0 - np.sum(grad * step, axis=-1))[:, None]
+        step = np.clip(step, -max_log_step, max_log_step)
+
+        current = merit(f, x, active, u[active])
+        accepted = np.zeros(active.size, dtype=bool)
+        damping = 1.0
+        while damping >= min_damping:
+            trial = np.flatnonzero(~accepted & np.all(np.isfinite(step), axis=-1))
+            if not trial.size:
+                break
+            u_trial = u[active[trial]] + damping * step[trial]
+            x_trial = np.exp(u_trial)
+            f_trial = reduced.residual(x_trial, pl[active[trial]])
+            ok = np.all(np.isfinite(f_trial), axis=-1)
+            ok[ok] = merit(f_trial[ok], x_trial[ok], active[trial[ok]], u_trial[ok]) < current[trial[ok]]
+            u[active[trial[ok]]] = u_trial[ok]
+            accepted[trial[ok]] = True
+            damping *= 0.5
+        active = active[accepted]
+
+    return u, converged
+
+
+def starting_points(n_sets, n_starts, low=1e-2, high=1e3, seed=0):
+    """Log-uniform monomer concentrations, (n_sets * n_starts, 5), and their set index."""
+    rng = np.random.default_rng(seed)
+    x0 = np.exp(rng.uniform(np.log(low), np.log(high), (n_sets * n_starts, len(monomer_names))))
+    return x0, np.repeat(np.arange(n_sets), n_starts)
+
+
+def all_steadystates(model, p, n_starts=20, max_rounds=4, seed=0, merge_tol=1e-4):
+    """All steady states found for every parameter set.
+
+    model: NativeModel from ap1_native
+    p: parameter arrays (n_sets, n_parameters)
+    n_starts: Newton starting points per parameter set and round
+    max_rounds: rounds of deflated Newton; a set with a root stops early once
+        a round finds no new one, a set without one is searched in every round
+    merge_tol: roots closer than this (max abs difference in log
+        concentration) count as the same
+
+    Returns SteadyStates with one row per root: the parameter set it belongs
+    to, the full state, whether it is linearly stable and the largest real
+    part of the Jacobian eigenvalues. Sets without a row had no root found.
+    """
+    reduced = ReducedModel(model)
+    p = np.atleast_2d(np.asarray(p, dtype=float))
+    n_sets = len(p)
+    roots, roots_set = [], []
+    searching = np.ones(n_sets, dtype=bool)
+    has_root = np.zeros(n_sets, dtype=bool)
+
+    for round_index in range(max_rounds):
+        sets = np.flatnonzero(searching)
+        if not sets.size:
+            break
+        x0, start_set = starting_points(len(sets), n_starts, seed=seed + round_index)
+        set_index = sets[start_set]
+        u, converged = deflated_newton(reduced, p, x0, roots, roots_set, set_index)
+
+        new_found = np.zeros(n_sets, dtype=bool)
+        for lane in np.flatnonzero(converged):
+            s = set_index[lane]
+            if not any(rs == s and np.max(np.abs(r - u[lane])) < merge_tol for r, rs in zip(roots, roots_set)):
+                roots.append(u[lane])
+                roots_set.append(s)
+                new_found[s] = True
+        has_root |= new_found
+        searching &= new_found | ~has_root
+
+    roots_set = np.array(roots_set, dtype=int)
+    order = np.argsort(roots_set, kind='stable')
+    roots_set = roots_set[order]
+    x = np.exp(np.array(roots).reshape(-1, len(reduced.kept))[order])
+    y = reduced.full_state(x, p[roots_set])
+    max_real = np.linalg.eigvals(model.jacobian(y, p[roots_set])).real.max(axis=-1) if len(y) else np.empty(0)
+    return SteadyStates(roots_set, y, max_real < 0, max_real)
+
+
+def steady_state_census(model, par_names, param_values, param_index, **kwargs):
+    """Table of all steady states per LHS parameter set.
+
+    One row per steady state: param_index, its *_total concentrations
+    (fos, jun, fra1, fra2, jund), stable, max_real_eigenvalue and
+    n_stable, the number of stable steady states of that parameter set.
+    A parameter set without any steady state found has one row with empty
+    concentrations and n_stable 0.
+    """
+    p = model.parameter_array(par_names, param_values)
+    found = all_steadystates(model, p, **kwargs)
+    census = pd.DataFrame(model.totals(found.y), columns=monomer_names)
+    census.insert(0, 'param_index', np.asarray(param_index)[found.set_index])
+    census['stable'] = found.stable
+    census['max_real_eigenvalue'] = found.max_real_eigenvalue
+    not_found = np.setdiff1d(np.asarray(param_index), census['param_index'])
+    if not_found.size:
+        print(f"No steady state found for {not_found.size} parameter sets.")
+        census = pd.concat([census, pd.DataFrame({'param_index': not_found, 'stable': False})],
+                           ignore_index=True).sort_values('param_index', kind='stable').reset_index(drop=True)
+    census['n_stable'] = census.groupby('param_index')['stable'].transform('sum')
+    return census
+
+
+if __name__ == '__main__':
+    BASE_DIR = sys.argv[1]
+    INPUT_DIR = os.path.join(BASE_DIR, 'input')
+    chunk_files = list_chunk_files(INPUT_DIR)
+
+    native_model = load_native_model()
+    param_sets = []
+    for chunk_file in chunk_files:
+        chunk = read_chunk(chunk_file)
+        param_sets.append(chunk.iloc[:, [0] + list(range(2, 17))].drop_duplicates('param_index'))
+    param_sets = pd.concat(param_sets).drop_duplicates('param_index').sort_values('param_index')
+
+    census = []
+    for start in range(0, len(param_sets), 1000):
+        block = param_sets.iloc[start:start + 1000]
+        census.append(steady_state_census(native_model, block.columns[1:].tolist(),
+                                          block.iloc[:, 1:].round(3).to_numpy(dtype=float), block['param_index']))
+        print(f"Processed {start + len(block)} of {len(param_sets)} parameter sets.")
+    pd.concat(census).to_csv(os.path.join(BASE_DIR, 'steady_state_census.csv'), index=False)
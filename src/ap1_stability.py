@@ -0,0 +1,131 @@
+"""Linear stability of the steady states of run_simulation.py.
+
+The results only keep the five *_total concentrations (rounded to 0.1), not
+the 14 species. At a steady state every dimer is made only by its binding
+reaction and lost by unbinding and degradation, so the dimers follow from
+the free monomers, and the totals fix the full state: state_from_totals
+solves the dimer balances together with the totals, and newton_batch polishes
+the result into a steady state of the full model. A row is resolved when that
+steady state has the stored totals up to their rounding.
+
+The Jacobian of every resolved state is evaluated analytically for a whole
+block of rows, and its eigenvalues give:
+
+    max_real_eigenvalue  largest real part; below 0 for a stable state
+    stable               1 stable, 0 unstable (a saddle or an unstable focus)
+    slowest_timescale    1 / |max_real_eigenvalue|, the relaxation time of the
+                         slowest mode near a stable state (growth time for an
+                         unstable one)
+"""
+from collections import namedtuple
+import numpy as np
+from ap1_native import monomer_names
+from ap1_steadystate import newton_batch, lu_factor_batch, lu_solve_batch
+
+StabilityResult = namedtuple('StabilityResult', ['y', 'resolved', 'max_real_eigenvalue', 'stable',
+                                                 'slowest_timescale'])
+
+# half the rounding step of the stored totals (np.round(..., 1) in run_simulation.py)
+TOTALS_TOLERANCE = 0.05
+
+
+def state_from_totals(model, p, totals, max_iter=50, tol=1e-10, min_damping=1e-3, max_log_step=5.0, floor=1e-3):
+    """Species concentrations with the given *_total concentrations and
+    balanced dimers, for every lane.
+
+    Damped Newton in log concentrations, as in newton_batch, on the rhs of
+    the dimers (the species that are not monomers) together with
+    totals(y) / totals - 1. Totals below floor (0.0 after rounding) are raised to
+    it, so every species stays positive.
+    Returns the states and a converged flag per lane.
+    """
+    totals = np.maximum(np.asarray(totals, dtype=float), floor)
+    p = np.broadcast_to(np.asarray(p, dtype=float), totals.shape[:-1] + (np.shape(p)[-1],))
+    n_lanes = totals.shape[0]
+    n_species = len(model.species_names)
+    dimers = [i for i, name in enumerate(model.species_names) if name not in monomer_names]
+    # the totals are linear in the species
+    totals_matrix = model.totals(np.eye(n_species)).T
+
+    def residual(y, pa, ta):
+        return np.concatenate([model.rhs(y, pa)[:, dimers] / (1.0 + y[:, dimers]),
+                               model.totals(y) / ta - 1.0], axis=-1)
+
+    # start from monomers at the totals, with the dimers balanced against
+    # them: dimer rates are linear in the dimers, so one linear solve from 0
+    y = model.initial_state(totals)
+    dimer_jac = model.jacobian(y, p)[:, dimers][:, :, dimers]
+    y[:, dimers] = -lu_solve_batch(lu_factor_batch(dimer_jac), model.rhs(y, p)[:, dimers])
+    y = np.maximum(y, 1e-12)
+    converged = np.zeros(n_lanes, dtype=bool)
+    g = residual(y, p, totals)
+    active = np.arange(n_lanes)
+    for _ in range(max_iter):
+        done = np.all(np.abs(g[active]) <= tol, axis=-1)
+        converged[active[done]] = True
+        active = active[~done]
+        if not active.size:
+            break
+
+        ya, pa, ta, ga = y[active], p[active], totals[active], g[active]
+        # d residual / d log(y), with the scaling of residual held fixed
+        jac_log = np.concatenate([model.jacobian(ya, pa)[:, dimers] / (1.0 + ya[:, dimers, None]),
+                                  totals_matrix / ta[:, :, None]], axis=1) * ya[:, None, :]
+        du = np.clip(-lu_solve_batch(lu_factor_batch(jac_log), ga), -max_log_step, max_log_step)
+        norm = np.linalg.norm(ga, axis=-1)
+
+        accepted = np.zeros(active.size, dtype=bool)
+        damping = 1.0
+        while damping >= min_damping:
+            trial = np.flatnonzero(~accepted & np.all(np.isfinite(du), axis=-1))
+            if not trial.size:
+                break
+            y_trial = ya[trial] * np.exp(damping * du[trial])
+            g_trial = residual(y_trial, pa[trial], ta[trial])
+            ok = np.all(np.isfinite(g_trial), axis=-1)
+            ok[ok] = np.linalg.norm(g_trial[ok], axis=-1) < (1.0 - 1e-4 * damping) * norm[trial[ok]]
+            ya[trial[ok]], ga[trial[ok]] = y_trial[ok], g_trial[ok]
+            accepted[trial[ok]] = True
+            damping *= 0.5
+
+        y[active], g[active] = ya, ga
+        # no damped step reduces the residual: give up on the lane
+        active = active[accepted]
+    return y, converged
+
+
+def eigenvalue_summary(jac):
+    """max_real_eigenvalue, stable and slowest_timescale of a block of Jacobians."""
+    if not len(jac):
+        return np.empty(0), np.empty(0, dtype=bool), np.empty(0)
+    max_real = np.linalg.eigvals(jac).real.max(axis=-1)
+    with np.errstate(divide='ignore'):
+        slowest_timescale = 1.0 / np.abs(max_real)
+    return max_real, max_real < 0, slowest_timescale
+
+
+def steady_state_stability(model, p, totals, y=None):
+    """Eigenvalue summary of the steady states of a block of rows.
+
+    p: full parameter arrays of the rows (model.parameter_array)
+    totals: (n, 5) stored *_total concentrations
+    y: full steady states, if known (native engine); else rebuilt from totals
+    Returns a StabilityResult; rows that are not resolved have NaN in the
+    eigenvalue columns and stable False.
+    """
+    totals = np.asarray(totals, dtype=float)
+    p = np.broadcast_to(np.asarray(p, dtype=float), totals.shape[:-1] + (np.shape(p)[-1],))
+    if y is None:
+        y, _ = state_from_totals(model, p, totals)
+    polish = newton_batch(model, p, y)
+    y = polish.y
+    resolved = polish.converged & np.all(np.abs(model.totals(y) - totals) <= TOTALS_TOLERANCE + 1e-6 * np.abs(totals),
+                                         axis=-1)
+
+    n_lanes = len(totals)
+    max_real = np.full(n_lanes, np.nan)
+    slowest_timescale = np.full(n_lanes, np.nan)
+    stable = np.zeros(n_lanes, dtype=bool)
+    max_real[resolved], stable[resolved], slowest_timescale[resolved] = eigenvalue_summary(
+        model.jacobian(y[resolved], p[resolved]))
+    return StabilityResult(y, resolved, max_real, stable, slowest_timescale)
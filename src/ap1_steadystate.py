@@ -0,0 +1,514 @@
+"""Batched steady state solver for the native AP-1 model (ap1_native.py).
+
+A block of (parameter set, initial condition) pairs is integrated as one
+vectorized system. Every lane has its own time, step size and convergence test,
+and drops out of the active set as soon as it has reached a steady state, so
+slow lanes do not hold back the rest of the block.
+
+Return codes follow the COPASI steady state task used in run_simulation.py.
+"""
+import time
+from collections import namedtuple
+import numpy as np
+from scipy.integrate import LSODA
+
+# return codes (0 to 3 have the same meaning as in COPASI); shared with
+# copasi_session.py and the status column of result_store.py
+STATUS_NOT_FOUND = 0
+STATUS_FOUND = 1
+STATUS_EQUILIBRIUM = 2  # COPASI only
+STATUS_NEGATIVE = 3
+STATUS_INTEGRATION_FAILED = 4  # failed step here, DLSODA error in COPASI
+STATUS_UNEXPECTED = 5  # COPASI only: any other return code or error
+STATUS_TIMEOUT = 6  # stopped by the time or step budget of the simulation
+
+status_messages = {
+    STATUS_NOT_FOUND: "Steady state not found.",
+    STATUS_NEGATIVE: "Steady state with negative concentrations found.",
+    STATUS_INTEGRATION_FAILED: "Steady state calculation failed due to integration error.",
+    STATUS_TIMEOUT: "Steady state calculation stopped at its time or step budget.",
+}
+
+# path a lane took in solve_steadystate_hybrid
+PATH_INTEGRATION = 0  # settled during the short integration
+PATH_NEWTON = 1  # polished by damped Newton
+PATH_FALLBACK = 2  # Newton failed, long integration from the short-integration end point
+
+path_names = {PATH_INTEGRATION: 'integration', PATH_NEWTON: 'newton', PATH_FALLBACK: 'fallback_integration'}
+
+# rungs of solve_steadystate_rescue, in the order they are tried
+RESCUE_TIGHT_TOLERANCE = 0
+RESCUE_LONG_HORIZON = 1
+RESCUE_LSODA = 2
+RESCUE_NEWTON_POLISH = 3
+RESCUE_NONE = -1  # no rung found a steady state
+
+rescue_names = {RESCUE_TIGHT_TOLERANCE: 'rescue_tight_tolerance', RESCUE_LONG_HORIZON: 'rescue_long_horizon',
+                RESCUE_LSODA: 'rescue_lsoda', RESCUE_NEWTON_POLISH: 'rescue_newton_polish'}
+
+SteadyStateResult = namedtuple('SteadyStateResult', ['y', 'status', 't', 'steps', 'h'])
+HybridResult = namedtuple('HybridResult', ['y', 'status', 'path', 'newton_iterations', 'steps', 't'])
+NewtonResult = namedtuple('NewtonResult', ['y', 'converged', 'iterations'])
+RescueResult = namedtuple('RescueResult', ['y', 'status', 'rung', 'newton_iterations', 'steps'])
+
+# ROS2 (Verwer et al. 1999), an L-stable 2-stage Rosenbrock method
+ROS2_GAMMA = 1.0 + 1.0 / np.sqrt(2.0)
+
+
+def finite_difference_jacobian(model, y, p):
+    """Forward difference Jacobian d rhs / d y for all lanes, shape (n, n_species, n_species).
+
+    Only kept to check model.jacobian, the solvers use the analytic Jacobian.
+    """
+    n_species = y.shape[-1]
+    f0 = model.rhs(y, p)
+    delta = np.sqrt(np.finfo(float).eps) * np.maximum(np.abs(y), 1e-6)
+    y_pert = y[:, None, :] + delta[:, :, None] * np.eye(n_species)
+    f_pert = model.rhs(y_pert, p[:, None, :])
+    return np.swapaxes((f_pert - f0[:, None, :]) / delta[:, :, None], 1, 2)
+
+
+def lu_factor_batch(a):
+    """LU factorization with partial pivoting of a stack of small matrices.
+
+    a: (n, m, m). The loops run over the m pivots and every operation is
+    vectorized over the n lanes, which is much faster than np.linalg.inv for
+    thousands of 14x14 systems. Returns (lu, piv) with the lanes as the last
+    axis of lu, for lu_solve_batch.
+    """
+    lu = np.ascontiguousarray(np.moveaxis(a, 0, -1))
+    m, n = lu.shape[0], lu.shape[-1]
+    lanes = np.arange(n)
+    piv = np.empty((m, n), dtype=np.intp)
+    for k in range(m):
+        piv[k] = k + np.argmax(np.abs(lu[k:, k, :]), axis=0)
+        swap = lanes[piv[k] != k]
+        if swap.size:
+            rows = piv[k, swap]
+            row_k = lu[k, :, swap].copy()
+            lu[k, :, swap] = lu[rows, :, swap]
+            lu[rows, :, swap] = row_k
+        if k + 1 < m:
+            lu[k + 1:, k, :] /= lu[k, k, :]
+            lu[k + 1:, k + 1:, :] -= lu[k + 1:, k, None, :] * lu[None, k, k + 1:, :]
+    return lu, piv
+
+
+def lu_solve_batch(lu_piv, b):
+    """Solve a @ x = b for every lane, given lu_factor_batch(a); b is (n, m)."""
+    lu, piv = lu_piv
+    x = np.array(b.T, dtype=float)
+    m = x.shape[0]
+    lanes = np.arange(x.shape[1])
+    for k in range(m):
+        swap = lanes[piv[k] != k]
+        if swap.size:
+            rows = piv[k, swap]
+            x_k = x[k, swap].copy()
+            x[k, swap] = x[rows, swap]
+            x[rows, swap] = x_k
+    for k in range(m - 1):
+        x[k + 1:] -= lu[k + 1:, k, :] * x[k]
+    for k in range(m - 1, -1, -1):
+        x[k] = (x[k] - np.einsum('jn,jn->n', lu[k, k + 1:, :], x[k + 1:])) / lu[k, k, :]
+    return x.T
+
+
+def is_steady(f, y, ss_rtol, ss_atol):
+    """Per-lane rate criterion: every |dy/dt| below ss_atol + ss_rtol*|y|."""
+    return np.all(np.abs(f) <= ss_atol + ss_rtol * np.abs(y), axis=-1)
+
+
+def max_real_eigenvalue(jac):
+    """Largest real part of the Jacobian eigenvalues for every lane."""
+    if not len(jac):
+        return np.empty(0)
+    return np.linalg.eigvals(jac).real.max(axis=-1)
+
+
+def ros2_step(model, ya, pa, fa, ha, eye, rtol, atol):
+    """One ROS2 step of size ha for a set of lanes.
+
+    ya, pa, fa: states, parameters and rhs of the lanes; eye: identity of the
+    state size. Returns the new states and their rhs, which lanes accept the
+    step and the factor for their next step size.
+    """
+    jac = model.jacobian(ya, pa)
+    lu = lu_factor_batch(eye - (ROS2_GAMMA * ha)[:, None, None] * jac)
+    k1 = lu_solve_batch(lu, fa)
+    k2 = lu_solve_batch(lu, model.rhs(ya + ha[:, None] * k1, pa) - 2.0 * k1)
+    y_new = ya + ha[:, None] * (1.5 * k1 + 0.5 * k2)
+
+    # embedded linearly implicit Euler solution for the error estimate,
+    # filtered through the iteration matrix so that well-damped stiff
+    # components (the fast dimerization) do not control the step size
+    err = lu_solve_batch(lu, 0.5 * ha[:, None] * (k1 + k2))
+    scale = atol + rtol * np.maximum(np.abs(ya), np.abs(y_new))
+    err_norm = np.max(np.abs(err) / scale, axis=-1)
+    # the Hill terms are undefined for negative dimers, so a step that
+    # overshoots below zero is rejected like any other failed step
+    f_new = model.rhs(y_new, pa)
+    err_norm[~np.all(np.isfinite(f_new), axis=-1)] = np.inf
+    accepted = err_norm <= 1.0
+
+    factor = np.clip(0.9 / np.sqrt(np.maximum(err_norm, 1e-10)), 0.2, 5.0)
+    factor[~accepted] = np.minimum(factor[~accepted], 0.5)
+    return y_new, f_new, accepted, factor
+
+
+def solve_steadystate_batch(model, p, y0, t_max=1e9, rtol=1e-3, atol=1e-3, ss_rtol=1e-6, ss_atol=1e-9,
+                            h0=1e-4, max_steps=5000, negative_tol=1e-6, t0=0.0, deadline=None):
+    """Integrate every lane until its own steady state test passes.
+
+    model: NativeModel from ap1_native
+    p: parameter array (n, n_parameters)
+    y0: initial states (n, n_species)
+    t_max: longest integration time per lane (COPASI uses 1e9)
+    rtol, atol: local error tolerances of the integrator. They only decide
+        which basin a lane ends up in, the final state is held to the steady
+        state criterion; 1e-3 reproduced tight LSODA runs on LHS samples
+    ss_rtol, ss_atol: steady state rate criterion, see is_steady
+    h0: initial step size
+    max_steps: step budget per lane
+    negative_tol: concentrations below -negative_tol count as negative
+    t0: start time. t0, h0 and max_steps may also be per-lane arrays, which is
+        how solve_steadystate_hybrid continues an earlier integration
+    deadline: time.perf_counter() value at which all lanes still integrating
+        stop (the wall time budget of the block)
+    Lanes that use up their steps or hit the deadline get STATUS_TIMEOUT,
+    lanes that reach t_max without settling STATUS_NOT_FOUND.
+
+    Returns a SteadyStateResult with the final states, status codes, the time
+    each lane stopped at, the number of steps it took and its last step size.
+    """
+    y = np.array(y0, dtype=float, copy=True)
+    p = np.broadcast_to(np.asarray(p, dtype=float), y.shape[:-1] + (np.shape(p)[-1],))
+    n_lanes, n_species = y.shape
+    eye = np.eye(n_species)
+
+    status = np.full(n_lanes, STATUS_NOT_FOUND)
+    t = np.array(np.broadcast_to(t0, n_lanes), dtype=float)
+    h = np.array(np.broadcast_to(h0, n_lanes), dtype=float)
+    max_steps = np.broadcast_to(max_steps, n_lanes)
+    steps = np.zeros(n_lanes, dtype=int)
+    f = model.rhs(y, p)
+
+    active = np.flatnonzero(~is_steady(f, y, ss_rtol, ss_atol))
+    status[np.setdiff1d(np.arange(n_lanes), active)] = STATUS_FOUND
+
+    while active.size:
+        ya, pa, fa, ha = y[active], p[active], f[active], h[active]
+        ha = np.minimum(ha, t_max - t[active])
+
+        y_new, f_new, accepted, factor = ros2_step(model, ya, pa, fa, ha, eye, rtol, atol)
+
+        lanes = active[accepted]
+        y[lanes] = y_new[accepted]
+        t[lanes] += ha[accepted]
+        f[lanes] = f_new[accepted]
+        h[active] = ha * factor
+        steps[active] += 1
+
+        done = np.zeros(active.size, dtype=bool)
+        steady = np.zeros(active.size, dtype=bool)
+        steady[accepted] = is_steady(f[lanes], y[lanes], ss_rtol, ss_atol)
+        negative = steady & np.any(y[active] < -negative_tol, axis=-1)
+        status[active[steady]] = STATUS_FOUND
+        status[active[negative]] = STATUS_NEGATIVE
+        done |= steady
+
+        # lanes that reached t_max without settling
+        exhausted = ~done & (t[active] >= t_max)
+        status[active[exhausted]] = STATUS_NOT_FOUND
+        done |= exhausted
+
+        # lanes over their step or wall time budget
+        if deadline is not None and time.perf_counter() > deadline:
+            over_budget = ~done
+        else:
+            over_budget = ~done & (steps[active] >= max_steps[active])
+        status[active[over_budget]] = STATUS_TIMEOUT
+        done |= over_budget
+
+        # step size collapse or non-finite values, the equivalent of a DLSODA error
+        failed = ~done & (h[active] < 1e-14 * np.maximum(1.0, t[active]))
+        status[active[failed]] = STATUS_INTEGRATION_FAILED
+        done |= failed
+
+        active = active[~done]
+
+    return SteadyStateResult(y, status, t, steps, h)
+
+
+def newton_batch(model, p, y0, max_iter=30, ss_rtol=1e-6, ss_atol=1e-9, min_damping=1e-3, max_log_step=5.0):
+    """Damped Newton iteration on rhs(y) = 0 for every lane.
+
+    The iteration runs in log concentrations, u = log(y), so the iterates stay
+    positive; in linear coordinates the Newton step keeps cutting into the Hill
+    terms, which are undefined for negative dimers. Each iteration takes the
+    full step if it reduces the scaled residual norm, and halves it until it
+    does (down to min_damping). Single components move by at most a factor
+    exp(max_log_step) per iteration. A lane stops as soon as it passes the
+    steady state test, or fails when no damped step reduces the residual or
+    the Jacobian is singular.
+
+    Returns a NewtonResult with the final states, a converged flag and the
+    number of iterations per lane.
+    """
+    y = np.maximum(np.array(y0, dtype=float), 1e-12)
+    p = np.broadcast_to(np.asarray(p, dtype=float), y.shape[:-1] + (np.shape(p)[-1],))
+    n_lanes = y.shape[0]
+    converged = np.zeros(n_lanes, dtype=bool)
+    iterations = np.zeros(n_lanes, dtype=int)
+
+    def residual_norm(f, y):
+        return np.sqrt(np.mean((f / (1.0 + np.abs(y))) ** 2, axis=-1))
+
+    f = model.rhs(y, p)
+    active = np.arange(n_lanes)
+    for _ in range(max_iter):
+        steady = is_steady(f[active], y[active], ss_rtol, ss_atol)
+        converged[active[steady]] = True
+        active = active[~steady]
+        if not active.size:
+            break
+
+        ya, pa, fa = y[active], p[active], f[active]
+        # d rhs / d log(y) = J diag(y)
+        jac_log = model.jacobian(ya, pa) * ya[:, None, :]
+        du = np.clip(-lu_solve_batch(lu_factor_batch(jac_log), fa), -max_log_step, max_log_step)
+        norm = residual_norm(fa, ya)
+        iterations[active] += 1
+
+        # backtracking on the step length, lane by lane; the weights of the
+        # residual norm are held at the current iterate so du is a descent direction
+        accepted = np.zeros(active.size, dtype=bool)
+        y_next, f_next = ya.copy(), fa.copy()
+        damping = 1.0
+        while damping >= min_damping:
+            trial = np.flatnonzero(~accepted & np.all(np.isfinite(du), axis=-1))
+            if not trial.size:
+                break
+            y_trial = ya[trial] * np.exp(damping * du[trial])
+            f_trial = model.rhs(y_trial, pa[trial])
+            ok = np.all(np.isfinite(f_trial), axis=-1)
+            ok[ok] = residual_norm(f_trial[ok], ya[trial[ok]]) < (1.0 - 1e-4 * damping) * norm[trial[ok]]
+            y_next[trial[ok]], f_next[trial[ok]] = y_trial[ok], f_trial[ok]
+            accepted[trial[ok]] = True
+            damping *= 0.5
+
+        y[active], f[active] = y_next, f_next
+        active = active[accepted]
+    else:
+        converged[active] = is_steady(f[active], y[active], ss_rtol, ss_atol)
+
+    return NewtonResult(y, converged, iterations)
+
+
+def solve_steadystate_hybrid(model, p, y0, newton_times=(1.0, 10.0, 100.0), max_newton_iter=8,
+                             newton_min_damping=1.0, max_newton_move=4.0, t_max=1e9, max_steps=5000, ss_rtol=1e-6, ss_atol=1e-9,
+                             negative_tol=1e-6, **kwargs):
+    """Short integration polished by Newton, with a fallback ladder.
+
+    Every lane is integrated up to the first of newton_times and then handed to
+    newton_batch. A Newton root is accepted only if it is non-negative and
+    linearly stable, since only a stable steady state can be reached by the
+    integration it replaces. Lanes where Newton diverges or lands on a negative
+    or unstable root continue integrating from where they stopped to the next
+    of newton_times and try Newton again; after the last one they integrate up
+    to t_max like solve_steadystate_batch.
+
+    newton_min_damping: smallest Newton step length. The default of 1 only
+        accepts full steps, i.e. a lane is handed over once it is inside the
+        region of fast convergence around its root. On LHS samples, damped
+        Newton from farther out occasionally converged to the steady state of
+        another basin, which matters for the multistability analysis.
+    max_newton_move: a root is also rejected if any concentration differs from
+        the integration end point by more than this factor, for the same reason
+
+    Path codes: PATH_INTEGRATION when a lane settles (or fails) during one of
+    the short integration stages, PATH_NEWTON when its steady state comes from
+    Newton, PATH_FALLBACK when it needed the long integration.
+
+    Extra keyword arguments go to solve_steadystate_batch.
+    Returns a HybridResult with the final states, status codes, path codes,
+    Newton iterations, integration steps and integration time per lane.
+    """
+    y = np.array(y0, dtype=float, copy=True)
+    p = np.broadcast_to(np.asarray(p, dtype=float), y.shape[:-1] + (np.shape(p)[-1],))
+    n_lanes = len(y)
+    tolerances = dict(ss_rtol=ss_rtol, ss_atol=ss_atol, negative_tol=negative_tol)
+
+    status = np.full(n_lanes, STATUS_NOT_FOUND)
+    path = np.full(n_lanes, PATH_INTEGRATION)
+    newton_iterations = np.zeros(n_lanes, dtype=int)
+    steps = np.zeros(n_lanes, dtype=int)
+    t = np.zeros(n_lanes)
+    h = np.full(n_lanes, kwargs.pop('h0', 1e-4))
+
+    pending = np.arange(n_lanes)
+    for stage_end in list(newton_times) + [t_max]:
+        if not pending.size:
+            break
+        stage = solve_steadystate_batch(model, p[pending], y[pending], t_max=stage_end, t0=t[pending],
+                                        h0=h[pending], max_steps=max_steps - steps[pending], **tolerances, **kwargs)
+        y[pending], t[pending], h[pending] = stage.y, stage.t, stage.h
+        steps[pending] += stage.steps
+        status[pending] = stage.status
+
+        # lanes that settled, went negative, failed or ran out of budget are final
+        final = stage.status != STATUS_NOT_FOUND
+        if stage_end == t_max:
+            path[pending] = PATH_FALLBACK
+            break
+        pending = pending[~final]
+        if not pending.size:
+            break
+
+        newton = newton_batch(model, p[pending], y[pending], max_iter=max_newton_iter,
+                              ss_rtol=ss_rtol, ss_atol=ss_atol, min_damping=newton_min_damping)
+        newton_iterations[pending] += newton.iterations
+        ok = newton.converged & np.all(newton.y >= -negative_tol, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            move = np.abs(np.log(newton.y / y[pending]))
+        ok &= np.all(~(move > np.log(max_newton_move)), axis=-1)
+        ok[ok] = max_real_eigenvalue(model.jacobian(newton.y[ok], p[pending[ok]])) < 0
+        y[pending[ok]] = newton.y[ok]
+        status[pending[ok]] = STATUS_FOUND
+        path[pending[ok]] = PATH_NEWTON
+        pending = pending[~ok]
+
+    return HybridResult(y, status, path, newton_iterations, steps, t)
+
+
+def solve_steadystate_lsoda(model, p, y0, t_max=1e9, rtol=1e-6, atol=1e-9, ss_rtol=1e-6, ss_atol=1e-9,
+                            max_steps=20000, negative_tol=1e-6, deadline=None):
+    """Steady states with scipy's LSODA (the integrator of COPASI), lane by lane.
+
+    A different method than the batched ROS2 integrator, for the lanes it
+    could not solve; too slow for whole blocks. Every accepted step is
+    followed by the steady state test. Same arguments and status codes as
+    solve_steadystate_batch; the deadline is checked after every step.
+    Returns a SteadyStateResult.
+    """
+    y = np.array(y0, dtype=float, copy=True)
+    p = np.broadcast_to(np.asarray(p, dtype=float), y.shape[:-1] + (np.shape(p)[-1],))
+    n_lanes = len(y)
+    status = np.full(n_lanes, STATUS_NOT_FOUND)
+    t = np.zeros(n_lanes)
+    h = np.zeros(n_lanes)
+    steps = np.zeros(n_lanes, dtype=int)
+
+    for lane in range(n_lanes):
+        pl = p[lane:lane + 1]
+        solver = LSODA(lambda t, yl: model.rhs(yl[None], pl)[0], 0.0, y[lane], t_max, rtol=rtol, atol=atol,
+                       jac=lambda t, yl: model.jacobian(yl[None], pl)[0])
+        while True:
+            with np.errstate(all='ignore'):
+                message = solver.step()
+            steps[lane] += 1
+            yl = solver.y
+            if solver.status == 'failed' or message is not None or not np.all(np.isfinite(yl)):
+                status[lane] = STATUS_INTEGRATION_FAILED
+                break
+            if is_steady(model.rhs(yl[None], pl), yl[None], ss_rtol, ss_atol)[0]:
+                status[lane] = STATUS_NEGATIVE if np.any(yl < -negative_tol) else STATUS_FOUND
+                break
+            if solver.status == 'finished':
+                break
+            if steps[lane] >= max_steps or (deadline is not None and time.perf_counter() > deadline):
+                status[lane] = STATUS_TIMEOUT
+                break
+        y[lane], t[lane], h[lane] = solver.y, solver.t, solver.step_size or 0.0
+
+    return SteadyStateResult(y, status, t, steps, h)
+
+
+def solve_steadystate_rescue(model, p, y0, max_steps=20000, rung_time=60.0, ss_rtol=1e-6, ss_atol=1e-9,
+                             negative_tol=1e-6):
+    """Escalating second try for lanes without a steady state.
+
+    Each rung gets only the lanes the earlier ones did not solve:
+    RESCUE_TIGHT_TOLERANCE: solve_steadystate_batch with integrator
+        tolerances rtol 1e-5, atol 1e-8 instead of 1e-3 (1e-6/1e-9 ran out of
+        steps on most LHS rows)
+    RESCUE_LONG_HORIZON: solve_steadystate_batch up to t = 1e12
+    RESCUE_LSODA: solve_steadystate_lsoda, a different integrator
+    RESCUE_NEWTON_POLISH: damped newton_batch from where the long horizon
+        integration stopped, accepted if the root is non-negative and stable
+    A negative steady state does not count as solved. Each integration rung
+    stops at max_steps steps per lane or after rung_time seconds; lanes that
+    oscillate would otherwise use up any budget.
+    Returns a RescueResult with the final states, status codes, the rung that
+    solved each lane (RESCUE_NONE if none did), Newton iterations and
+    integration steps.
+    """
+    y = np.array(y0, dtype=float, copy=True)
+    p = np.broadcast_to(np.asarray(p, dtype=float), y.shape[:-1] + (np.shape(p)[-1],))
+    n_lanes = len(y)
+    tolerances = dict(ss_rtol=ss_rtol, ss_atol=ss_atol, negative_tol=negative_tol)
+    status = np.full(n_lanes, STATUS_NOT_FOUND)
+    rung = np.full(n_lanes, RESCUE_NONE)
+    newton_iterations = np.zeros(n_lanes, dtype=int)
+    steps = np.zeros(n_lanes, dtype=int)
+    # where the Newton polish starts: the end point of the long integration
+    y_end = y.copy()
+
+    def take(lanes, result, code):
+        steps[lanes] += result.steps
+        status[lanes] = result.status
+        ok = result.status == STATUS_FOUND
+        y[lanes[ok]] = result.y[ok]
+        rung[lanes[ok]] = code
+        return lanes[~ok]
+
+    pending = np.arange(n_lanes)
+    stage = solve_steadystate_batch(model, p, y, rtol=1e-5, atol=1e-8, max_steps=max_steps,
+                                    deadline=time.perf_counter() + rung_time, **tolerances)
+    pending = take(pending, stage, RESCUE_TIGHT_TOLERANCE)
+
+    if pending.size:
+        stage = solve_steadystate_batch(model, p[pending], y[pending], t_max=1e12, max_steps=max_steps,
+                                        deadline=time.perf_counter() + rung_time, **tolerances)
+        finite = np.all(np.isfinite(stage.y), axis=-1)
+        y_end[pending[finite]] = stage.y[finite]
+        pending = take(pending, stage, RESCUE_LONG_HORIZON)
+
+    if pending.size:
+        stage = solve_steadystate_lsoda(model, p[pending], y[pending], max_steps=max_steps,
+                                        deadline=time.perf_counter() + rung_time, **tolerances)
+        pending = take(pending, stage, RESCUE_LSODA)
+
+    if pending.size:
+        newton = newton_batch(model, p[pending], y_end[pending], ss_rtol=ss_rtol, ss_atol=ss_atol)
+        newton_iterations[pending] += newton.iterations
+        ok = newton.converged & np.all(newton.y >= -negative_tol, axis=-1)
+        ok[ok] = max_real_eigenvalue(model.jacobian(newton.y[ok], p[pending[ok]])) < 0
+        y[pending[ok]] = newton.y[ok]
+        status[pending[ok]] = STATUS_FOUND
+        rung[pending[ok]] = RESCUE_NEWTON_POLISH
+
+    return RescueResult(y, status, rung, newton_iterations, steps)
+
+
+def steadystate_totals(model, par_names, param_values, init_cond_values, method='integration', **kwargs):
+    """Steady state *_total concentrations for a block of LHS rows.
+
+    Same inputs as one row of the chunk files, stacked: parameter values
+    (n, len(par_names)) and monomer initial conditions (n, 5). Dimers start at 0.
+    method: 'integration' (solve_steadystate_batch) or 'hybrid'
+        (solve_steadystate_hybrid)
+    Returns (totals, status, path, newton_iterations, steps) where totals is
+    (n, 5), in the order fos, jun, fra1, fra2, jund.
+    """
+    p = model.parameter_array(par_names, param_values)
+    y0 = model.initial_state(init_cond_values)
+    if method == 'hybrid':
+        result = solve_steadystate_hybrid(model, p, y0, **kwargs)
+        return model.totals(result.y), result.status, result.path, result.newton_iterations, result.steps
+    if method != 'integration':
+        raise ValueError(f"Unknown steady state method {method}.")
+    result = solve_steadystate_batch(model, p, y0, **kwargs)
+    n_lanes = len(result.y)
+    return (model.totals(result.y), result.status, np.full(n_lanes, PATH_INTEGRATION),
+            np.zeros(n_lanes, dtype=int), result.steps)
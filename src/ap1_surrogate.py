@@ -0,0 +1,219 @@
+"""Surrogate pre-screen of the LHS rows before the ODE simulations.
+
+04_calibrate_model_to_experiments keeps the parameter sets whose steady
+states have one of the experimental discrete states (every total high at
+>= 10, else low), so most simulated rows are thrown away. A random forest
+trained on the results of finished runs predicts the state of a row from its
+log10 LHS parameters and initial conditions, with the predicted probability
+as its confidence, on CPU and at a few microseconds per row.
+
+screen_chunk scores the rows of a chunk file against a set of target states:
+p_target of a parameter set is the highest predicted probability, over its
+initial conditions, of ending in one of them. A parameter set is ruled out
+when p_target is below 1 - confidence. run_simulation.py --screen skip leaves
+the rows of ruled-out sets out of the run, --screen deprioritize runs them
+after all the others. As an optional stage between LHS_params_init_conds.py
+and run_simulation.py:
+
+    python ap1_surrogate.py train surrogate.joblib FINISHED_BASE_DIR [...]
+    python ap1_surrogate.py screen surrogate.joblib BASE_DIR \\
+        --target-states ap1_singlecell_replicate_avg_frq_states_v2.csv [--cell-lines ...] [--confidence 0.95]
+    python run_simulation.py BASE_DIR --screen skip
+
+screen writes BASE_DIR/screen/screen_<chunk> (param_index, p_target,
+ruled_out). Needs scikit-learn (as plsda_module.py).
+"""
+import os
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+import joblib
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.model_selection import train_test_split
+import result_store
+from pair_design import read_chunk, list_chunk_files
+
+logger = logging.getLogger(__name__)
+
+steady_state_species_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
+index_columns = ['param_index', 'init_cond_index']
+
+# high/low threshold of 02_process_LHS_simulations and 04_calibrate_model_to_experiments
+STATE_THRESHOLD = 10
+
+
+def state_labels(totals, threshold=STATE_THRESHOLD):
+    """Discrete state of every row of totals (n, 5), e.g. 'high, low, low, high, low'."""
+    high = np.asarray(totals, dtype=float) >= threshold
+    return np.array([', '.join('high' if h else 'low' for h in row) for row in high])
+
+
+def cell_line_states(file_name, cell_lines=None):
+    """Experimental states of every cell line in
+    ap1_singlecell_replicate_avg_frq_states_v2.csv (columns cell_line, state),
+    {cell_line: sorted states} in the format of state_labels.
+
+    cell_lines: keep only these cell lines
+    """
+    data = pd.read_csv(file_name, index_col=0)
+    # as in 04_calibrate_model_to_experiments
+    data['cell_line'] = data['cell_line'].replace({'A375 _x001A_NRAS(Q61K)': 'A375_NRAS(Q61K)'})
+    if cell_lines is not None:
+        data = data[data['cell_line'].isin(cell_lines)]
+    # "('high', 'low', ...)" -> "high, low, ..."
+    data['state'] = data['state'].str.replace(r"[()'\s]", "", regex=True).str.replace(",", ", ", regex=False)
+    return {cell_line: sorted(states.unique()) for cell_line, states in data.groupby('cell_line')['state']}
+
+
+def read_target_states(file_name, cell_lines=None):
+    """Experimental states of ap1_singlecell_replicate_avg_frq_states_v2.csv
+    over all cell lines (or the given ones), in the format of state_labels.
+    """
+    return sorted(set().union(*cell_line_states(file_name, cell_lines).values()))
+
+
+def row_features(chunk):
+    """log10 LHS parameters and initial conditions of the rows of a chunk DataFrame."""
+    return np.log10(chunk.drop(columns=index_columns).to_numpy(float))
+
+
+def solved_rows(base_dir, chunk_file, output_format='csv'):
+    """Rows of a chunk file that have a steady state in the results of
+    base_dir: the chunk columns and the totals as <name>_steady
+    """
+    chunk = read_chunk(chunk_file)
+    if output_format == 'parquet':
+        results = result_store.load_results(os.path.join(base_dir, 'output', 'results.parquet'),
+                                            (chunk['param_index'].min(), chunk['param_index'].max() + 1))
+    else:
+        results = pd.read_csv(os.path.join(base_dir, 'output', f'results_{os.path.basename(chunk_file)}'))
+    results = results.drop_duplicates(index_columns, keep='last').dropna(subset=steady_state_species_names)
+    # the initial conditions of the chunk file have the names of the totals
+    return chunk.merge(results[index_columns + steady_state_species_names], on=index_columns,
+                       suffixes=('', '_steady'))
+
+
+def steady_columns():
+    return [f'{name}_steady' for name in steady_state_species_names]
+
+
+def training_rows(base_dir, output_format='csv'):
+    """Features and state labels of the solved rows of a finished run in base_dir."""
+    features, labels = [], []
+    for chunk_file in list_chunk_files(os.path.join(base_dir, 'input')):
+        rows = solved_rows(base_dir, chunk_file, output_format)
+        features.append(row_features(rows.drop(columns=steady_columns())))
+        labels.append(state_labels(rows[steady_columns()]))
+    return np.concatenate(features), np.concatenate(labels)
+
+
+def train_surrogate(features, labels, max_rows=500000, n_estimators=100, min_samples_leaf=5, test_size=0.1,
+                    seed=0):
+    """Random forest of the state labels, fitted on at most max_rows rows.
+
+    A held-out test_size share of the rows gives the accuracy of the
+    predictions overall and above a few confidence levels, logged to choose
+    --confidence of the screen. Returns the fitted classifier.
+    """
+    rng = np.random.default_rng(seed)
+    if len(labels) > max_rows:
+        rows = rng.choice(len(labels), max_rows, replace=False)
+        features, labels = features[rows], labels[rows]
+    x_train, x_test, y_train, y_test = train_test_split(features, labels, test_size=test_size, random_state=seed)
+    model = RandomForestClassifier(n_estimators=n_estimators, min_samples_leaf=min_samples_leaf, n_jobs=-1,
+                                   random_state=seed)
+    model.fit(x_train, y_train)
+
+    predicted, confidence = predict_states(model, x_test)
+    correct = predicted == y_test
+    logger.info(f"Surrogate: {len(y_train)} training rows, {len(model.classes_)} states, "
+                f"held-out accuracy {correct.mean():.3f}.")
+    for level in [0.8, 0.9, 0.95, 0.99]:
+        sure = confidence >= level
+        if sure.any():
+            logger.info(f"Surrogate: confidence >= {level}: {sure.mean():.3f} of the rows, "
+                        f"accuracy {correct[sure].mean():.3f}.")
+    return model
+
+
+def predict_states(model, features):
+    """Predicted state label and its probability (confidence) for every row."""
+    probabilities = model.predict_proba(features)
+    best = np.argmax(probabilities, axis=-1)
+    return model.classes_[best], probabilities[np.arange(len(best)), best]
+
+
+def target_probability(model, features, target_states):
+    """Predicted probability of every row to end in one of target_states."""
+    targets = np.isin(model.classes_, list(target_states))
+    return model.predict_proba(features)[:, targets].sum(axis=-1)
+
+
+def screen_chunk(model, chunk_file, target_states, confidence=0.95, block_size=200000):
+    """p_target and ruled_out of every param_index of a chunk file."""
+    frames = []
+    for chunk in read_chunk(chunk_file, chunksize=block_size):
+        frames.append(pd.DataFrame({'param_index': chunk['param_index'].to_numpy(),
+                                    'p_target': target_probability(model, row_features(chunk), target_states)}))
+    screen = pd.concat(frames).groupby('param_index', as_index=False)['p_target'].max()
+    screen['ruled_out'] = (screen['p_target'] < 1.0 - confidence).astype(int)
+    return screen
+
+
+def save_surrogate(model_file, model):
+    joblib.dump(model, model_file)
+
+
+def load_surrogate(model_file):
+    return joblib.load(model_file)
+
+
+def screen_file(base_dir, chunk_file):
+    """BASE_DIR/screen/screen_<chunk> of a chunk file."""
+    return os.path.join(base_dir, 'screen', f'screen_{os.path.basename(chunk_file)}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Train the surrogate of the AP-1 steady states, or screen the "
+                                                 "chunk files of a run with it.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    train = commands.add_parser('train', help="fit the surrogate on the results of finished runs")
+    train.add_argument('model_file')
+    train.add_argument('base_dirs', nargs='+', help="BASE_DIR of finished runs (input/ and output/)")
+    train.add_argument('--output-format', choices=['csv', 'parquet'], default='csv')
+    train.add_argument('--max-rows', type=int, default=500000,
+                       help="rows sampled from the results to fit on")
+    screen = commands.add_parser('screen', help="write BASE_DIR/screen/ for run_simulation.py --screen")
+    screen.add_argument('model_file')
+    screen.add_argument('base_dir')
+    screen.add_argument('--target-states', required=True,
+                        help="experimental states csv (columns cell_line, state)")
+    screen.add_argument('--cell-lines', nargs='+', default=None,
+                        help="only the states of these cell lines (default: all)")
+    screen.add_argument('--confidence', type=float, default=0.95,
+                        help="rule out a parameter set when it ends in a target state with probability "
+                             "below 1 - confidence for every initial condition")
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        data = [training_rows(base_dir, args.output_format) for base_dir in args.base_dirs]
+        features = np.concatenate([f for f, _ in data])
+        labels = np.concatenate([l for _, l in data])
+        save_surrogate(args.model_file, train_surrogate(features, labels, args.max_rows))
+        logger.info(f"Saved the surrogate to {args.model_file}.")
+    else:
+        model = load_surrogate(args.model_file)
+        target_states = read_target_states(args.target_states, args.cell_lines)
+        logger.info(f"Screening for {len(target_states)} target states.")
+        unseen = sorted(set(target_states) - set(model.classes_))
+        if unseen:
+            logger.warning(f"The surrogate was not trained on any row in the target states {unseen}; "
+                           f"they get probability 0.")
+        os.makedirs(os.path.join(args.base_dir, 'screen'), exist_ok=True)
+        for chunk_file in list_chunk_files(os.path.join(args.base_dir, 'input')):
+            screen = screen_chunk(model, chunk_file, target_states, args.confidence)
+            screen.to_csv(screen_file(args.base_dir, chunk_file), index=False, float_format='%.4g')
+            logger.info(f"{os.path.basename(chunk_file)}: {screen['ruled_out'].sum()} of {len(screen)} "
+                        f"parameter sets ruled out.")
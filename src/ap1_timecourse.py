@@ -0,0 +1,162 @@
+"""Batched time courses of the native AP-1 model (ap1_native.py).
+
+run_simulation.py --mode timecourse integrates blocks of LHS rows, set up
+like the steady state solves of run_simulation.py (LHS parameters, monomer
+initial conditions, dimers at 0), with the ROS2 integrator of ap1_steadystate.py.
+The *_total concentrations are only recorded at the points of a fixed output
+grid, log-spaced for relaxation kinetics over many time scales or evenly
+spaced (decimated). Every step is shortened to land on the next grid point of
+its lane, so no dense trajectory is kept, and a lane that has reached its
+steady state stops and fills its remaining grid points with it. Memory and
+output per row are set by the grid size, however long the horizon.
+
+Every task of rows is streamed to one Parquet part in long format:
+
+    BASE_DIR/timecourse/<chunk>_<param_start>_<init_cond_start>.parquet
+        param_index int32, init_cond_index int16, t float64,
+        fos, jun, fra1, fra2, jund float64 (NaN after a failed step),
+        status int8 (per row: 1 steady before the end of the grid, 0 still
+            moving, 3 negative, 4 integration failure, 6 budget)
+"""
+import os
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from ap1_steadystate import (ros2_step, is_steady, STATUS_NOT_FOUND, STATUS_FOUND, STATUS_NEGATIVE,
+                             STATUS_INTEGRATION_FAILED, STATUS_TIMEOUT)
+
+steady_state_species_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
+
+TimecourseResult = namedtuple('TimecourseResult', ['t', 'totals', 'status', 'steps'])
+
+
+def output_grid(t_end, n_points, grid='log', t_first=1e-2):
+    """Output times: t = 0 followed by n_points times up to t_end.
+
+    grid: 'log' for log-spaced times from t_first, 'linear' for every
+        t_end / n_points
+    """
+    if grid == 'log':
+        times = np.logspace(np.log10(t_first), np.log10(t_end), n_points)
+    elif grid == 'linear':
+        times = np.linspace(t_end / n_points, t_end, n_points)
+    else:
+        raise ValueError(f"Unknown output grid {grid}.")
+    return np.concatenate([[0.0], times])
+
+
+def integrate_timecourse_batch(model, p, y0, t_grid, rtol=1e-3, atol=1e-3, ss_rtol=1e-6, ss_atol=1e-9, h0=1e-4,
+                               max_steps=100000, negative_tol=1e-6):
+    """Totals of every lane at the times of t_grid (starting at 0).
+
+    Same integrator settings as solve_steadystate_batch; max_steps is the
+    step budget per lane over the whole grid.
+    Returns a TimecourseResult with t_grid, totals (n, len(t_grid), 5), the
+    status per lane (STATUS_FOUND when it settled before the last grid time,
+    STATUS_NOT_FOUND when it was still moving) and the steps per lane.
+    """
+    y = np.array(y0, dtype=float, copy=True)
+    p = np.broadcast_to(np.asarray(p, dtype=float), y.shape[:-1] + (np.shape(p)[-1],))
+    n_lanes, n_species = y.shape
+    eye = np.eye(n_species)
+    n_out = len(t_grid)
+
+    totals = np.full((n_lanes, n_out, len(steady_state_species_names)), np.nan)
+    totals[:, 0] = model.totals(y)
+    status = np.full(n_lanes, STATUS_NOT_FOUND)
+    t = np.zeros(n_lanes)
+    h = np.full(n_lanes, h0, dtype=float)
+    steps = np.zeros(n_lanes, dtype=int)
+    next_out = np.ones(n_lanes, dtype=int)
+    f = model.rhs(y, p)
+
+    active = np.arange(n_lanes) if n_out > 1 else np.empty(0, dtype=int)
+    while active.size:
+        ya, pa, fa = y[active], p[active], f[active]
+        target = t_grid[next_out[active]]
+        to_target = target - t[active]
+        ha = np.minimum(h[active], to_target)
+
+        y_new, f_new, accepted, factor = ros2_step(model, ya, pa, fa, ha, eye, rtol, atol)
+
+        lanes = active[accepted]
+        y[lanes] = y_new[accepted]
+        f[lanes] = f_new[accepted]
+        t[lanes] += ha[accepted]
+        # a step cut short by a grid point does not shrink the next one
+        h[active] = np.where(accepted & (ha < h[active]), np.maximum(h[active], ha * factor), ha * factor)
+        steps[active] += 1
+
+        # steps that were cut to the next grid time land on it exactly
+        hit = accepted & (ha >= to_target)
+        hit_lanes = active[hit]
+        t[hit_lanes] = target[hit]
+        totals[hit_lanes, next_out[hit_lanes]] = model.totals(y[hit_lanes])
+        next_out[hit_lanes] += 1
+
+        done = np.zeros(active.size, dtype=bool)
+        steady = np.zeros(active.size, dtype=bool)
+        steady[accepted] = is_steady(f[lanes], y[lanes], ss_rtol, ss_atol)
+        for lane in active[steady]:
+            totals[lane, next_out[lane]:] = model.totals(y[lane])
+        status[active[steady]] = STATUS_FOUND
+        status[active[steady & np.any(y[active] < -negative_tol, axis=-1)]] = STATUS_NEGATIVE
+        done |= steady
+
+        # lanes at the end of the grid that are still moving
+        done |= next_out[active] >= n_out
+
+        over_budget = ~done & (steps[active] >= max_steps)
+        status[active[over_budget]] = STATUS_TIMEOUT
+        done |= over_budget
+
+        failed = ~done & (h[active] < 1e-14 * np.maximum(1.0, t[active]))
+        status[active[failed]] = STATUS_INTEGRATION_FAILED
+        done |= failed
+
+        active = active[~done]
+
+    return TimecourseResult(t_grid, totals, status, steps)
+
+
+def timecourse_frame(param_index, init_cond_index, result):
+    """Long-format table of a TimecourseResult, one row per lane and grid time."""
+    n_lanes, n_out, n_totals = result.totals.shape
+    data = pd.DataFrame({'param_index': np.repeat(np.asarray(param_index, dtype=np.int32), n_out),
+                         'init_cond_index': np.repeat(np.asarray(init_cond_index, dtype=np.int16), n_out),
+                         't': np.tile(result.t, n_lanes)})
+    totals = result.totals.reshape(n_lanes * n_out, n_totals)
+    for i, name in enumerate(steady_state_species_names):
+        data[name] = totals[:, i]
+    data['status'] = np.repeat(np.asarray(result.status, dtype=np.int8), n_out)
+    return data
+
+
+def part_name(chunk_file, param_start, init_cond_start):
+    """Name of the Parquet part of a task (without extension)."""
+    return f'{os.path.splitext(os.path.basename(chunk_file))[0]}_{param_start}_{init_cond_start}'
+
+
+def write_timecourse(directory, name, param_index, init_cond_index, result):
+    """Write one task of time courses as directory/name.parquet via a hidden temporary file."""
+    os.makedirs(directory, exist_ok=True)
+    tmp_file = os.path.join(directory, f'.{name}.tmp')
+    timecourse_frame(param_index, init_cond_index, result).to_parquet(tmp_file, index=False, compression='zstd')
+    os.replace(tmp_file, os.path.join(directory, f'{name}.parquet'))
+
+
+def load_timecourse(directory, param_range=None, columns=None):
+    """Time courses of a run as one DataFrame, sorted by param_index, init_cond_index and t.
+
+    param_range: (start, stop) to keep only these param_index values; the
+        filter is applied while reading
+    """
+    filters = None
+    if param_range is not None:
+        filters = [('param_index', '>=', param_range[0]), ('param_index', '<', param_range[1])]
+    files = sorted(os.path.join(directory, f) for f in os.listdir(directory)
+                   if f.endswith('.parquet') and not f.startswith('.'))
+    frames = [pd.read_parquet(f, columns=columns, filters=filters) for f in files]
+    data = pd.concat(frames, ignore_index=True)
+    sort_columns = [c for c in ['param_index', 'init_cond_index', 't'] if c in data.columns]
+    return data.sort_values(sort_columns).reset_index(drop=True)
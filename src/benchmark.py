@@ -0,0 +1,232 @@
+"""Throughput benchmark of the simulation backends of run_simulation.py.
+
+The benchmark runs fixed slices of the LHS design, picked with a seed from the
+results of a finished run:
+
+    monostable    parameter sets with one steady state over all their initial conditions
+    multistable   parameter sets with two or more steady states
+    failure       parameter sets with failed rows
+
+make_slices writes every slice once, as a chunk file BENCH_DIR/slices/<slice>.csv.
+Every benchmark reads those files, so the numbers stay comparable when the
+engines change. run_benchmark solves every slice with every backend (copasi,
+native-integration, native-hybrid). It uses the worker functions of
+run_simulation.py (init_worker, solve_block) on a pool of processes and
+reports per slice and backend:
+
+    sims_per_s_per_core   rows / busy time of the workers (no pool start-up or idle time)
+    p50_latency_s         median time per solve: one COPASI row, or a native block
+    p99_latency_s           (solved at once) divided by its rows
+    peak_rss_mb           largest peak resident memory of the driver and the workers
+    failure_rate          share of rows without a steady state
+
+The numbers are written to BENCH_DIR/results/<time>.json. They are compared
+with BENCH_DIR/baselines.json, and a change beyond --tolerance is logged as a
+regression. --save-baseline makes the run the new baseline.
+
+    python benchmark.py make-slices BENCH_DIR FINISHED_BASE_DIR [--n-params 20] [--seed 0]
+    python benchmark.py run BENCH_DIR [--backends ...] [--save-baseline]
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import logging
+import resource
+import subprocess
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import run_simulation
+from pair_design import read_chunk, list_chunk_files
+from run_simulation import (init_worker, load_chunk, take_rows, solve_block, chunk_layout, stored_results,
+                            steady_state_species_names, COPASI_MODEL_FILE)
+
+logger = logging.getLogger(__name__)
+
+slice_names = ['monostable', 'multistable', 'failure']
+# backend: (engine, method) of run_simulation.py
+backends = {'copasi': ('copasi', 'integration'),
+            'native-integration': ('native', 'integration'),
+            'native-hybrid': ('native', 'hybrid')}
+metric_names = ['sims_per_s_per_core', 'p50_latency_s', 'p99_latency_s', 'peak_rss_mb', 'failure_rate']
+
+
+def param_classes(results):
+    """Slice of every param_index of a results DataFrame (NaN totals for failed rows)."""
+    failed = results[steady_state_species_names].isna().any(axis=1)
+    n_failed = failed.groupby(results['param_index']).sum()
+    # distinct steady states, at the rounding of the results
+    solved = results[~failed]
+    n_states = solved.groupby('param_index')[steady_state_species_names].apply(
+        lambda states: len(states.drop_duplicates())).reindex(n_failed.index, fill_value=0)
+    return pd.Series(np.where(n_failed > 0, 'failure', np.where(n_states > 1, 'multistable', 'monostable')),
+                     index=n_failed.index)
+
+
+def make_slices(bench_dir, base_dir, n_params=20, seed=0, output_format='csv'):
+    """Write BENCH_DIR/slices/<slice>.csv: all rows of n_params parameter sets
+    of every slice, drawn with seed from the finished run in base_dir.
+    """
+    rng = np.random.default_rng(seed)
+    chunk_files = list_chunk_files(os.path.join(base_dir, 'input'))
+    classes = pd.concat([param_classes(stored_results(chunk_file, os.path.join(base_dir, 'output'), output_format))
+                         for chunk_file in chunk_files])
+    os.makedirs(os.path.join(bench_dir, 'slices'), exist_ok=True)
+    for name in slice_names:
+        candidates = classes.index[classes == name].to_numpy()
+        if len(candidates) < n_params:
+            logger.warning(f"Slice {name}: only {len(candidates)} parameter sets in {base_dir}.")
+        picked = np.sort(rng.choice(candidates, min(n_params, len(candidates)), replace=False))
+        rows = pd.concat([chunk[chunk['param_index'].isin(picked)] for chunk in map(read_chunk, chunk_files)])
+        rows.to_csv(os.path.join(bench_dir, 'slices', f'{name}.csv'), index=False)
+        logger.info(f"Slice {name}: {len(picked)} parameter sets, {len(rows)} rows.")
+
+
+def bench_task(task, backend):
+    """Solve rows [start, stop) of a slice file in a worker; returns the
+    latency of every row, their return codes, the busy time and the peak RSS
+    of the worker (kB)
+    """
+    slice_file, start, stop = task
+    chunk_block, par_names = load_chunk(slice_file)
+    engine, method = backends[backend]
+    # COPASI solves row by row; the native engine solves the whole block at once
+    solve_size = 1 if engine == 'copasi' else stop - start
+    latencies, status = [], []
+    task_start = time.perf_counter()
+    for first in range(start, stop, solve_size):
+        block = take_rows(chunk_block, np.arange(first, min(first + solve_size, stop)))
+        solve_start = time.perf_counter()
+        output = solve_block(block, par_names, engine, method)
+        n_rows = len(block.param_index)
+        latencies.extend([(time.perf_counter() - solve_start) / n_rows] * n_rows)
+        status.extend(output.status)
+    return latencies, status, time.perf_counter() - task_start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def benchmark_slice(slice_file, backend, processes, task_rows):
+    """Metrics of one slice file solved with one backend."""
+    engine, _ = backends[backend]
+    n_rows = len(pd.read_csv(slice_file, usecols=['param_index']))
+    tasks = [(slice_file, start, min(start + task_rows, n_rows)) for start in range(0, n_rows, task_rows)]
+    initializer = partial(init_worker, COPASI_MODEL_FILE if engine == 'copasi' else None, None)
+    with Pool(processes=processes, initializer=initializer) as pool:
+        outputs = pool.map(partial(bench_task, backend=backend), tasks, chunksize=1)
+    latencies = np.concatenate([output[0] for output in outputs])
+    status = np.concatenate([output[1] for output in outputs])
+    busy_time = sum(output[2] for output in outputs)
+    peak_rss_kb = max([resource.getrusage(resource.RUSAGE_SELF).ru_maxrss] + [output[3] for output in outputs])
+    return {'sims_per_s_per_core': len(status) / busy_time,
+            'p50_latency_s': float(np.percentile(latencies, 50)),
+            'p99_latency_s': float(np.percentile(latencies, 99)),
+            'peak_rss_mb': peak_rss_kb / 1024,
+            'failure_rate': float(np.mean(~np.isin(status, [1, 2]))),
+            'n_rows': int(len(status)), 'task_rows': task_rows}
+
+
+def regressions(metrics, baseline, tolerance=0.1, failure_tolerance=0.01):
+    """Metrics that got worse than the baseline: throughput down or latency and
+    memory up by more than tolerance (relative), failure rate up by more than
+    failure_tolerance (absolute)
+    """
+    worse = []
+    if metrics['sims_per_s_per_core'] < baseline['sims_per_s_per_core'] * (1 - tolerance):
+        worse.append('sims_per_s_per_core')
+    for name in ['p50_latency_s', 'p99_latency_s', 'peak_rss_mb']:
+        if metrics[name] > baseline[name] * (1 + tolerance):
+            worse.append(name)
+    if metrics['failure_rate'] > baseline['failure_rate'] + failure_tolerance:
+        worse.append('failure_rate')
+    return worse
+
+
+def environment():
+    """Machine and code version the numbers were measured with."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'host': platform.node(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def run_benchmark(bench_dir, backend_names, processes, task_rows=None, save_baseline=False, tolerance=0.1):
+    """Benchmark every slice of bench_dir with every backend, write the
+    results and compare them with the baselines. Returns the number of
+    regressions.
+    """
+    baseline_file = os.path.join(bench_dir, 'baselines.json')
+    baselines = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baselines = json.load(f)['metrics']
+
+    metrics = {}
+    n_regressions = 0
+    for name in slice_names:
+        slice_file = os.path.join(bench_dir, 'slices', f'{name}.csv')
+        chunk_layout(slice_file)
+        for backend in backend_names:
+            rows = task_rows or (20 if backends[backend][0] == 'copasi' else 200)
+            result = benchmark_slice(slice_file, backend, processes, rows)
+            metrics.setdefault(name, {})[backend] = result
+            logger.info(f"{name:12s} {backend:18s} " + ", ".join(f"{m} {result[m]:.4g}" for m in metric_names))
+            baseline = baselines.get(name, {}).get(backend)
+            if baseline is None:
+                continue
+            if baseline.get('task_rows') != rows:
+                logger.warning(f"Baseline of {name} / {backend} was measured with {baseline.get('task_rows')} rows "
+                               f"per task, not {rows}; not compared.")
+                continue
+            worse = regressions(result, baseline, tolerance)
+            n_regressions += len(worse)
+            for m in worse:
+                logger.warning(f"Regression in {name} / {backend}: {m} {result[m]:.4g} (baseline {baseline[m]:.4g}).")
+
+    report = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'processes': processes, 'environment': environment(),
+              'metrics': metrics}
+    os.makedirs(os.path.join(bench_dir, 'results'), exist_ok=True)
+    with open(os.path.join(bench_dir, 'results', f"{report['time'].replace(':', '')}.json"), 'w') as f:
+        json.dump(report, f, indent=1)
+    if save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        logger.info(f"Saved the baselines to {baseline_file}.")
+    return n_regressions
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    # the per-block messages of the workers
+    run_simulation.logger.setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description="Throughput benchmark of the simulation backends.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    slices = commands.add_parser('make-slices', help="pick the benchmark slices from a finished run")
+    slices.add_argument('bench_dir')
+    slices.add_argument('base_dir', help="BASE_DIR of a finished run (input/ and output/)")
+    slices.add_argument('--n-params', type=int, default=20, help="parameter sets per slice")
+    slices.add_argument('--seed', type=int, default=0)
+    slices.add_argument('--output-format', choices=['csv', 'parquet'], default='csv')
+    run = commands.add_parser('run', help="benchmark the slices and compare with the baselines")
+    run.add_argument('bench_dir')
+    run.add_argument('--backends', nargs='+', choices=list(backends), default=list(backends))
+    run.add_argument('--processes', type=int, default=int(os.getenv('SLURM_NPROCS', os.cpu_count())))
+    run.add_argument('--task-rows', type=int, default=None,
+                     help="rows per task (default 20 for COPASI, 200 for the native engine)")
+    run.add_argument('--tolerance', type=float, default=0.1,
+                     help="relative change of throughput, latency or memory that counts as a regression")
+    run.add_argument('--save-baseline', action='store_true', help="store this run as the baseline")
+    args = parser.parse_args()
+
+    if args.command == 'make-slices':
+        make_slices(args.bench_dir, args.base_dir, args.n_params, args.seed, args.output_format)
+    else:
+        n_regressions = run_benchmark(args.bench_dir, args.backends, args.processes, args.task_rows,
+                                      args.save_baseline, args.tolerance)
+        logger.info(f"{n_regressions} regressions against the baselines.")
+        sys.exit(1 if n_regressions else 0)
@@ -0,0 +1,166 @@
+"""Durable progress for run_simulation.py and resuming interrupted runs.
+
+The results_<chunk>.csv files are the record of what is done. Every block of
+results is appended with one write and fsync'd before the driver moves on, so
+a (param_index, init_cond_index) pair is committed once its row is in the
+results file. The side files (failed_indices.txt and diagnostics/) are
+written before the results of the block, so on resume any of their rows
+without a committed pair belong to an unfinished block and are dropped.
+
+A job killed in the middle of a write can still leave a torn last line;
+repair_csv cuts it off before the results are read back.
+"""
+import os
+import io
+import csv
+import numpy as np
+import pandas as pd
+
+# (param_index, init_cond_index) -> one int64 key; init_cond_index < 2**20
+IC_KEY_BITS = 20
+
+
+def pair_keys(param_index, init_cond_index):
+    """int64 keys of (param_index, init_cond_index) pairs."""
+    return (np.asarray(param_index, dtype=np.int64) << IC_KEY_BITS) | np.asarray(init_cond_index, dtype=np.int64)
+
+
+def key_param_index(keys):
+    """param_index of pair keys."""
+    return np.asarray(keys, dtype=np.int64) >> IC_KEY_BITS
+
+
+def key_init_cond_index(keys):
+    """init_cond_index of pair keys."""
+    return np.asarray(keys, dtype=np.int64) & ((1 << IC_KEY_BITS) - 1)
+
+
+def csv_text(rows, fieldnames=None):
+    """Rows (dicts if fieldnames is given, else sequences) as csv text."""
+    buffer = io.StringIO()
+    if fieldnames is None:
+        csv.writer(buffer).writerows(rows)
+    else:
+        csv.DictWriter(buffer, fieldnames=fieldnames).writerows(rows)
+    return buffer.getvalue()
+
+
+def append_atomic(file_name, text):
+    """Append text to a file with a single write and fsync it."""
+    data = text.encode()
+    fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_atomic(file_name, text):
+    """Replace a file's content: write a temporary file and rename it."""
+    tmp_file = f'{file_name}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, file_name)
+
+
+def repair_csv(file_name, n_fields):
+    """Cut a torn tail off a csv file written by append_atomic.
+
+    Removes an unterminated last line, and a last line with the wrong number
+    of fields. Returns the number of bytes removed.
+    """
+    if not os.path.exists(file_name):
+        return 0
+    with open(file_name, 'rb') as f:
+        data = f.read()
+    end = len(data)
+    if not data.endswith(b'\n'):
+        end = data.rfind(b'\n') + 1
+    last_start = data.rfind(b'\n', 0, max(end - 1, 0)) + 1
+    if last_start < end and data[last_start:end].count(b',') != n_fields - 1:
+        end = last_start
+    if end < len(data):
+        with open(file_name, 'r+b') as f:
+            f.truncate(end)
+            os.fsync(f.fileno())
+    return len(data) - end
+
+
+def committed_pairs(output_file):
+    """Sorted pair keys of every row in a results file (including 'NA' rows)."""
+    if not os.path.exists(output_file):
+        return np.empty(0, dtype=np.int64)
+    index = pd.read_csv(output_file, usecols=['param_index', 'init_cond_index'], dtype=np.int64)
+    return np.unique(pair_keys(index['param_index'], index['init_cond_index']))
+
+
+def keep_committed_csv(file_name, committed, by_param=False):
+    """Rewrite a csv side file with param_index/init_cond_index columns (or only
+    param_index if by_param), keeping the rows of committed pairs once.
+    Returns the number of rows dropped.
+    """
+    if not os.path.exists(file_name):
+        return 0
+    repair_csv(file_name, len(pd.read_csv(file_name, nrows=0).columns))
+    rows = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+    if by_param:
+        keep = np.isin(rows['param_index'].astype(np.int64), key_param_index(committed))
+    else:
+        keep = np.isin(pair_keys(rows['param_index'].astype(np.int64), rows['init_cond_index'].astype(np.int64)),
+                       committed)
+    kept = rows[keep].drop_duplicates()
+    # same line ends as the csv module writes
+    write_atomic(file_name, kept.to_csv(index=False, lineterminator='\r\n'))
+    return len(rows) - len(kept)
+
+
+def replace_csv_rows(file_name, text):
+    """Replace rows of a results csv file by the rows in text (csv without
+    header, same columns) with the same (param_index, init_cond_index), in
+    place; rows of new pairs are appended. Returns the number of rows replaced.
+    """
+    rows = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+    new_rows = pd.read_csv(io.StringIO(text), header=None, names=rows.columns, dtype=str, keep_default_na=False)
+    keys = pair_keys(rows['param_index'].astype(np.int64), rows['init_cond_index'].astype(np.int64))
+    new_keys = pair_keys(new_rows['param_index'].astype(np.int64), new_rows['init_cond_index'].astype(np.int64))
+    position = dict(zip(keys.tolist(), range(len(rows))))
+    replaced = np.array([key in position for key in new_keys.tolist()], dtype=bool)
+    rows.iloc[[position[key] for key in new_keys[replaced].tolist()]] = new_rows[replaced].to_numpy()
+    rows = pd.concat([rows, new_rows[~replaced]], ignore_index=True)
+    write_atomic(file_name, rows.to_csv(index=False, lineterminator='\r\n'))
+    return int(replaced.sum())
+
+
+def failure_line_key(line):
+    """Pair key of a failed_indices.txt line, None if the line is not complete."""
+    try:
+        head = line.split(':', 1)[0]
+        param_part, init_cond_part = head.split(', ')
+        return int(pair_keys(int(param_part.rsplit(' ', 1)[1]), int(init_cond_part.rsplit(' ', 1)[1])))
+    except (ValueError, IndexError):
+        return None
+
+
+def keep_committed_failures(file_name, committed):
+    """Rewrite failed_indices.txt keeping the complete lines of committed pairs once.
+    Returns the number of lines dropped.
+    """
+    if not os.path.exists(file_name):
+        return 0
+    with open(file_name) as f:
+        lines = f.read().split('\n')
+    committed_set = set(committed.tolist())
+    kept, seen = [], set()
+    # the last element is '' after a complete file, or a torn line
+    for line in lines[:-1]:
+        key = failure_line_key(line)
+        if key in committed_set and line not in seen:
+            seen.add(line)
+            kept.append(line + '\n')
+    write_atomic(file_name, ''.join(kept))
+    return len(lines) - 1 - len(kept) + (1 if lines[-1] else 0)
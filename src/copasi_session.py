@@ -0,0 +1,313 @@
+"""Persistent COPASI session for one simulation worker.
+
+The model is loaded once per worker process (through the Pool initializer in
+run_simulation.py) and every object the simulations touch is resolved once:
+the LHS reaction parameters, the monomer and dimer initial concentrations and
+the *_total readouts. The per-simulation hot path, CopasiSession.solve, then
+only sets values on those handles, runs the steady state task and reads five
+numbers back, without basico's name lookups or get_species() DataFrames.
+
+The budget of a solve (CopasiSession.set_budget) has three parts:
+
+    time_budget   seconds, enforced through the task's process report, which
+                  COPASI asks whether to go on between the stages of its
+                  steady state integration
+    steps         integration steps per DLSODA call: the Max Internal Steps
+                  of the Time-Course method, which the steady state
+                  integration uses; a call over it fails with an MXSTEP error
+    duration      model time of the forward integration (Maximum duration
+                  for forward integration of the steady state method)
+
+A solve over its budget raises SteadyStateError with STATUS_TIMEOUT. A stage
+stuck inside DLSODA cannot be stopped from Python, so WatchedSession runs the
+CopasiSession in a child process and kills and replaces that process when a
+solve runs well past its time budget.
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import subprocess
+from multiprocessing.connection import Connection
+import numpy as np
+import COPASI
+from basico import load_model, set_task_settings, T
+from ap1_native import monomer_names, dimer_names
+from phase_profile import PhaseProfiler
+from ap1_steadystate import (STATUS_NOT_FOUND, STATUS_FOUND, STATUS_EQUILIBRIUM, STATUS_NEGATIVE,
+                             STATUS_INTEGRATION_FAILED, STATUS_UNEXPECTED, STATUS_TIMEOUT)
+
+total_names = [f'{name}_total' for name in monomer_names]
+
+
+class SteadyStateError(Exception):
+    """No usable steady state; status is one of the ap1_steadystate return codes."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class _Deadline(COPASI.CProcessReport):
+    """Process report that tells COPASI to stop once the deadline has passed."""
+
+    def __init__(self):
+        super().__init__()
+        self.deadline = None
+
+    def expired(self):
+        return self.deadline is not None and time.perf_counter() > self.deadline
+
+    def proceed(self):
+        return not self.expired()
+
+    def progressItem(self, handle):
+        return self.proceed()
+
+
+class CopasiSession:
+    """One loaded COPASI model with direct handles to the objects the LHS runs change.
+
+    cps_file: COPASI model file
+    par_names: LHS parameter names ('(reaction).parameter'), can also be set
+        later with use_parameters
+    """
+
+    def __init__(self, cps_file, par_names=None):
+        self.data_model = load_model(cps_file)
+        self.model = self.data_model.getModel()
+        # integration only, as in the original run_simulation.py settings
+        set_task_settings(T.STEADY_STATE, settings={'method': {'Use Newton': False, 'Use Integration': True}},
+                          model=self.data_model)
+        self.task = self.data_model.getTask('Steady-State')
+        self.task.setUpdateModel(False)
+
+        metabolites = {}
+        for i in range(self.model.getNumMetabs()):
+            metab = self.model.getMetabolite(i)
+            metabolites[metab.getObjectName()] = metab
+        self.monomers = [metabolites[name] for name in monomer_names]
+        self.dimers = [metabolites[name] for name in dimer_names]
+        self.totals = [metabolites[name] for name in total_names]
+
+        self.reactions = {}
+        for i in range(self.model.getNumReactions()):
+            reaction = self.model.getReaction(i)
+            self.reactions[reaction.getObjectName()] = reaction
+
+        self._parameter_handles = {}
+        self.parameters = []
+        self._changed = None
+        self._key = None
+        self.status = None
+        # seconds per solve, None for no limit
+        self.time_budget = None
+        self._deadline = _Deadline()
+        self.task.setCallBack(self._deadline)
+        # sampled phase timers of solve (see phase_profile.py), off by default
+        self.profiler = PhaseProfiler()
+        if par_names is not None:
+            self.use_parameters(par_names)
+
+    def set_budget(self, time_budget=None, steps=None, duration=None):
+        """Budget of every solve: seconds, integration steps per DLSODA call
+        and model time of the forward integration; None for no limit (steps,
+        duration: the settings of the model file)
+        """
+        self.time_budget = time_budget
+        if steps is not None:
+            set_task_settings(T.TIME_COURSE, settings={'method': {'Max Internal Steps': int(steps)}},
+                              model=self.data_model)
+        if duration is not None:
+            set_task_settings(T.STEADY_STATE,
+                              settings={'method': {'Maximum duration for forward integration': float(duration)}},
+                              model=self.data_model)
+
+    def _resolve_parameter(self, par_name):
+        """'(basal_fos).v' -> the local parameter v of reaction basal_fos."""
+        reaction_name, parameter_name = par_name[1:].split(').', 1)
+        parameter = self.reactions[reaction_name].getParameters().getParameter(parameter_name)
+        if parameter is None:
+            raise KeyError(f"Reaction {reaction_name} has no local parameter {parameter_name}.")
+        return parameter
+
+    def use_parameters(self, par_names):
+        """Set the parameters that solve() receives, in this order.
+
+        Called once per chunk file with its parameter columns; handles are
+        cached, so calling it for every batch costs nothing.
+        """
+        key = tuple(par_names)
+        if key == self._key:
+            return
+        self._key = key
+        if key not in self._parameter_handles:
+            self._parameter_handles[key] = [self._resolve_parameter(name) for name in par_names]
+        self.parameters = self._parameter_handles[key]
+
+        # every initial value solve() changes, to update dependent values in one call
+        self._changed = COPASI.ObjectStdVector()
+        for parameter in self.parameters:
+            self._changed.push_back(parameter.getValueReference())
+        for metab in self.monomers + self.dimers:
+            self._changed.push_back(metab.getInitialConcentrationReference())
+
+    def solve(self, params, ics):
+        """Steady state *_total concentrations for one row.
+
+        params: values for the parameters given to use_parameters
+        ics: initial concentrations of fos, jun, fra1, fra2, jund; the dimers
+            start at 0
+        Returns an array with fos_total, jun_total, fra1_total, fra2_total,
+        jund_total, and sets self.status to the COPASI return code. Raises
+        SteadyStateError with the failure message and status when no steady
+        state is found (the messages of failed_indices.txt), and with
+        STATUS_TIMEOUT when the solve ran past its time or step budget.
+        """
+        profiler = self.profiler
+        for parameter, value in zip(self.parameters, params):
+            parameter.setDblValue(float(value))
+        profiler.mark('set_parameters')
+        for metab, value in zip(self.monomers, ics):
+            metab.setInitialConcentration(float(value))
+        for metab in self.dimers:
+            metab.setInitialConcentration(0.0)
+        self.model.updateInitialValues(self._changed)
+        profiler.mark('set_species')
+
+        COPASI.CCopasiMessage.clearDeque()
+        self._deadline.deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        ok = self.task.initialize(COPASI.CCopasiTask.OUTPUT_UI) and self.task.process(True)
+        profiler.mark('solve')
+        messages = COPASI.CCopasiMessage.getAllMessageText()
+        profiler.mark('messages')
+        if self._deadline.expired():
+            raise SteadyStateError(f"Steady state calculation stopped at its time budget of {self.time_budget} s.",
+                                   STATUS_TIMEOUT)
+        if not ok and 'MXSTEP' in self.task.getProcessError():
+            raise SteadyStateError("Steady state calculation stopped at its step budget.", STATUS_TIMEOUT)
+        if not ok or "DLSODA" in messages:
+            raise SteadyStateError("Steady state calculation failed due to DLSODA error.",
+                                   STATUS_INTEGRATION_FAILED)
+
+        status = self.task.getResult()
+        if status == STATUS_NOT_FOUND:
+            raise SteadyStateError("Steady state not found.", STATUS_NOT_FOUND)
+        elif status == STATUS_NEGATIVE:
+            raise SteadyStateError("Steady state with negative concentrations found.", STATUS_NEGATIVE)
+        elif status not in [STATUS_FOUND, STATUS_EQUILIBRIUM]:
+            raise SteadyStateError(f"Unexpected return code: {status}", STATUS_UNEXPECTED)
+        self.status = status
+
+        totals = np.array([metab.getConcentration() for metab in self.totals])
+        profiler.mark('readout')
+        return totals
+
+
+class WatchedSession:
+    """CopasiSession in a child process, with a watchdog on every solve.
+
+    A solve that has not returned watchdog_s seconds after it started (stuck
+    inside DLSODA, where the time budget of the process report cannot stop
+    it) gets its process killed and replaced by a new one, and raises
+    SteadyStateError with STATUS_TIMEOUT. Same interface as CopasiSession:
+    use_parameters, solve, status, profiler.
+
+    watchdog_s: default twice the time budget, at least 1 s more
+    """
+
+    def __init__(self, cps_file, time_budget, steps=None, duration=None, watchdog_s=None):
+        self.cps_file = cps_file
+        self.time_budget = time_budget
+        self.budget = (time_budget, steps, duration)
+        self.watchdog_s = watchdog_s or max(2 * time_budget, time_budget + 1.0)
+        self.status = None
+        self.n_killed = 0
+        self.profiler = PhaseProfiler()
+        self._par_names = None
+        self._process = None
+        self._conn = None
+        self._start()
+
+    def _start(self):
+        """Start the child process and wait until it has loaded the model."""
+        parent, child = socket.socketpair()
+        self._process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', str(child.fileno()),
+                                          self.cps_file], pass_fds=[child.fileno()])
+        child.close()
+        self._conn = Connection(parent.detach())
+        self._conn.recv()
+        self._conn.send(('budget', self.budget))
+        if self._par_names is not None:
+            self._conn.send(('use', self._par_names))
+
+    def _restart(self):
+        self._process.kill()
+        self._process.wait()
+        self._conn.close()
+        self._start()
+
+    def use_parameters(self, par_names):
+        par_names = list(par_names)
+        if par_names != self._par_names:
+            self._par_names = par_names
+            self._conn.send(('use', par_names))
+
+    def solve(self, params, ics):
+        """CopasiSession.solve in the child process, within watchdog_s seconds."""
+        try:
+            self._conn.send(('solve', np.asarray(params, dtype=float), np.asarray(ics, dtype=float)))
+            answered = self._conn.poll(self.watchdog_s)
+            reply = self._conn.recv() if answered else None
+        except (EOFError, OSError):
+            self._restart()
+            raise SteadyStateError("The COPASI process stopped during the steady state calculation.",
+                                   STATUS_UNEXPECTED)
+        self.profiler.mark('solve')
+        if reply is None:
+            self.n_killed += 1
+            self._restart()
+            raise SteadyStateError(f"Steady state calculation killed by the watchdog after {self.watchdog_s} s.",
+                                   STATUS_TIMEOUT)
+        kind, value, status = reply
+        if kind == 'error':
+            raise SteadyStateError(value, status)
+        self.status = status
+        return value
+
+    def close(self):
+        self._conn.close()
+        self._process.wait()
+
+
+def serve(fd, cps_file):
+    """Child process of a WatchedSession: solve the rows sent over fd."""
+    conn = Connection(fd)
+    session = CopasiSession(cps_file)
+    conn.send(('ready', None, None))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message[0] == 'budget':
+            session.set_budget(*message[1])
+        elif message[0] == 'use':
+            session.use_parameters(message[1])
+        else:
+            try:
+                totals = session.solve(message[1], message[2])
+                conn.send(('ok', totals, session.status))
+            except SteadyStateError as e:
+                conn.send(('error', str(e), e.status))
+            except Exception as e:
+                conn.send(('error', str(e), STATUS_UNEXPECTED))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="COPASI child process of a WatchedSession.")
+    parser.add_argument('--serve', type=int, required=True, metavar='FD')
+    parser.add_argument('cps_file')
+    args = parser.parse_args()
+    serve(args.serve, args.cps_file)
@@ -0,0 +1,83 @@
+"""Sampled ranges of the AP-1 model parameters and initial conditions.
+
+Used by LHS_params_init_conds.py to generate the LHS design, and by the
+analysis modules that work on the same ranges without re-running it. Every
+entry is (name, (min, mid, max)); the parameter names are the COPASI names
+of the chunk file columns.
+"""
+import numpy as np
+
+param_values = [
+    ('(basal_fos).v', (0.08, 0.8, 80)), # increased range for FOS from 8 to 80
+    ('(basal_jun).v', (0.08, 0.8, 8)),
+    ('(basal_fra1).v', (0.08, 0.8, 8)),
+    ('(basal_fra2).v', (0.08, 0.8, 8)),
+    ('(basal_jund).v', (0.08, 0.8, 8)),
+    ('(jun_by_junjun).beta', (2, 20, 200)),
+    ('(jun_by_junfos).beta', (2, 20, 200)),
+    ('(fra1_by_junfra1).beta', (2, 20, 200)),
+    ('(fra1_by_jundfos).beta', (2, 20, 200)),
+    ('(fra2_by_junfra2).beta', (2, 20, 200)),
+    ('(degradation_fos).k1', (0.426, 0.852, 1.704)),
+    ('(degradation_jun).k1', (0.417, 0.834, 1.668)),
+    ('(degradation_fra1).k1', (0.174, 0.347, 0.694)),
+    ('(degradation_fra2).k1', (0.08, 0.16, 0.32)),
+    ('(degradation_jund).k1', (0.058, 0.116, 0.232))
+]
+
+init_cond_values = [
+    ('fos', (0.316, 10,316.228)), # mid value is 10 taking the geometric mean of 0.316 and 316.228
+    ('jun', (0.316, 10,316.228)),
+    ('fra1', (0.316,10, 316.228)),
+    ('fra2', (0.316,10, 316.228)),
+    ('jund', (0.316,10, 316.228))
+]
+
+param_names = [name for name, _ in param_values]
+
+
+def param_bounds(names=None):
+    """(min, max) of the sampled range of every parameter, as an array (n, 2)."""
+    ranges = dict(param_values)
+    names = param_names if names is None else names
+    return np.array([(ranges[name][0], ranges[name][2]) for name in names], dtype=float)
+
+
+def log10_scaled(value_range, rule='param'):
+    """True if a range is sampled on a log10 scale, False for log2, with the
+    rules of LHS_params_init_conds.py.
+
+    rule: 'param' (100-fold ranges, or 10-fold above the mid value) or
+        'init_cond' (10-fold on both sides of the mid value)
+    """
+    min_val, mid_val, max_val = value_range
+    if rule == 'param':
+        return np.isclose(max_val/mid_val, 10, atol=1e-1) or max_val/min_val > 10
+    return np.isclose(max_val/mid_val, mid_val/min_val, atol=1e-1) and np.isclose(max_val/mid_val, 10, atol=1e-1)
+
+
+def scale_samples(unit_samples, values, rule='param'):
+    """Scale samples in [0, 1], an array (n, len(values)), to the ranges of
+    values (param_values or init_cond_values), log-uniformly.
+    """
+    unit_samples = np.asarray(unit_samples, dtype=float)
+    scaled = np.empty_like(unit_samples)
+    for i, (_, value_range) in enumerate(values):
+        min_val, _, max_val = value_range
+        if log10_scaled(value_range, rule):
+            # If it's 100-fold logarithmic scaling:
+            log_min, log_max = np.log10(min_val), np.log10(max_val)
+            scaled[:, i] = np.power(10, log_min + unit_samples[:, i] * (log_max-log_min))
+        else:
+            # If it's 2-fold difference:
+            log_min, log_max = np.log2(min_val), np.log2(max_val)
+            scaled[:, i] = np.power(2, log_min + unit_samples[:, i] * (log_max-log_min))
+    return scaled
+
+
+def unit_scaled(samples, values):
+    """Inverse of scale_samples: the position of samples (n, len(values)) in
+    [0, 1] on the log scale of their ranges (log10 and log2 give the same).
+    """
+    bounds = np.log10([(value_range[0], value_range[2]) for _, value_range in values])
+    return (np.log10(np.asarray(samples, dtype=float)) - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
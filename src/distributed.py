@@ -0,0 +1,336 @@
+"""Multi-node runs of run_simulation.py through a task ledger on the shared file system.
+
+Every node (a Slurm array task, an srun rank, or a local process started by
+run_simulation.py --local-nodes N) runs the dynamic schedule on its own cores
+and takes its tasks from BASE_DIR/ledger, without a central server:
+
+    ledger/tasks.csv          the task list, written once by the first node
+    ledger/skip/<...>.npy     the skip keys of a task (rows left out on resume
+                              or by the surrogate screen), if it has any
+    ledger/claims/<task_id>   claimed by a node: created with O_EXCL, so one
+                              node wins; touched as a heartbeat while it runs
+    ledger/done/<task_id>     the task's results are written
+
+A node claims a task only when one of its workers is free, so fast nodes take
+more tasks. A claim that has not been touched for lease_timeout seconds (its
+node died or was preempted) is taken over by another node, as is a claim of a
+previous run of the same node id (a requeued array task).
+
+Each node writes into its own directory, BASE_DIR/nodes/<node_id>/, with the
+same output/, diagnostics/ and failure files as a single-node run, so no two
+processes append to one file over the network. When the last task is done,
+one node merges the node directories into BASE_DIR/output, diagnostics/,
+failures.csv and failed_indices.txt, keeping each (param_index,
+init_cond_index) once: a task re-run after a lost claim gives the same rows
+twice.
+"""
+import os
+import time
+import shutil
+import socket
+import threading
+import numpy as np
+import pandas as pd
+import result_store
+from checkpoint import csv_text, write_atomic
+
+task_columns = ['task_id', 'chunk_file', 'param_start', 'param_stop', 'init_cond_start', 'init_cond_stop',
+                'skip_file']
+
+
+def default_node_id():
+    """Node id from Slurm (array task id, then rank), else host name and pid."""
+    for name in ['SLURM_ARRAY_TASK_ID', 'SLURM_PROCID']:
+        if os.getenv(name) is not None:
+            return f'node{os.getenv(name)}'
+    return f'{socket.gethostname()}_{os.getpid()}'
+
+
+def node_dir(BASE_DIR, node_id):
+    return os.path.join(BASE_DIR, 'nodes', str(node_id))
+
+
+class TaskLedger:
+    """Shared list of SimTasks with per-task claim and done files.
+
+    ledger_dir: BASE_DIR/ledger, on a file system all nodes see
+    node_id: name of this node in the claim files
+    lease_timeout: seconds without a heartbeat before a claim is taken over;
+        well above the time between heartbeats (lease_timeout / 4) and any
+        clock difference between the nodes
+    """
+
+    def __init__(self, ledger_dir, node_id, lease_timeout=900.0):
+        self.ledger_dir = ledger_dir
+        self.tasks_file = os.path.join(ledger_dir, 'tasks.csv')
+        self.claims_dir = os.path.join(ledger_dir, 'claims')
+        self.done_dir = os.path.join(ledger_dir, 'done')
+        self.node_id = str(node_id)
+        self.owner = f'{self.node_id} {socket.gethostname()} {os.getpid()}'
+        self.lease_timeout = lease_timeout
+        self.tasks = None
+        self.skip_files = None
+        self.held = {}  # task_id: claim file
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+        os.makedirs(self.claims_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+
+    def publish(self, tasks, INPUT_DIR, task_type):
+        """Write the task list if no node has yet, then read the ledger's list.
+
+        tasks: SimTasks of this node's make_tasks; the ones in the ledger win,
+            so all nodes (and reruns) use the same task ids
+        task_type: the SimTask namedtuple
+        Returns the ledger's SimTasks, with chunk files in INPUT_DIR; their
+        skip keys are read when a task is claimed.
+        """
+        # skip keys go to a directory of this publisher, written before the
+        # list is linked, so the list that wins only refers to complete files
+        skip_dir = os.path.join('skip', f'{self.node_id}_{os.getpid()}')
+        rows = []
+        for task_id, task in enumerate(tasks):
+            skip_file = ''
+            if len(task.skip):
+                skip_file = os.path.join(skip_dir, f'{task_id}.npy')
+                os.makedirs(os.path.join(self.ledger_dir, skip_dir), exist_ok=True)
+                np.save(os.path.join(self.ledger_dir, skip_file), np.asarray(task.skip, dtype=np.int64))
+            rows.append([task_id, os.path.basename(task.chunk_file), task.param_start, task.param_stop,
+                         task.init_cond_start, task.init_cond_stop, skip_file])
+        tmp_file = f'{self.tasks_file}.{self.node_id}.{os.getpid()}.tmp'
+        write_atomic(tmp_file, csv_text([task_columns] + rows))
+        try:
+            # link fails if the file exists: the first node's list is kept
+            os.link(tmp_file, self.tasks_file)
+        except FileExistsError:
+            shutil.rmtree(os.path.join(self.ledger_dir, skip_dir), ignore_errors=True)
+        finally:
+            os.remove(tmp_file)
+
+        table = pd.read_csv(self.tasks_file, keep_default_na=False)
+        self.tasks = [task_type(os.path.join(INPUT_DIR, row.chunk_file), int(row.param_start), int(row.param_stop),
+                                int(row.init_cond_start), int(row.init_cond_stop))
+                      for row in table.itertuples()]
+        self.skip_files = table['skip_file'].tolist() if 'skip_file' in table.columns else [''] * len(self.tasks)
+        return self.tasks
+
+    def _task(self, task_id):
+        """SimTask of a task_id with its skip keys."""
+        task = self.tasks[task_id]
+        if self.skip_files[task_id]:
+            skip = np.load(os.path.join(self.ledger_dir, self.skip_files[task_id]))
+            task = task._replace(skip=tuple(skip.tolist()))
+        return task
+
+    def _claim_file(self, task_id):
+        return os.path.join(self.claims_dir, str(task_id))
+
+    def _done_file(self, task_id):
+        return os.path.join(self.done_dir, str(task_id))
+
+    def _try_claim(self, task_id):
+        try:
+            fd = os.open(self._claim_file(task_id), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        os.write(fd, self.owner.encode())
+        os.close(fd)
+        with self._lock:
+            self.held[task_id] = self._claim_file(task_id)
+        return True
+
+    def _is_stale(self, task_id, claim_file=None):
+        """True if the claim of task_id (read from claim_file, by default its
+        claim file) is past its lease or from an earlier run of this node id.
+        """
+        claim_file = claim_file or self._claim_file(task_id)
+        try:
+            age = time.time() - os.stat(claim_file).st_mtime
+            with open(claim_file) as f:
+                owner = f.read()
+        except FileNotFoundError:
+            return False
+        # an earlier process with this node id (e.g. a requeued array task)
+        previous_run = owner.split(' ', 1)[0] == self.node_id and owner != self.owner
+        return age > self.lease_timeout or previous_run
+
+    def _take_over(self, task_id):
+        """Claim a task whose claim is stale; one node wins the rename.
+
+        Another node may have taken the task over between the staleness check
+        and the rename, so the renamed claim is checked again: a live one is
+        linked back in place and the task is left to its node.
+        """
+        claim_file = self._claim_file(task_id)
+        stale_file = f'{claim_file}.{self.node_id}.{os.getpid()}.stale'
+        try:
+            os.rename(claim_file, stale_file)
+        except FileNotFoundError:
+            return False
+        if not self._is_stale(task_id, stale_file):
+            try:
+                os.link(stale_file, claim_file)
+            except FileExistsError:
+                pass
+            os.remove(stale_file)
+            return False
+        os.remove(stale_file)
+        return self._try_claim(task_id)
+
+    def claim(self):
+        """Claim the next open task, or take over a stale one. Returns
+        (task_id, task) or None; tasks with equal fields keep their own ids.
+        """
+        while self._cursor < len(self.tasks):
+            task_id = self._cursor
+            self._cursor += 1
+            if not os.path.exists(self._done_file(task_id)) and self._try_claim(task_id):
+                return task_id, self._task(task_id)
+        # every task has been claimed once: look for claims of dead nodes
+        done = set(os.listdir(self.done_dir))
+        for task_id in range(len(self.tasks)):
+            if str(task_id) in done or task_id in self.held:
+                continue
+            if self._is_stale(task_id) and self._take_over(task_id):
+                return task_id, self._task(task_id)
+        return None
+
+    def claims(self):
+        """Generator of claimed (task_id, task), read one per free worker by scheduler.run_dynamic."""
+        while True:
+            claimed = self.claim()
+            if claimed is None:
+                return
+            yield claimed
+
+    def complete(self, task_id):
+        """Mark a task done, after its results are written."""
+        with open(self._done_file(task_id), 'w') as f:
+            f.write(self.owner)
+        with self._lock:
+            claim_file = self.held.pop(task_id, None)
+        try:
+            os.remove(claim_file)
+        except (TypeError, FileNotFoundError):
+            pass
+
+    def n_done(self):
+        return len([f for f in os.listdir(self.done_dir) if f.isdigit()])
+
+    def all_done(self):
+        return self.n_done() >= len(self.tasks)
+
+    def _beat(self):
+        while not self._stop.wait(self.lease_timeout / 4):
+            with self._lock:
+                claim_files = list(self.held.items())
+            for task_id, claim_file in claim_files:
+                try:
+                    os.utime(claim_file)
+                except FileNotFoundError:
+                    # taken over by another node; our result is still written
+                    pass
+
+    def start_heartbeat(self):
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._stop.set()
+            self._heartbeat.join()
+            self._heartbeat = None
+
+    def try_lock(self, name):
+        """Create ledger/<name>.lock if it does not exist; True for the one node that does."""
+        try:
+            fd = os.open(os.path.join(self.ledger_dir, f'{name}.lock'), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return False
+        os.write(fd, self.owner.encode())
+        os.close(fd)
+        return True
+
+    def unlock(self, name):
+        os.remove(os.path.join(self.ledger_dir, f'{name}.lock'))
+
+
+def _merge_csv(files, output_file):
+    """Concatenate csv files with a param_index (and init_cond_index) column,
+    keeping each index (pair) once, sorted by index, with the csv module's line ends
+    """
+    frames = [pd.read_csv(f, dtype=str, keep_default_na=False) for f in files]
+    rows = pd.concat(frames, ignore_index=True)
+    key_columns = [c for c in ['param_index', 'init_cond_index'] if c in rows.columns]
+    rows = rows.drop_duplicates(key_columns, keep='last')
+    order = np.lexsort([rows[c].astype(np.int64).to_numpy() for c in key_columns[::-1]])
+    write_atomic(output_file, rows.iloc[order].to_csv(index=False, lineterminator='\r\n'))
+    return len(rows)
+
+
+def merge_node_outputs(BASE_DIR, repair=None):
+    """Merge BASE_DIR/nodes/*/ into the single-node layout of BASE_DIR.
+
+    repair: called with each node directory before it is merged, to make the
+        files of a node that was stopped mid-write consistent (torn last
+        lines, failures of uncommitted rows), as on resume
+
+    results_<chunk>.csv and the param_index-keyed diagnostics files are
+    rebuilt from all nodes (so merging again is harmless); Parquet parts are
+    moved into output/results.parquet and compacted. Other node files (logs,
+    worker_utilization.csv) stay in the node directories.
+    Returns {merged file: number of rows}.
+    """
+    nodes_dir = os.path.join(BASE_DIR, 'nodes')
+    node_dirs = sorted(os.path.join(nodes_dir, d) for d in os.listdir(nodes_dir)
+                       if os.path.isdir(os.path.join(nodes_dir, d)))
+    merged = {}
+    if repair is not None:
+        for directory in node_dirs:
+            repair(directory)
+
+    for subdir in ['output', 'diagnostics', '']:
+        by_name = {}
+        for directory in node_dirs:
+            path = os.path.join(directory, subdir)
+            if not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if name.endswith('.csv') and os.path.isfile(os.path.join(path, name)):
+                    by_name.setdefault(name, []).append(os.path.join(path, name))
+        os.makedirs(os.path.join(BASE_DIR, subdir), exist_ok=True)
+        for name, files in sorted(by_name.items()):
+            if 'param_index' not in pd.read_csv(files[0], nrows=0).columns:
+                continue
+            output_file = os.path.join(BASE_DIR, subdir, name)
+            merged[output_file] = _merge_csv(files, output_file)
+
+    lines = []
+    for directory in node_dirs:
+        failed_file = os.path.join(directory, 'failed_indices.txt')
+        if os.path.exists(failed_file):
+            with open(failed_file) as f:
+                lines.extend(line for line in f.read().split('\n') if line)
+    if lines:
+        output_file = os.path.join(BASE_DIR, 'failed_indices.txt')
+        lines = list(dict.fromkeys(lines))
+        write_atomic(output_file, ''.join(f'{line}\n' for line in lines))
+        merged[output_file] = len(lines)
+
+    dataset_dir = os.path.join(BASE_DIR, 'output', 'results.parquet')
+    moved = 0
+    for directory in node_dirs:
+        node_name = os.path.basename(directory)
+        for partition, part_list in result_store.part_files(os.path.join(directory, 'output', 'results.parquet')).items():
+            target_dir = os.path.join(dataset_dir, os.path.basename(partition))
+            os.makedirs(target_dir, exist_ok=True)
+            for part in part_list:
+                os.replace(part, os.path.join(target_dir, f'{node_name}_{os.path.basename(part)}'))
+                moved += 1
+    if moved or os.path.isdir(dataset_dir):
+        result_store.compact_results(dataset_dir)
+        merged[dataset_dir] = moved
+    return merged
@@ -0,0 +1,165 @@
+"""Failure table of run_simulation.py, written by a single process.
+
+Failed rows are sent to one FailureWriter in the driver process: directly
+with --schedule dynamic, where the driver writes all output, and through a
+queue with --schedule chunks. There a worker's FailureSender waits until the
+writer has written its failures, so they are on disk before the worker
+commits the results of the block (see checkpoint.py). The writer appends them to BASE_DIR/failures.csv,
+one row per failure:
+
+    param_index, init_cond_index, failure_class, status, message,
+    integration_steps, newton_iterations, elapsed_s
+
+failure_class is derived from the status (ap1_steadystate.py return codes).
+Solver statistics are -1 where the engine does not report them (COPASI).
+elapsed_s is the solve time of the row for COPASI, and of the whole block
+the row was solved in for the native engine.
+
+failed_indices.txt is still written by the same writer, in its old format,
+for 02_process_LHS_simulations.
+"""
+import os
+import threading
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from ap1_steadystate import (STATUS_NOT_FOUND, STATUS_NEGATIVE, STATUS_INTEGRATION_FAILED, STATUS_UNEXPECTED,
+                             STATUS_TIMEOUT)
+from checkpoint import csv_text, append_atomic, write_atomic, pair_keys, failure_line_key
+
+Failure = namedtuple('Failure', ['param_index', 'init_cond_index', 'status', 'message',
+                                 'integration_steps', 'newton_iterations', 'elapsed_s'])
+
+failure_classes = {
+    STATUS_NOT_FOUND: 'no_steady_state',
+    STATUS_NEGATIVE: 'negative_concentrations',
+    STATUS_INTEGRATION_FAILED: 'integration_error',  # DLSODA error for COPASI
+    STATUS_UNEXPECTED: 'unexpected_code',
+    STATUS_TIMEOUT: 'timeout',
+}
+
+failure_headers = ['param_index', 'init_cond_index', 'failure_class', 'status', 'message',
+                   'integration_steps', 'newton_iterations', 'elapsed_s']
+failure_dtypes = {'param_index': 'int32', 'init_cond_index': 'int16', 'failure_class': 'category',
+                  'status': 'int8', 'message': 'string', 'integration_steps': 'int32',
+                  'newton_iterations': 'int32', 'elapsed_s': 'float64'}
+
+
+class FailureWriter:
+    """The one writer of failures.csv and failed_indices.txt.
+
+    BASE_DIR: run directory
+    failure_queue: queue the pool workers put (list of Failure, sender
+        number) on, see FailureSender; start() runs a thread that writes them until
+        close()
+    """
+
+    def __init__(self, BASE_DIR, failure_queue=None):
+        self.failure_file = os.path.join(BASE_DIR, 'failures.csv')
+        self.failed_indices_file = os.path.join(BASE_DIR, 'failed_indices.txt')
+        self.failure_queue = failure_queue
+        self.counts = {}
+        self.ack_queues = []
+        self._thread = None
+
+    def put(self, failures):
+        """Write a list of Failure records."""
+        if not failures:
+            return
+        rows = []
+        for failure in failures:
+            failure_class = failure_classes.get(failure.status, 'unexpected_code')
+            self.counts[failure_class] = self.counts.get(failure_class, 0) + 1
+            rows.append([failure.param_index, failure.init_cond_index, failure_class, failure.status,
+                         failure.message, failure.integration_steps, failure.newton_iterations,
+                         round(failure.elapsed_s, 4)])
+        text = csv_text(rows)
+        if not os.path.exists(self.failure_file):
+            text = csv_text([failure_headers]) + text
+        append_atomic(self.failure_file, text)
+        append_atomic(self.failed_indices_file, ''.join(
+            f"Failed for param_index {failure.param_index}, init_cond_index {failure.init_cond_index}: "
+            f"{failure.message}\n" for failure in failures))
+
+    def sender(self, ack_queue):
+        """FailureSender to this writer for one worker at a time, acknowledged
+        on ack_queue."""
+        self.ack_queues.append(ack_queue)
+        return FailureSender(self.failure_queue, ack_queue, len(self.ack_queues) - 1)
+
+    def _drain(self):
+        while True:
+            item = self.failure_queue.get()
+            if item is None:
+                break
+            failures, sender = item
+            try:
+                self.put(failures)
+                self.ack_queues[sender].put(None)
+            except Exception as e:
+                self.ack_queues[sender].put(f"{type(e).__name__}: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Write what is still queued and stop the writer thread."""
+        if self._thread is not None:
+            self.failure_queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+
+class FailureSender:
+    """Worker side of a FailureWriter with a queue: put() returns once the
+    writer has written the failures.
+
+    failure_queue: the writer's queue
+    ack_queue: queue the writer acknowledges on, used by one worker at a time
+    sender: number of the sender at the writer
+    """
+
+    def __init__(self, failure_queue, ack_queue, sender):
+        self.failure_queue = failure_queue
+        self.ack_queue = ack_queue
+        self.sender = sender
+
+    def put(self, failures):
+        """Send a list of Failure records and wait until they are written."""
+        if not failures:
+            return
+        self.failure_queue.put((failures, self.sender))
+        error = self.ack_queue.get()
+        if error is not None:
+            raise OSError(f"Failures were not written: {error}")
+
+
+def load_failures(BASE_DIR):
+    """failures.csv of a run as a typed DataFrame."""
+    return pd.read_csv(os.path.join(BASE_DIR, 'failures.csv'), dtype=failure_dtypes, keep_default_na=False)
+
+
+def drop_failures(BASE_DIR, keys):
+    """Remove the failures of these pair keys (e.g. rows that are solved again)
+    from failures.csv and failed_indices.txt. Returns the number of rows removed.
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    failure_file = os.path.join(BASE_DIR, 'failures.csv')
+    dropped = 0
+    if os.path.exists(failure_file):
+        rows = pd.read_csv(failure_file, dtype=str, keep_default_na=False)
+        drop = np.isin(pair_keys(rows['param_index'].astype(np.int64), rows['init_cond_index'].astype(np.int64)),
+                       keys)
+        write_atomic(failure_file, rows[~drop].to_csv(index=False, lineterminator='\r\n'))
+        dropped = int(drop.sum())
+
+    failed_indices_file = os.path.join(BASE_DIR, 'failed_indices.txt')
+    if os.path.exists(failed_indices_file):
+        key_set = set(keys.tolist())
+        with open(failed_indices_file) as f:
+            lines = f.read().split('\n')
+        write_atomic(failed_indices_file, ''.join(f'{line}\n' for line in lines[:-1]
+                                                  if failure_line_key(line) not in key_set))
+    return dropped
@@ -0,0 +1,314 @@
+"""Index-pair design of the LHS runs, instead of wide chunk CSVs.
+
+LHS_params_init_conds.py writes the design as two small tables and the
+pairs to run:
+
+    input/params.csv       param_index and the 15 LHS parameters, one row per parameter set
+    input/init_conds.csv   init_cond_index and the 5 initial conditions
+    input/design.json      {"chunks": {name: [param_start, param_stop, init_cond_start, init_cond_stop]}}:
+                           every chunk is the cross product of its half-open index ranges
+
+The chunk names (chunk_<i>_LHS_samples_<n>.csv) stay the identity of the
+chunks, in results_<chunk>, diagnostics/<...>_<chunk> and the task ledger, so
+the drivers keep passing input/<chunk> paths around. read_chunk generates the
+rows of such a path from the two tables on demand, in the column layout of
+the wide chunk CSVs (param_index, init_cond_index, parameters, initial
+conditions), and reads real chunk CSVs as before.
+
+extend_design grows a design with the points of a scrambled Sobol or Halton
+sequence instead of a new LHS. New parameter sets get the next param_index
+values, so the existing ones (and their results) stay, and they come in new
+chunks that run_simulation.py --resume runs alone. design.json keeps the
+sequence in "sampler": {"method", "seed", "n"} (points drawn so far), and
+the next extension fast-forwards past them. append_params adds any other
+parameter sets the same way (ap1_adaptive.py). The points are scaled with the log10/log2 rules of
+LHS_params_init_conds.py and appended to params.csv in blocks, so 10^6+
+parameter sets never sit in memory at once.
+
+    python pair_design.py expand INPUT_DIR OUTPUT_DIR
+    python pair_design.py extend INPUT_DIR N [--method sobol] [--seed 0] [--chunk-params 200]
+"""
+import os
+import json
+import logging
+import warnings
+import argparse
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+from design_space import param_values, init_cond_values, scale_samples
+
+logger = logging.getLogger(__name__)
+
+DESIGN_FILE = 'design.json'
+PARAMS_FILE = 'params.csv'
+INIT_CONDS_FILE = 'init_conds.csv'
+
+# loaded designs, per input directory
+_designs = {}
+
+
+def write_design(input_dir, paramset_df, init_cond_df, chunks):
+    """Write the two tables and the chunks of a design to input_dir.
+
+    paramset_df: param_index and parameter columns
+    init_cond_df: init_cond_index and initial condition columns
+    chunks: {name: (param_start, param_stop, init_cond_start, init_cond_stop)}
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    paramset_df.to_csv(os.path.join(input_dir, PARAMS_FILE), index=False)
+    init_cond_df.to_csv(os.path.join(input_dir, INIT_CONDS_FILE), index=False)
+    with open(os.path.join(input_dir, DESIGN_FILE), 'w') as f:
+        json.dump({'chunks': {name: [int(i) for i in ranges] for name, ranges in chunks.items()}}, f, indent=1)
+
+
+def load_design(input_dir):
+    """(chunks, params, init_conds) of the design in input_dir, cached per process."""
+    input_dir = os.path.abspath(input_dir)
+    if input_dir not in _designs:
+        with open(os.path.join(input_dir, DESIGN_FILE)) as f:
+            chunks = {name: tuple(ranges) for name, ranges in json.load(f)['chunks'].items()}
+        params = pd.read_csv(os.path.join(input_dir, PARAMS_FILE)).sort_values('param_index')
+        init_conds = pd.read_csv(os.path.join(input_dir, INIT_CONDS_FILE)).sort_values('init_cond_index')
+        _designs[input_dir] = (chunks, params.reset_index(drop=True), init_conds.reset_index(drop=True))
+    return _designs[input_dir]
+
+
+def list_chunk_files(input_dir):
+    """Chunk files of input_dir: the chunks of its design.json, or its chunk_* CSVs."""
+    if os.path.exists(os.path.join(input_dir, DESIGN_FILE)):
+        chunks, _, _ = load_design(input_dir)
+        return [os.path.join(input_dir, name) for name in sorted(chunks)]
+    return sorted(os.path.join(input_dir, f) for f in os.listdir(input_dir) if f.startswith('chunk_'))
+
+
+def is_design_chunk(chunk_file):
+    """True if chunk_file is a chunk of a design.json rather than a CSV file."""
+    return (not os.path.exists(chunk_file)
+            and os.path.exists(os.path.join(os.path.dirname(chunk_file), DESIGN_FILE)))
+
+
+def chunk_pairs(chunk_file):
+    """param_index and init_cond_index arrays of the rows of a design chunk, in file order."""
+    chunks, params, init_conds = load_design(os.path.dirname(chunk_file))
+    param_start, param_stop, init_cond_start, init_cond_stop = chunks[os.path.basename(chunk_file)]
+    param_index = params['param_index'].to_numpy(np.int64)
+    param_index = param_index[(param_index >= param_start) & (param_index < param_stop)]
+    init_cond_index = init_conds['init_cond_index'].to_numpy(np.int64)
+    init_cond_index = init_cond_index[(init_cond_index >= init_cond_start) & (init_cond_index < init_cond_stop)]
+    return np.repeat(param_index, len(init_cond_index)), np.tile(init_cond_index, len(param_index))
+
+
+def _chunk_frame(chunk_file, param_index, init_cond_index, columns):
+    """Rows of the given pairs with the requested columns of the wide layout."""
+    _, params, init_conds = load_design(os.path.dirname(chunk_file))
+    data = {'param_index': param_index, 'init_cond_index': init_cond_index}
+    param_rows = np.searchsorted(params['param_index'].to_numpy(), param_index)
+    init_cond_rows = np.searchsorted(init_conds['init_cond_index'].to_numpy(), init_cond_index)
+    for column in columns:
+        if column in data:
+            continue
+        if column in params.columns:
+            data[column] = params[column].to_numpy()[param_rows]
+        else:
+            data[column] = init_conds[column].to_numpy()[init_cond_rows]
+    return pd.DataFrame({column: data[column] for column in columns})
+
+
+def chunk_columns(chunk_file):
+    """Columns of a chunk in the wide layout."""
+    _, params, init_conds = load_design(os.path.dirname(chunk_file))
+    return ['param_index', 'init_cond_index'] + params.columns.drop('param_index').tolist() + \
+        init_conds.columns.drop('init_cond_index').tolist()
+
+
+def read_chunk(chunk_file, usecols=None, dtype=None, chunksize=None, nrows=None):
+    """Rows of a chunk as pd.read_csv(chunk_file, ...) returns them, for a
+    chunk CSV or a design chunk (generated from the tables).
+
+    usecols, dtype, nrows: as in pd.read_csv (dtype a single type)
+    chunksize: iterate over DataFrames of chunksize rows
+    """
+    if not is_design_chunk(chunk_file):
+        return pd.read_csv(chunk_file, usecols=usecols, dtype=dtype, chunksize=chunksize, nrows=nrows)
+    columns = chunk_columns(chunk_file)
+    if usecols is not None:
+        columns = [column for column in columns if column in usecols]
+    param_index, init_cond_index = chunk_pairs(chunk_file)
+    if nrows is not None:
+        param_index, init_cond_index = param_index[:nrows], init_cond_index[:nrows]
+
+    def frame(rows):
+        data = _chunk_frame(chunk_file, param_index[rows], init_cond_index[rows], columns)
+        return data if dtype is None else data.astype(dtype)
+
+    if chunksize is None:
+        return frame(slice(None))
+    return (frame(slice(start, start + chunksize)) for start in range(0, len(param_index), chunksize))
+
+
+def expand_chunks(input_dir, output_dir):
+    """Write every design chunk of input_dir as a wide chunk CSV to output_dir,
+    for tools that need the old files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for chunk_file in list_chunk_files(input_dir):
+        read_chunk(chunk_file).to_csv(os.path.join(output_dir, os.path.basename(chunk_file)), index=False)
+
+
+def unit_samples(method, dimension, seed, first, n, block_size=65536):
+    """Points first .. first + n - 1 of a scrambled Sobol or Halton sequence
+    in [0, 1)^dimension, in blocks of at most block_size points.
+    """
+    engine = (qmc.Sobol if method == 'sobol' else qmc.Halton)(dimension, scramble=True, seed=seed)
+    if first:
+        engine.fast_forward(first)
+    with warnings.catch_warnings():
+        # the balance warning of Sobol blocks that are not a power of 2
+        warnings.simplefilter('ignore', UserWarning)
+        for start in range(0, n, block_size):
+            yield engine.random(min(block_size, n - start))
+
+
+def _read_design_file(input_dir):
+    design_file = os.path.join(input_dir, DESIGN_FILE)
+    if not os.path.exists(design_file):
+        return {'chunks': {}}
+    with open(design_file) as f:
+        return json.load(f)
+
+
+def design_sampler(input_dir):
+    """The sampler entry of design.json ({'method', 'seed', 'n'}), or None."""
+    return _read_design_file(input_dir).get('sampler')
+
+
+def _write_design_file(input_dir, design):
+    """Replace design.json via a hidden temporary file and drop the cached design."""
+    tmp_file = os.path.join(input_dir, f'.{DESIGN_FILE}.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(design, f, indent=1)
+    os.replace(tmp_file, os.path.join(input_dir, DESIGN_FILE))
+    _designs.pop(os.path.abspath(input_dir), None)
+
+
+def _check_design_dir(input_dir):
+    """Raise ValueError for a directory of chunk CSVs without a design.json:
+    new param_index values would repeat theirs, and the design would hide them
+    from list_chunk_files.
+    """
+    if os.path.isdir(input_dir) and not os.path.exists(os.path.join(input_dir, DESIGN_FILE)) \
+            and any(f.startswith('chunk_') for f in os.listdir(input_dir)):
+        raise ValueError(f"{input_dir} has chunk CSVs but no {DESIGN_FILE}; put the new design in another "
+                         f"directory.")
+
+
+def append_params(input_dir, blocks, chunk_name, chunk_params=200, sampler=None):
+    """Append parameter sets to the design in input_dir, with the next
+    param_index values, in new chunks of chunk_params parameter sets with all
+    initial conditions. Returns the names of the new chunks.
+
+    blocks: iterable of DataFrames with the parameter columns (param_values order)
+    chunk_name: name of a new chunk, with {i} for its number, e.g. 'chunk_{i}_sobol_samples.csv'
+    sampler: new "sampler" entry of design.json (None keeps it)
+
+    design.json marks the append as pending (with the size params.csv had
+    before it) until the new chunks are in, so the rows of an interrupted
+    append are cut off by the next one. A directory of chunk CSVs without a
+    design.json raises ValueError.
+    """
+    _check_design_dir(input_dir)
+    params_file = os.path.join(input_dir, PARAMS_FILE)
+    design = _read_design_file(input_dir)
+    if 'pending' in design and os.path.exists(params_file):
+        with open(params_file, 'r+b') as f:
+            f.truncate(design['pending'])
+    n_rows = len(pd.read_csv(params_file, usecols=['param_index'])) if os.path.exists(params_file) else 0
+    design['pending'] = os.path.getsize(params_file) if os.path.exists(params_file) else 0
+    _write_design_file(input_dir, design)
+
+    param_index = n_rows
+    with open(params_file, 'a') as f:
+        for block in blocks:
+            block = block.reset_index(drop=True)
+            block.insert(0, 'param_index', np.arange(param_index, param_index + len(block), dtype=np.int64))
+            block.to_csv(f, header=f.tell() == 0, index=False)
+            param_index += len(block)
+        f.flush()
+        os.fsync(f.fileno())
+
+    n_init = len(pd.read_csv(os.path.join(input_dir, INIT_CONDS_FILE), usecols=['init_cond_index']))
+    new_chunks = []
+    for start in range(n_rows, param_index, chunk_params):
+        name = chunk_name.format(i=len(design['chunks']))
+        design['chunks'][name] = [start, min(start + chunk_params, param_index), 0, n_init]
+        new_chunks.append(name)
+    del design['pending']
+    if sampler is not None:
+        design['sampler'] = sampler
+    _write_design_file(input_dir, design)
+    logger.info(f"Added param_index {n_rows} to {param_index - 1} x {n_init} initial conditions to {input_dir} "
+                f"in {len(new_chunks)} chunks, {len(design['chunks'])} in the design.")
+    return new_chunks
+
+
+def extend_design(input_dir, n_new, method='sobol', seed=0, chunk_params=200, n_init_conds=None,
+                  block_size=65536):
+    """Append the next n_new points of a Sobol or Halton sequence to the design
+    in input_dir, in new chunks of chunk_params parameter sets with all
+    initial conditions. Returns the names of the new chunks.
+
+    A directory without a design gets a new one; its initial conditions are
+    n_init_conds points of the same method (seed + 1), unless init_conds.csv
+    exists. An interrupted extension is redone by calling again with the same
+    arguments. A directory of chunk CSVs without a design.json raises
+    ValueError.
+    """
+    if method not in ('sobol', 'halton'):
+        raise ValueError(f"Unknown sampler method {method}.")
+    _check_design_dir(input_dir)
+    os.makedirs(input_dir, exist_ok=True)
+    init_conds_file = os.path.join(input_dir, INIT_CONDS_FILE)
+    if not os.path.exists(init_conds_file):
+        if n_init_conds is None:
+            raise ValueError(f"{input_dir} has no {INIT_CONDS_FILE}; a new design needs n_init_conds.")
+        unit = next(unit_samples(method, len(init_cond_values), seed + 1, 0, n_init_conds, n_init_conds))
+        init_cond_df = pd.DataFrame(scale_samples(unit, init_cond_values, 'init_cond'),
+                                    columns=[name for name, _ in init_cond_values])
+        init_cond_df.insert(0, 'init_cond_index', np.arange(n_init_conds, dtype=np.int64))
+        init_cond_df.to_csv(init_conds_file, index=False)
+
+    sampler = _read_design_file(input_dir).get('sampler', {'method': method, 'seed': seed, 'n': 0})
+    if (sampler['method'], sampler['seed']) != (method, seed):
+        raise ValueError(f"The design in {input_dir} is extended with {sampler['method']} seed "
+                         f"{sampler['seed']}, not {method} seed {seed}.")
+    logger.info(f"Extending {input_dir} by {method} points {sampler['n']} to {sampler['n'] + n_new - 1}.")
+    param_names = [name for name, _ in param_values]
+    blocks = (pd.DataFrame(scale_samples(unit, param_values, 'param'), columns=param_names)
+              for unit in unit_samples(method, len(param_values), seed, sampler['n'], n_new, block_size))
+    return append_params(input_dir, blocks, f'chunk_{{i}}_{method}_samples.csv', chunk_params,
+                         dict(sampler, n=sampler['n'] + n_new))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Write the chunks of a design as wide chunk CSVs, or extend a "
+                                                 "design with Sobol or Halton parameter sets.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    expand = commands.add_parser('expand', help="write the wide chunk CSVs of a design")
+    expand.add_argument('input_dir', help="directory with design.json, params.csv and init_conds.csv")
+    expand.add_argument('output_dir')
+    extend = commands.add_parser('extend', help="append parameter sets to a design, in new chunks")
+    extend.add_argument('input_dir')
+    extend.add_argument('n_new', type=int, help="parameter sets to add")
+    extend.add_argument('--method', choices=['sobol', 'halton'], default='sobol')
+    extend.add_argument('--seed', type=int, default=0, help="scrambling seed, the same for every extension")
+    extend.add_argument('--chunk-params', type=int, default=200, help="parameter sets per new chunk")
+    extend.add_argument('--init-conds', type=int, default=None,
+                        help="initial conditions of a new design (directory without init_conds.csv)")
+    args = parser.parse_args()
+
+    if args.command == 'expand':
+        expand_chunks(args.input_dir, args.output_dir)
+    else:
+        extend_design(args.input_dir, args.n_new, args.method, args.seed, args.chunk_params, args.init_conds)
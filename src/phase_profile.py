@@ -0,0 +1,157 @@
+"""Sampled per-phase timers for the simulation hot path of run_simulation.py.
+
+run_simulation.py --profile N times the phases of every Nth row:
+
+    copasi_row     set_parameters, set_species (initial values and their
+                   update), solve (steady state task), messages (COPASI
+                   message capture, which replaced a check of the
+                   printed output), readout (the *_total values),
+                   result (result row and failure bookkeeping)
+    native_block   solve, result (a native block is one call, timed whole)
+
+A sampled row takes one perf_counter() per phase; the other rows only check
+a flag, so the timers can stay on for a whole run. Every worker keeps a
+PhaseProfiler, and its samples and counters go back to the driver with the
+output of every task (BlockOutput.profile). ProfileReport adds them up per
+worker and writes at the end of the run:
+
+    diagnostics/profile.json    per phase, in total and per worker: samples,
+                                sampled rows, seconds, mean_us per row, share
+                                of the sampled row time and the estimated total
+                                over all rows; counters
+    diagnostics/profile.folded  collapsed stacks 'worker_<pid>;<row>;<phase> <us>'
+                                for flamegraph.pl or speedscope
+"""
+import os
+import json
+import time
+
+
+class PhaseProfiler:
+    """Lap timer over the phases of every sample_every-th row of a worker.
+
+    sample_every: 0 to switch the timers off
+    """
+
+    def __init__(self, sample_every=0):
+        self.sample_every = sample_every
+        self._sampled = False
+        self._root = None
+        self._last = 0.0
+        self._n_rows = 0
+        self.reset()
+
+    def reset(self):
+        # rows seen per root frame, (root, phase) -> [samples, sampled rows, seconds], counters
+        self.rows = {}
+        self.phases = {}
+        self.counters = {}
+
+    def start(self, root, n_rows=1):
+        """Start a row (or a block of n_rows rows) under root; sampled when
+        the row count passes a multiple of sample_every.
+        """
+        seen = self.rows.get(root, 0)
+        self.rows[root] = seen + n_rows
+        self._sampled = bool(self.sample_every) and (seen + n_rows) // self.sample_every > seen // self.sample_every
+        if self._sampled:
+            self._root = root
+            self._n_rows = n_rows
+            self._last = time.perf_counter()
+
+    def mark(self, phase):
+        """End phase of the current row (lap since the last mark)."""
+        if not self._sampled:
+            return
+        now = time.perf_counter()
+        entry = self.phases.setdefault((self._root, phase), [0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += self._n_rows
+        entry[2] += now - self._last
+        self._last = now
+
+    def stop(self):
+        self._sampled = False
+
+    def count(self, name, n=1):
+        if self.sample_every:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def take(self):
+        """Samples and counters since the last take (None if nothing was
+        recorded), tagged with the worker pid; resets the profiler
+        """
+        if not self.sample_every or not self.rows:
+            return None
+        profile = {'pid': os.getpid(), 'rows': self.rows,
+                   'phases': [[root, phase] + entry for (root, phase), entry in self.phases.items()],
+                   'counters': self.counters}
+        self.reset()
+        return profile
+
+
+class ProfileReport:
+    """Driver side: the PhaseProfiler samples of all workers, per worker."""
+
+    def __init__(self):
+        self.workers = {}
+
+    def add(self, profile):
+        if profile is None:
+            return
+        worker = self.workers.setdefault(profile['pid'], {'rows': {}, 'phases': {}, 'counters': {}})
+        for root, n in profile['rows'].items():
+            worker['rows'][root] = worker['rows'].get(root, 0) + n
+        for root, phase, n, n_rows, seconds in profile['phases']:
+            entry = worker['phases'].setdefault((root, phase), [0, 0, 0.0])
+            entry[0] += n
+            entry[1] += n_rows
+            entry[2] += seconds
+        for name, n in profile['counters'].items():
+            worker['counters'][name] = worker['counters'].get(name, 0) + n
+
+    @staticmethod
+    def _summary(rows, phases):
+        """Per phase: samples, sampled rows, seconds, mean_us per row, share of
+        the sampled time of its root and estimated_total_s over all rows
+        """
+        root_seconds = {}
+        for (root, _), (_, _, seconds) in phases.items():
+            root_seconds[root] = root_seconds.get(root, 0.0) + seconds
+        summary = {}
+        for (root, phase), (n, n_rows, seconds) in sorted(phases.items()):
+            summary[f'{root};{phase}'] = {
+                'samples': n, 'sampled_rows': n_rows, 'seconds': seconds, 'mean_us': 1e6 * seconds / n_rows,
+                'share': seconds / root_seconds[root] if root_seconds[root] else 0.0,
+                'estimated_total_s': seconds * rows.get(root, 0) / n_rows}
+        return summary
+
+    def totals(self):
+        """rows, phases and counters summed over the workers."""
+        rows, phases, counters = {}, {}, {}
+        for worker in self.workers.values():
+            for root, n in worker['rows'].items():
+                rows[root] = rows.get(root, 0) + n
+            for key, entry in worker['phases'].items():
+                total = phases.setdefault(key, [0, 0, 0.0])
+                for i, value in enumerate(entry):
+                    total[i] += value
+            for name, n in worker['counters'].items():
+                counters[name] = counters.get(name, 0) + n
+        return rows, phases, counters
+
+    def write(self, diagnostics_dir):
+        """Write profile.json and profile.folded to diagnostics_dir."""
+        rows, phases, counters = self.totals()
+        report = {'rows': rows, 'phases': self._summary(rows, phases), 'counters': counters,
+                  'workers': {str(pid): {'rows': worker['rows'],
+                                         'phases': self._summary(worker['rows'], worker['phases']),
+                                         'counters': worker['counters']}
+                              for pid, worker in sorted(self.workers.items())}}
+        with open(os.path.join(diagnostics_dir, 'profile.json'), 'w') as f:
+            json.dump(report, f, indent=1)
+        with open(os.path.join(diagnostics_dir, 'profile.folded'), 'w') as f:
+            for pid, worker in sorted(self.workers.items()):
+                for (root, phase), (_, _, seconds) in sorted(worker['phases'].items()):
+                    f.write(f'worker_{pid};{root};{phase} {max(1, round(1e6 * seconds))}\n')
+        return report
@@ -0,0 +1,165 @@
+"""Columnar Parquet store for the steady state results of run_simulation.py.
+
+Written with run_simulation.py --output-format parquet, as an alternative to
+the appended results_<chunk>.csv files. Layout:
+
+    output/results.parquet/param_block=<param_index // partition_size>/<part>.parquet
+
+with one row per (param_index, init_cond_index):
+    param_index int32, init_cond_index int16,
+    fos, jun, fra1, fra2, jund float64 (NaN when no steady state),
+    status int8 (return codes of ap1_steadystate.py: 1 found, 2 equilibrium,
+        0 not found, 3 negative, 4 integration/DLSODA failure, 5 unexpected,
+        6 timeout)
+
+Every block of results becomes one part file per partition it touches, written
+under a hidden name and renamed, so readers and resume never see a partial
+file. compact_results merges the parts of every partition at the end of a run.
+Reading needs pyarrow (or fastparquet) through pandas:
+
+    results = load_results('BASE_DIR/output/results.parquet')
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+from checkpoint import pair_keys
+
+steady_state_species_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
+index_dtypes = {'param_index': np.int32, 'init_cond_index': np.int16}
+DEFAULT_PARTITION_SIZE = 1000
+
+
+def partition_dir(dataset_dir, param_block):
+    return os.path.join(dataset_dir, f'param_block={param_block}')
+
+
+def _write_part(directory, name, data):
+    """Write a DataFrame as directory/name.parquet via a hidden temporary file."""
+    os.makedirs(directory, exist_ok=True)
+    tmp_file = os.path.join(directory, f'.{name}.tmp')
+    data.to_parquet(tmp_file, index=False, compression='zstd')
+    os.replace(tmp_file, os.path.join(directory, f'{name}.parquet'))
+
+
+def results_frame(param_index, init_cond_index, steady_states, status):
+    """Typed results table from arrays; steady_states is (n, 5) with NaN for failures."""
+    data = pd.DataFrame({'param_index': np.asarray(param_index, dtype=index_dtypes['param_index']),
+                         'init_cond_index': np.asarray(init_cond_index, dtype=index_dtypes['init_cond_index'])})
+    steady_states = np.asarray(steady_states, dtype=np.float64).reshape(len(data), len(steady_state_species_names))
+    for i, name in enumerate(steady_state_species_names):
+        data[name] = steady_states[:, i]
+    data['status'] = np.asarray(status, dtype=np.int8)
+    return data
+
+
+def write_results(dataset_dir, name, param_index, init_cond_index, steady_states, status,
+                  partition_size=DEFAULT_PARTITION_SIZE):
+    """Add a block of results to the dataset, one part file per param_index partition.
+
+    name: prefix of the part files (e.g. the chunk file name), made unique
+        with the process id and time
+    """
+    data = results_frame(param_index, init_cond_index, steady_states, status)
+    part_name = f'{os.path.splitext(name)[0]}_{os.getpid()}_{time.time_ns()}'
+    param_block = data['param_index'].to_numpy() // partition_size
+    for block in np.unique(param_block):
+        _write_part(partition_dir(dataset_dir, block), part_name, data[param_block == block])
+
+
+def part_files(dataset_dir):
+    """Part files of the dataset, by partition directory."""
+    parts = {}
+    if not os.path.isdir(dataset_dir):
+        return parts
+    for directory in sorted(os.listdir(dataset_dir)):
+        path = os.path.join(dataset_dir, directory)
+        if directory.startswith('param_block=') and os.path.isdir(path):
+            parts[path] = sorted(os.path.join(path, f) for f in os.listdir(path)
+                                 if f.endswith('.parquet') and not f.startswith('.'))
+    return parts
+
+
+def read_parts(files, columns=None):
+    """One DataFrame from a list of part files."""
+    frames = [pd.read_parquet(f, columns=columns) for f in files]
+    if not frames:
+        empty = results_frame([], [], np.empty((0, len(steady_state_species_names))), [])
+        return empty if columns is None else empty[columns]
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_results(dataset_dir, param_range=None, columns=None, partition_size=DEFAULT_PARTITION_SIZE):
+    """All results of the dataset as one DataFrame, sorted by param_index and init_cond_index.
+
+    param_range: (start, stop) to read only the partitions of these param_index values
+    columns: subset of columns to read
+    partition_size: the one the dataset was written with
+    """
+    files = []
+    for directory, part_list in part_files(dataset_dir).items():
+        param_block = int(directory.rsplit('=', 1)[1])
+        if param_range is not None:
+            start, stop = param_range
+            if (param_block + 1) * partition_size <= start or param_block * partition_size >= stop:
+                continue
+        files.extend(part_list)
+
+    read_columns = None if columns is None else list(dict.fromkeys(['param_index', 'init_cond_index'] + columns))
+    data = read_parts(files, read_columns)
+    data = data.drop_duplicates(['param_index', 'init_cond_index'], keep='last')
+    if param_range is not None:
+        data = data[(data['param_index'] >= param_range[0]) & (data['param_index'] < param_range[1])]
+    data = data.sort_values(['param_index', 'init_cond_index']).reset_index(drop=True)
+    return data if columns is None else data[columns]
+
+
+def committed_pairs(dataset_dir):
+    """Sorted pair keys (see checkpoint.pair_keys) of every row in the dataset."""
+    files = [f for part_list in part_files(dataset_dir).values() for f in part_list]
+    index = read_parts(files, ['param_index', 'init_cond_index'])
+    return np.unique(pair_keys(index['param_index'], index['init_cond_index']))
+
+
+def compact_results(dataset_dir):
+    """Merge the part files of every partition into one, sorted and without repeated pairs.
+
+    The merged file is in place before the old parts are removed, and
+    repeated pairs are also dropped by load_results, so an interrupted
+    compaction loses nothing.
+    """
+    for directory, part_list in part_files(dataset_dir).items():
+        if len(part_list) < 2:
+            continue
+        data = read_parts(part_list)
+        data = data.drop_duplicates(['param_index', 'init_cond_index'], keep='last')
+        data = data.sort_values(['param_index', 'init_cond_index'])
+        _write_part(directory, f'compacted_{time.time_ns()}', data)
+        for f in part_list:
+            os.remove(f)
+
+
+def replace_results(dataset_dir, name, param_index, init_cond_index, steady_states, status,
+                    partition_size=DEFAULT_PARTITION_SIZE):
+    """Replace the rows of these pairs (e.g. rows solved again after a timeout).
+
+    Every partition the rows fall in is rewritten as one sorted part without
+    the old rows of the pairs, and its old parts are removed; if that is
+    interrupted, replacing the same rows again repairs it.
+    """
+    data = results_frame(param_index, init_cond_index, steady_states, status)
+    param_block = data['param_index'].to_numpy() // partition_size
+    parts = part_files(dataset_dir)
+    for block in np.unique(param_block):
+        directory = partition_dir(dataset_dir, block)
+        part_list = parts.get(directory, [])
+        rows = data[param_block == block]
+        old = read_parts(part_list)
+        old = old[~np.isin(pair_keys(old['param_index'], old['init_cond_index']),
+                           pair_keys(rows['param_index'], rows['init_cond_index']))]
+        merged = pd.concat([old, rows], ignore_index=True)
+        merged = merged.drop_duplicates(['param_index', 'init_cond_index'], keep='last')
+        _write_part(directory, f'{os.path.splitext(name)[0]}_{time.time_ns()}',
+                    merged.sort_values(['param_index', 'init_cond_index']))
+        for f in part_list:
+            os.remove(f)
@@ -1,24 +1,40 @@
 #%%
 import os
-import io
 import sys
-from itertools import product
 import time
 import numpy as np
 import pandas as pd
-import datetime
 # import traceback
 # import itertools
-#from collections import namedtuple
-#import argparse
-from multiprocessing import Pool
-# from functools import partial
-from memory_profiler import profile
-from numpy.random import rand
+from collections import namedtuple
+import argparse
+import subprocess
+from itertools import chain
+from multiprocessing import Pool, Manager
+from functools import partial
 import csv
-from basico import *
+from ap1_native import load_native_model
+from ap1_stability import steady_state_stability
+from ap1_sensitivity import steady_state_sensitivities, sensitivity_frame, write_sensitivities
+from ap1_continuation import (continue_branches, locate_folds, continue_folds, branch_frame, fold_frame,
+                              fold_curve_frame, write_continuation)
+from design_space import param_bounds
+from ap1_timecourse import integrate_timecourse_batch, output_grid, part_name, write_timecourse
+from ap1_steadystate import (steadystate_totals, solve_steadystate_rescue, status_messages, path_names, rescue_names,
+                             STATUS_FOUND, STATUS_UNEXPECTED, RESCUE_NONE)
+from copasi_session import CopasiSession, WatchedSession, SteadyStateError
+from scheduler import run_dynamic, log_schedule_report
+from checkpoint import (pair_keys, key_param_index, key_init_cond_index, csv_text, append_atomic, write_atomic, repair_csv,
+                        committed_pairs, keep_committed_csv, keep_committed_failures, replace_csv_rows)
+import result_store
+from failure_store import Failure, FailureWriter, load_failures, drop_failures
+from distributed import TaskLedger, default_node_id, node_dir, merge_node_outputs
+from phase_profile import PhaseProfiler, ProfileReport
+from pair_design import read_chunk, list_chunk_files
 #Initialize logging
 import logging
+# set up by setup_logging when run as a script
+logger = logging.getLogger(__name__)
 #%%
 # logging.basicConfig(filename="sim_err.log", level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 # logging.basicConfig(filename="sim_err.log", level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -53,219 +69,1236 @@ def setup_logging(base_dir):
     return logger
 
 #import pdb; pdb.set_trace()
-print("Loading model...")
-model = load_model('ap1_model_081025_mod.cps')
-print("Model loaded successfully.")
-# set task setting for Newton-Raphson false
-set_task_settings(T.STEADY_STATE, settings={'method': {
-                  'Use Newton': False, 'Use Integration': True}})
-#%%
-# functions for changing parameters or defining range of initial conditions
-# set initial values for dimers
+COPASI_MODEL_FILE = 'ap1_model_081025_mod.cps'
+# per-worker COPASI session, set up by init_worker
+session = None
 
-#%%
-def fixed_initial_variables(species_name, species_value):
-    """This function sets the initial value of the species to the value in species_value
-    this will be used for setting the initial values of dimers once you load the model
-    Enter the species name and the value in a list
-    species_name: list of species names
-    species_value: list of species values 
-    """
-    for i in range(len(species_name)):
-        set_species(
-            name=species_name[i], initial_concentration=species_value[i], exact=True)
-
-#change local or global parameters
-
-
-def change_model_parameters(par_name, par_value, par_type):
-    """ This function changes the model parameters to the values in par_value
-    Enter the parameter name and the value in a list
-    par_name: list of parameter names
-    par_value: list of parameter values
-    par_type: string: 'local' or 'global' 
-    """
-
-    if par_type == 'local':
-       for i in range(len(par_name)):
-            set_reaction_parameters(name=par_name[i], value=par_value[i])
-    elif par_type == 'global':
-        (set_parameters(name=par_name[i], initial_value=par_value[i]) for i in range(len(par_name)))
-
-def run_steadystate_wrapper(*args, **kwargs):
-    # Redirect stdout
-    old_stdout = sys.stdout
-    new_stdout = io.StringIO()
-    sys.stdout = new_stdout
-
-    # Call the actual function
-    error_occurred = False
-    try:
-       status = basico.task_steadystate.run_steadystate(*args, **kwargs)
-    except:
-        error_occurred = True
-    finally:
-        # Get the stdout content and revert redirection
-        output = new_stdout.getvalue()
-        sys.stdout = old_stdout
-
-    # Check if the output has the error message
-    if "DLSODA" in output or error_occurred:  
-        raise Exception("Steady state calculation failed due to DLSODA error.")
-    
-    return status
-#%%
-# Steady State functions
-#modifying this to take on row of initial conditions at a time
-def get_steadystate(init_cond_rows):
-    """ This function runs the steady state for the model
-    init_cond_df: DataFrame: DataFrame of initial conditions
-    """
-    # create empty dataframe to store the steady state values
-    #logging.debug("Entering get_steadystate...")
-    num_init_col = len(init_cond_rows)
-    steady_state_arr = np.zeros((num_init_col))  #  same as num species
-    #steady_state_df = pd.DataFrame(steady_state_arr, columns= init_cond_df.columns.tolist())
-
-    # set all dimer initial values to 0
-    # need to make the names more flexible here for the AP1 dimer names
-    spec_names = ['junfos', 'junfra1', 'junfra2','junjund','junjun','jundfos','jundfra1','jundfra2','jundjund']
-    spec_vals = np.zeros(len(spec_names)).tolist() #
-    fixed_initial_variables(spec_names, spec_vals)
-
-    # loop through all the initial conditions and run the steady state
-    # extract name of species (**YOU ONLY NEED TO CHANGE THE NUMBER OF SPECIES**)
-    #my_species = get_species().reset_index()
-    
-    #species_name = get_species().index.tolist()[:num_init_col]
-    species_name = ['fos', 'jun', 'fra1', 'fra2', 'jund']
-    #logging.debug(f"Set species with names: {species_name}")
-    #species_name = ['fos', 'jun', 'fra1', 'fra2', 'jund']
-    # for i in range(0, len(init_cond_df)):
-    #     init_cond_rows = init_cond_df.iloc[i].values
-        
-        # set the initial conditions for the species based on the initial condition dataframe
-    for j, name in enumerate(species_name):
-        set_species(
-            name=name, initial_concentration=init_cond_rows[j], exact=True)
-
-    # run the steady state
-    #run_steadystate(use_initial_values = True, update_model = False)
-    status = run_steadystate_wrapper(use_initial_values=True, update_model=False)
-
-    # Check the status here and raise exception if necessary
-    if status == 0:
-        raise Exception("Steady state not found.")
-    elif status == 3:
-        raise Exception("Steady state with negative concentrations found.")
-    elif status not in [1, 2]:
-        raise Exception(f"Unexpected return code: {status}")
-    
-    ss_v = get_species()[['concentration']].reset_index()
-    ss_vtotal = ss_v[ss_v['name'].str.contains("total")]
-    steady_state_arr[:len(species_name)] = np.round(ss_vtotal['concentration'].values,1)
-    #logging.debug("Ran steady state...")
+# budget of every simulation: seconds (None for no limit), integration steps
+# (native: per simulation, COPASI: per DLSODA call) and model time of the
+# COPASI forward integration (None: the model file's); a row over budget gets
+# STATUS_TIMEOUT
+SimBudget = namedtuple('SimBudget', ['time_s', 'steps', 'duration'], defaults=(None,))
+sim_budget = SimBudget(None, 5000)
+# per-worker phase timers (--profile), sent back with every task
+profiler = PhaseProfiler()
+# driver side: the timers of all workers
+profile_report = ProfileReport()
 
-        
-    return steady_state_arr
+def init_worker(cps_file=COPASI_MODEL_FILE, budget=None, niceness=0, profile_every=0):
+    """Pool initializer: load the COPASI model once per worker process and
+    resolve the parameter/species handles used by process_chunk_rows
+    (integration only, Newton off, see CopasiSession)
+    cps_file: None for the native engine, which needs no session
+    budget: SimBudget of the simulations in this worker
+    niceness: added to the worker's nice value (the timeout retry pass runs at
+        low priority)
+    profile_every: time the phases of every profile_every-th row (0: off, see
+        phase_profile.py)
+    """
+    global session, sim_budget, profiler
+    if budget is not None:
+        sim_budget = budget
+    if niceness:
+        os.nice(niceness)
+    profiler = PhaseProfiler(profile_every)
+    if cps_file is None:
+        return
+    print(f"Loading model {cps_file}...")
+    if sim_budget.time_s is None:
+        session = CopasiSession(cps_file)
+        session.set_budget(None, sim_budget.steps, sim_budget.duration)
+    else:
+        # a COPASI process per worker, replaced when a solve is stuck past its budget
+        session = WatchedSession(cps_file, sim_budget.time_s, sim_budget.steps, sim_budget.duration)
+    session.profiler = profiler
+    print("Model loaded successfully.")
 #%%
 steady_state_species_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
 headers = ['param_index', 'init_cond_index'] + steady_state_species_names
 
-def process_chunk_rows(rows, output_file, chunk_file_name, BASE_DIR):
-    steady_state_species_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
-    headers = ['param_index', 'init_cond_index'] + steady_state_species_names
-    results_to_write = []
-    
-    for row in rows:
-        init_cond_index = row['init_cond_index']
-        param_index = row['param_index']
-        param_values = pd.Series(row).iloc[2:17].round(3).tolist()
-        init_cond_values = pd.Series(row).iloc[17:].tolist()
-        par_names = pd.Series(row).iloc[2:17].index.tolist()
+# chunk file layout: param_index, init_cond_index, 15 LHS parameters, 5 monomer initial conditions
+n_lhs_params = 15
+ChunkBlock = namedtuple('ChunkBlock', ['param_index', 'init_cond_index', 'param_values', 'init_cond_values'])
 
-        #logging.info(f"Processing row with param_index {param_index} and init_cond_index {init_cond_index}...")
+def chunk_layout(chunk_file):
+    """Parameter names of a chunk file, checked against the column layout once
+    from the header, so the blocks below can be sliced by position.
+    """
+    columns = read_chunk(chunk_file, nrows=0).columns.tolist()
+    if (columns[:2] != ['param_index', 'init_cond_index']
+            or len(columns) != 2 + n_lhs_params + len(steady_state_species_names)):
+        raise ValueError(f"Unexpected columns in {chunk_file}: {columns}")
+    return columns[2:2 + n_lhs_params]
+
+def read_chunk_blocks(chunk_file, block_size=None):
+    """Read a chunk file as ChunkBlock arrays of block_size rows (whole file if None).
+    Each block is parsed straight into one float64 array and split into
+    row-contiguous index, parameter (rounded to 3 decimals) and initial
+    condition arrays.
+    """
+    reader = read_chunk(chunk_file, dtype=np.float64, chunksize=block_size)
+    for data in ([reader] if block_size is None else reader):
+        values = data.to_numpy()
+        yield ChunkBlock(values[:, 0].astype(np.int64), values[:, 1].astype(np.int64),
+                         np.ascontiguousarray(np.round(values[:, 2:2 + n_lhs_params], 3)),
+                         np.ascontiguousarray(values[:, 2 + n_lhs_params:]))
+
+def take_rows(block, rows):
+    """ChunkBlock with the given rows of block"""
+    return ChunkBlock(*(column[rows] for column in block))
+
+def drop_committed(block, committed, by_param=False):
+    """ChunkBlock without the rows whose (param_index, init_cond_index) pair is
+    in committed (pair keys), or without every param_index that has a
+    committed row if by_param (adaptive runs solve whole param_index values)
+    """
+    if by_param:
+        done = np.isin(block.param_index, key_param_index(committed))
+    else:
+        done = np.isin(pair_keys(block.param_index, block.init_cond_index), committed)
+    return take_rows(block, np.flatnonzero(~done))
+
+# status: return code of every result row (ap1_steadystate.py codes)
+# profile: PhaseProfiler.take() of the worker, added by run_task
+BlockOutput = namedtuple('BlockOutput', ['results', 'status', 'failures', 'paths', 'ic_budget', 'profile'],
+                         defaults=(None,))
+
+def solve_rows(block, par_names):
+    """One COPASI steady state per row through the worker's CopasiSession
+    block: ChunkBlock from read_chunk_blocks
+    par_names: parameter names of the chunk file, from chunk_layout
+    The loop over rows only takes array rows, no name lookups or DataFrames.
+    Returns BlockOutput with a result dict and return code per row ('NA' for
+    failed rows) and a failure_store.Failure for every failed row.
+    """
+    session.use_parameters(par_names)
+    results, status, failures = [], [], []
 
+    for param_index, init_cond_index, params, init_conds in zip(*block):
+        profiler.start('copasi_row')
+        result = {
+            'param_index': param_index,
+            'init_cond_index': init_cond_index,
+        }
+        start = time.perf_counter()
         try:
-            change_model_parameters(par_names, param_values, 'local')
-            steady_state_result = get_steadystate(init_cond_values)
-            
-            result = {
-                'param_index': param_index,
-                'init_cond_index': init_cond_index,
-                **dict(zip(steady_state_species_names, steady_state_result))
-            }
-            results_to_write.append(result)
+            steady_state_result = np.round(session.solve(params, init_conds), 1)
+            result.update(zip(steady_state_species_names, steady_state_result))
+            status.append(session.status)
         except Exception as e:
-            #print(f"Error at param_index {param_index}, init_cond_index {init_cond_index}: {str(e)}")
-            logger.error(
-                f"Error at param_index {param_index}, init_cond_index {init_cond_index}: {str(e)}")
-
-            try:
-                with open(os.path.join(BASE_DIR, 'failed_indices.txt'), 'a') as f:
-                    f.write(f"Failed for param_index {param_index}, init_cond_index {init_cond_index}: {str(e)}\n")
-            except Exception as file_error:
-                print(f"Error writing to file: {file_error}")
-
-            error_msg = f"Error processing row with param_index {param_index} and init_cond_index {init_cond_index}: {str(e)}"
-            logger.debug(error_msg)
-
-            result = {
-                'param_index': param_index,
-                'init_cond_index': init_cond_index,
-            }
+            status.append(e.status if isinstance(e, SteadyStateError) else STATUS_UNEXPECTED)
+            failures.append(Failure(param_index, init_cond_index, status[-1], str(e), -1, -1,
+                                    time.perf_counter() - start))
             for species_name in steady_state_species_names:
                 result[species_name] = 'NA'
-            results_to_write.append(result)
-    
-    # Write results immediately to file
-    with open(output_file, 'a') as f:
-        writer = csv.DictWriter(f, fieldnames=headers)
-        writer.writerows(results_to_write)
-    
-    logger.info(f"Processed {len(rows)} rows, wrote to {output_file}.")
 
-def process_chunk(chunk_file, OUTPUT_DIR, BASE_DIR):
-    steady_state_species_names = ['fos', 'jun', 'fra1', 'fra2', 'jund']
-    headers = ['param_index', 'init_cond_index'] + steady_state_species_names
-    
-    chunk_file_name = os.path.basename(chunk_file)
-    output_file = os.path.join(OUTPUT_DIR, f'results_{chunk_file_name}')
-    
-    # Write header if file doesn't exist
+        results.append(result)
+        profiler.mark('result')
+        profiler.stop()
+    profiler.count('copasi_failed', len(failures))
+
+    return BlockOutput(results, status, failures, [], [])
+
+path_headers = ['param_index', 'init_cond_index', 'path', 'newton_iterations', 'integration_steps']
+stability_headers = ['param_index', 'init_cond_index', 'max_real_eigenvalue', 'stable', 'slowest_timescale']
+
+def solve_rows_native(block, par_names, method='integration'):
+    """Same output as solve_rows, but the whole block of rows is solved
+    at once as one stacked ODE system by the native engine (ap1_steadystate.py)
+    method: 'integration' or 'hybrid' (short integration + Newton, see
+        solve_steadystate_hybrid)
+    The path every row took is returned as BlockOutput.paths rows, written
+    to diagnostics/ so the result files keep the columns
+    02_process_LHS_simulations expects.
+    """
+    native_model = load_native_model()
+    profiler.start('native_block', len(block.param_index))
+    start = time.perf_counter()
+    # the time budget covers the block, whose lanes are integrated together
+    deadline = None if sim_budget.time_s is None else start + sim_budget.time_s
+    steady_states, status, path, newton_iterations, steps = steadystate_totals(
+        native_model, par_names, block.param_values, block.init_cond_values, method=method,
+        max_steps=sim_budget.steps, deadline=deadline)
+    elapsed = time.perf_counter() - start
+    profiler.mark('solve')
+
+    results, failures = [], []
+    for param_index, init_cond_index, steady_state_result, code, lane_steps, lane_newton_iterations in zip(
+            block.param_index, block.init_cond_index, np.round(steady_states, 1), status, steps, newton_iterations):
+        result = {
+            'param_index': param_index,
+            'init_cond_index': init_cond_index,
+        }
+        if code in [1, 2]:
+            result.update(zip(steady_state_species_names, steady_state_result))
+        else:
+            failures.append(Failure(param_index, init_cond_index, int(code), status_messages[code],
+                                    int(lane_steps), int(lane_newton_iterations), elapsed))
+            for species_name in steady_state_species_names:
+                result[species_name] = 'NA'
+        results.append(result)
+
+    paths = list(zip(block.param_index, block.init_cond_index,
+                     [path_names[code] for code in path], newton_iterations, steps))
+    path_counts = {name: int(np.sum(path == code)) for code, name in path_names.items()}
+    profiler.mark('result')
+    profiler.stop()
+    profiler.count('native_failed', len(failures))
+    for name, n in path_counts.items():
+        profiler.count(f'native_path_{name}', n)
+    logger.info(f"Solved {len(block.param_index)} rows with the native engine ({method}: {path_counts}).")
+    return BlockOutput(results, status.tolist(), failures, paths, [])
+
+def solve_block(block, par_names, engine='copasi', method='integration'):
+    """BlockOutput of solve_rows or solve_rows_native"""
+    if engine == 'native':
+        return solve_rows_native(block, par_names, method)
+    return solve_rows(block, par_names)
+
+def append_csv_rows(file_name, header, rows):
+    """Append rows to a csv file, writing header first if the file is new"""
+    write_header = not os.path.exists(file_name)
+    with open(file_name, 'a') as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+def write_block_output(output, output_file, chunk_file_name, BASE_DIR, failure_sink):
+    """Write a BlockOutput: failures to failure_sink (the driver's
+    FailureWriter, or a FailureSender to it, which returns once they are
+    written), the native paths and initial
+    condition budget to diagnostics/<paths|ic_budget>_<chunk file>, and last
+    the results, which commits the block (see checkpoint.py):
+    output_file is results_<chunk file>.csv, appended in one fsync'd write,
+    or the results.parquet dataset directory (see result_store.py)
+    """
+    if output.failures:
+        failure_sink.put(output.failures)
+
+    if output.paths:
+        append_csv_rows(os.path.join(BASE_DIR, 'diagnostics', f'paths_{chunk_file_name}'),
+                        path_headers, output.paths)
+    if output.ic_budget:
+        append_csv_rows(os.path.join(BASE_DIR, 'diagnostics', f'ic_budget_{chunk_file_name}'),
+                        ic_budget_headers, output.ic_budget)
+
+    if output_file.endswith('.parquet'):
+        steady_states = [[np.nan if result[s] == 'NA' else result[s] for s in steady_state_species_names]
+                         for result in output.results]
+        result_store.write_results(output_file, chunk_file_name,
+                                   [result['param_index'] for result in output.results],
+                                   [result['init_cond_index'] for result in output.results],
+                                   steady_states, output.status)
+    else:
+        append_atomic(output_file, csv_text(output.results, headers))
+
+def process_chunk_rows(block, par_names, output_file, chunk_file_name, BASE_DIR, failure_sink):
+    """Solve a block of rows with COPASI and write the results right away"""
+    output = solve_rows(block, par_names)
+    write_block_output(output, output_file, chunk_file_name, BASE_DIR, failure_sink)
+    logger.info(f"Processed {len(block.param_index)} rows ({len(output.failures)} failed), wrote to {output_file}.")
+    return output.results
+
+def process_chunk_rows_native(block, par_names, output_file, chunk_file_name, BASE_DIR, failure_sink,
+                              method='integration'):
+    """Solve a block of rows with the native engine and write the results right away"""
+    output = solve_rows_native(block, par_names, method)
+    write_block_output(output, output_file, chunk_file_name, BASE_DIR, failure_sink)
+    logger.info(f"Processed {len(block.param_index)} rows with the native engine ({len(output.failures)} failed), "
+                f"wrote to {output_file}.")
+    return output.results
+
+ic_budget_headers = ['param_index', 'n_init_conds', 'n_steady_states', 'since_last_new', 'stopped_early',
+                     'new_state_probability', 'missed_basin_fraction_95']
+
+def ic_budget_confidence(state_counts, since_last_new):
+    """How likely it is that a parameter set has steady states we did not find.
+
+    state_counts: number of initial conditions that reached each steady state
+    since_last_new: initial conditions in a row since the last new state
+    Returns (new_state_probability, missed_basin_fraction_95):
+    - the Good-Turing estimate of the chance that the next initial condition
+      reaches a new steady state, states seen once / initial conditions
+    - the basin size (fraction of initial conditions) that a missed state can
+      have at most, with 95% confidence: k draws all missing a basin of
+      fraction q has probability (1 - q)^k, solved for 0.05
+    """
+    n = sum(state_counts)
+    singletons = sum(1 for count in state_counts if count == 1)
+    new_state_probability = singletons / n if n else 1.0
+    missed_basin_fraction_95 = 1 - 0.05 ** (1 / since_last_new) if since_last_new else 1.0
+    return new_state_probability, missed_basin_fraction_95
+
+def solve_block_adaptive(block, par_names, engine, method, ic_patience, state_tol=0.1):
+    """Adaptive number of initial conditions per param_index.
+
+    The initial conditions of every param_index are taken in file order, in
+    waves of ic_patience rows for all param_index values still open, so each
+    wave is solved as one batch. A param_index is closed once ic_patience
+    initial conditions in a row have not reached a new steady state (totals
+    differing by more than state_tol from every state seen so far), or when
+    its initial conditions run out. Failed rows do not count either way.
+    Rows solved in the last wave after the stopping point are kept.
+    The confidence that all states were found is logged and returned as
+    BlockOutput.ic_budget rows, written to diagnostics/ic_budget_<chunk file>.
+    block must hold all initial conditions of its param_index values.
+    """
+    # rows of every param_index, in file order
+    order = np.argsort(block.param_index, kind='stable')
+    param_indices, starts = np.unique(block.param_index[order], return_index=True)
+    groups = dict(zip(param_indices.tolist(), np.split(order, starts[1:])))
+    position = dict.fromkeys(groups, 0)
+    states = {param_index: [] for param_index in groups}
+    state_counts = {param_index: [] for param_index in groups}
+    since_last_new = dict.fromkeys(groups, 0)
+    stopped = dict.fromkeys(groups, False)
+    open_params = list(groups)
+    outputs = []
+
+    while open_params:
+        wave = take_rows(block, np.concatenate([groups[p][position[p]:position[p] + ic_patience]
+                                                for p in open_params]))
+        outputs.append(solve_block(wave, par_names, engine, method))
+
+        for result in outputs[-1].results:
+            param_index = result['param_index']
+            position[param_index] += 1
+            if stopped[param_index] or result[steady_state_species_names[0]] == 'NA':
+                continue
+            steady_state = np.array([result[s] for s in steady_state_species_names], dtype=float)
+            for i, known in enumerate(states[param_index]):
+                if np.max(np.abs(known - steady_state)) <= state_tol:
+                    state_counts[param_index][i] += 1
+                    since_last_new[param_index] += 1
+                    break
+            else:
+                states[param_index].append(steady_state)
+                state_counts[param_index].append(1)
+                since_last_new[param_index] = 0
+            stopped[param_index] = since_last_new[param_index] >= ic_patience
+
+        open_params = [p for p in open_params if not stopped[p] and position[p] < len(groups[p])]
+
+    budget_rows = []
+    for param_index in groups:
+        new_state_probability, missed_basin_fraction_95 = ic_budget_confidence(
+            state_counts[param_index], since_last_new[param_index])
+        logger.info(f"param_index {param_index}: {len(states[param_index])} steady states from "
+                    f"{position[param_index]} of {len(groups[param_index])} initial conditions, "
+                    f"{since_last_new[param_index]} in a row without a new state; "
+                    f"P(next initial condition finds a new state) ~ {new_state_probability:.3f}, "
+                    f"95% confidence that any missed state has a basin fraction below {missed_basin_fraction_95:.3f}")
+        budget_rows.append([param_index, position[param_index], len(states[param_index]),
+                            since_last_new[param_index], stopped[param_index],
+                            round(new_state_probability, 4), round(missed_basin_fraction_95, 4)])
+
+    n_solved = sum(position.values())
+    logger.info(f"Adaptive initial conditions: solved {n_solved} of {len(block.param_index)} rows.")
+    return BlockOutput([result for output in outputs for result in output.results],
+                       [code for output in outputs for code in output.status],
+                       [failure for output in outputs for failure in output.failures],
+                       [path for output in outputs for path in output.paths], budget_rows)
+
+def param_blocks(block, n_params):
+    """Split a ChunkBlock into blocks of n_params param_index values with all their rows"""
+    param_indices = np.unique(block.param_index)
+    for start in range(0, len(param_indices), n_params):
+        rows = np.isin(block.param_index, param_indices[start:start + n_params])
+        yield take_rows(block, np.flatnonzero(rows))
+
+def open_output_file(chunk_file, OUTPUT_DIR, output_format='csv'):
+    """results_<chunk file> in OUTPUT_DIR, with the header written if it is new,
+    or the results.parquet dataset directory shared by all chunk files
+    """
+    if output_format == 'parquet':
+        output_file = os.path.join(OUTPUT_DIR, 'results.parquet')
+        os.makedirs(output_file, exist_ok=True)
+        return output_file
+    output_file = os.path.join(OUTPUT_DIR, f'results_{os.path.basename(chunk_file)}')
     if not os.path.exists(output_file):
         with open(output_file, 'w') as f:
             writer = csv.DictWriter(f, fieldnames=headers)
             writer.writeheader()
+    return output_file
+
+def read_committed(output_file):
+    """Pair keys already in a results csv file or the results.parquet dataset"""
+    if output_file.endswith('.parquet'):
+        return result_store.committed_pairs(output_file)
+    return committed_pairs(output_file)
+
+def process_chunk(chunk_file, OUTPUT_DIR, BASE_DIR, engine='copasi', method='integration', ic_patience=None,
+                  resume=False, output_format='csv', failure_sink=None, screened=None):
+    chunk_file_name = os.path.basename(chunk_file)
+    output_file = open_output_file(chunk_file, OUTPUT_DIR, output_format)
+    # pairs already in the results are skipped on resume
+    committed = read_committed(output_file) if resume else np.empty(0, dtype=np.int64)
+    # and so are the rows ruled out by the surrogate screen (pair keys)
+    if screened is not None:
+        committed = np.union1d(committed, screened)
     
     logger.info(f"Started processing file {chunk_file}...")
-    chunk_size = 500
-    for batch_data in pd.read_csv(chunk_file, chunksize=chunk_size):
-        logger.info(f"Processing {len(batch_data)} records from {chunk_file}...")
-        process_chunk_rows(batch_data.to_dict('records'), output_file, chunk_file_name, BASE_DIR)
+    par_names = chunk_layout(chunk_file)
+    # the native engine integrates a whole block as one vectorized system
+    chunk_size = 5000 if engine == 'native' else 500
+    if ic_patience:
+        # blocks of whole param_index values: the adaptive waves take the
+        # initial conditions of a param_index in order
+        chunk_block = drop_committed(next(read_chunk_blocks(chunk_file)), committed, by_param=True)
+        for block in param_blocks(chunk_block, max(1, chunk_size // ic_patience)):
+            output = solve_block_adaptive(block, par_names, engine, method, ic_patience)
+            write_block_output(output, output_file, chunk_file_name, BASE_DIR, failure_sink)
+        logger.info(f"Completed processing file {chunk_file}.")
+        return profiler.take()
+
+    for block in read_chunk_blocks(chunk_file, chunk_size):
+        block = drop_committed(block, committed)
+        if not len(block.param_index):
+            continue
+        logger.info(f"Processing {len(block.param_index)} records from {chunk_file}...")
+        if engine == 'native':
+            process_chunk_rows_native(block, par_names, output_file, chunk_file_name, BASE_DIR, failure_sink, method)
+        else:
+            process_chunk_rows(block, par_names, output_file, chunk_file_name, BASE_DIR, failure_sink)
     
     logger.info(f"Completed processing file {chunk_file}.")
+    # the phase timers of the chunk go back to the driver (--profile)
+    return profiler.take()
+
+#%%
+# dynamic scheduling: small (param_index range x initial condition range) tasks
+# skip: pair keys of committed rows inside the ranges, left out on resume
+SimTask = namedtuple('SimTask', ['chunk_file', 'param_start', 'param_stop', 'init_cond_start', 'init_cond_stop',
+                                 'skip'], defaults=((),))
+
+def make_tasks(chunk_files, task_params, task_init_conds=None, committed=None, by_param=False):
+    """Split the chunk files into SimTasks of task_params param_index values
+    x task_init_conds initial conditions (all initial conditions if None).
+    Ranges are half-open, on the index values; only the two index columns of
+    the chunk files are read here.
+    committed: {chunk file: sorted pair keys} on resume; tasks only cover
+        rows not committed yet (whole param_index values if by_param)
+    """
+    tasks = []
+    for chunk_file in chunk_files:
+        index = read_chunk(chunk_file, usecols=['param_index', 'init_cond_index'], dtype=np.int64)
+        done = np.empty(0, dtype=np.int64) if committed is None else committed[chunk_file]
+        if by_param:
+            remaining = ~np.isin(index['param_index'], key_param_index(done))
+        else:
+            remaining = ~np.isin(pair_keys(index['param_index'], index['init_cond_index']), done)
+        param_indices = np.unique(index['param_index'][remaining])
+        init_cond_indices = np.unique(index['init_cond_index'][remaining])
+        ic_step = len(init_cond_indices) if task_init_conds is None else task_init_conds
+        for i in range(0, len(param_indices), task_params):
+            params = param_indices[i:i + task_params]
+            for j in range(0, len(init_cond_indices), ic_step):
+                init_conds = init_cond_indices[j:j + ic_step]
+                task = SimTask(chunk_file, int(params[0]), int(params[-1]) + 1,
+                               int(init_conds[0]), int(init_conds[-1]) + 1)
+                skip = done[np.searchsorted(done, pair_keys(task.param_start, 0)):
+                            np.searchsorted(done, pair_keys(task.param_stop, 0))]
+                if not by_param:
+                    init_cond = key_init_cond_index(skip)
+                    skip = skip[(init_cond >= task.init_cond_start) & (init_cond < task.init_cond_stop)]
+                tasks.append(task._replace(skip=tuple(skip.tolist())))
+    return tasks
+
+def screen_split(chunk_file, BASE_DIR):
+    """Sorted pair keys of the rows of a chunk file that the surrogate screen
+    (BASE_DIR/screen/screen_<chunk>, see ap1_surrogate.py) keeps and rules out;
+    all rows are kept if the chunk file was not screened
+    """
+    index = read_chunk(chunk_file, usecols=['param_index', 'init_cond_index'], dtype=np.int64)
+    keys = pair_keys(index['param_index'].to_numpy(), index['init_cond_index'].to_numpy())
+    screen_file = os.path.join(BASE_DIR, 'screen', f'screen_{os.path.basename(chunk_file)}')
+    if not os.path.exists(screen_file):
+        logger.warning(f"No surrogate screen for {os.path.basename(chunk_file)}; all of its rows are kept.")
+        return np.sort(keys), np.empty(0, dtype=np.int64)
+    screen = pd.read_csv(screen_file)
+    ruled_out = np.isin(index['param_index'], screen.loc[screen['ruled_out'] == 1, 'param_index'])
+    return np.sort(keys[~ruled_out]), np.sort(keys[ruled_out])
+
+def screened_tasks(chunk_files, task_params, task_init_conds=None, committed=None, by_param=False, BASE_DIR=None,
+                   screen=None):
+    """make_tasks with the surrogate screen applied: the rows of parameter sets
+    it rules out are left out (screen 'skip') or made into tasks after all the
+    others ('deprioritize'); the ruled-out rows of a task are in its skip keys
+    """
+    if screen is None:
+        return make_tasks(chunk_files, task_params, task_init_conds, committed, by_param)
+    kept_done, ruled_out_done = {}, {}
+    n_ruled_out = 0
+    for chunk_file in chunk_files:
+        done = np.empty(0, dtype=np.int64) if committed is None else committed[chunk_file]
+        kept, ruled_out = screen_split(chunk_file, BASE_DIR)
+        kept_done[chunk_file] = np.union1d(done, ruled_out)
+        ruled_out_done[chunk_file] = np.union1d(done, kept)
+        n_ruled_out += len(np.unique(key_param_index(ruled_out)))
+    tasks = make_tasks(chunk_files, task_params, task_init_conds, kept_done, by_param)
+    logger.info(f"Surrogate screen: {n_ruled_out} parameter sets ruled out, "
+                f"{'run last' if screen == 'deprioritize' else 'skipped'}.")
+    if screen == 'deprioritize':
+        tasks += make_tasks(chunk_files, task_params, task_init_conds, ruled_out_done, by_param)
+    return tasks
+
+# the chunk file of the last task, kept by every worker for its next task
+_chunk_cache = {}
+
+def load_chunk(chunk_file):
+    """Whole chunk file as one ChunkBlock and its parameter names, cached per worker"""
+    if chunk_file not in _chunk_cache:
+        _chunk_cache.clear()
+        _chunk_cache[chunk_file] = (next(read_chunk_blocks(chunk_file)), chunk_layout(chunk_file))
+    return _chunk_cache[chunk_file]
+
+def run_task(task, engine='copasi', method='integration', ic_patience=None):
+    """Solve the rows of one SimTask in a worker; the BlockOutput goes back to the driver"""
+    chunk_block, par_names = load_chunk(task.chunk_file)
+    rows = np.flatnonzero((chunk_block.param_index >= task.param_start) & (chunk_block.param_index < task.param_stop)
+                          & (chunk_block.init_cond_index >= task.init_cond_start)
+                          & (chunk_block.init_cond_index < task.init_cond_stop))
+    block = take_rows(chunk_block, rows)
+    if task.skip:
+        block = drop_committed(block, np.array(task.skip, dtype=np.int64), by_param=bool(ic_patience))
+    if ic_patience:
+        output = solve_block_adaptive(block, par_names, engine, method, ic_patience)
+    else:
+        output = solve_block(block, par_names, engine, method)
+    return output._replace(profile=profiler.take())
+
+def run_claimed_task(claimed, engine='copasi', method='integration', ic_patience=None):
+    """run_task of a (task_id, task) claimed from the ledger of a distributed run"""
+    return run_task(claimed[1], engine, method, ic_patience)
+
+def prepare_resume(chunk_files, OUTPUT_DIR, BASE_DIR, output_format='csv'):
+    """Make the files of an interrupted run consistent before resuming it.
+
+    Cuts torn last lines off the results files, reads their committed pairs
+    and drops the rows of uncommitted pairs (and duplicates) from
+    failed_indices.txt and the diagnostics files.
+    Returns {chunk file: sorted committed pair keys}.
+    """
+    committed = {}
+    if output_format == 'parquet':
+        # parquet parts are renamed into place whole; one set for all chunk files
+        dataset_committed = result_store.committed_pairs(os.path.join(OUTPUT_DIR, 'results.parquet'))
+    for chunk_file in chunk_files:
+        chunk_file_name = os.path.basename(chunk_file)
+        if output_format == 'parquet':
+            committed[chunk_file] = dataset_committed
+        else:
+            output_file = os.path.join(OUTPUT_DIR, f'results_{chunk_file_name}')
+            torn = repair_csv(output_file, len(headers))
+            if torn:
+                logger.warning(f"Removed a torn last line ({torn} bytes) from {output_file}.")
+            committed[chunk_file] = committed_pairs(output_file)
+        for prefix, file_by_param in [('paths', False), ('ic_budget', True)]:
+            keep_committed_csv(os.path.join(BASE_DIR, 'diagnostics', f'{prefix}_{chunk_file_name}'),
+                               committed[chunk_file], file_by_param)
+        if output_format != 'parquet':
+            logger.info(f"Resume: {len(committed[chunk_file])} rows of {chunk_file_name} already committed.")
+    if output_format == 'parquet':
+        logger.info(f"Resume: {len(dataset_committed)} rows in total already committed.")
+
+    all_committed = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + list(committed.values())))
+    dropped = keep_committed_failures(os.path.join(BASE_DIR, 'failed_indices.txt'), all_committed)
+    keep_committed_csv(os.path.join(BASE_DIR, 'failures.csv'), all_committed)
+    logger.info(f"Resume: dropped {dropped} failed_indices.txt lines of uncommitted or repeated rows.")
+    return committed
+
+def write_task_output(task, output, OUTPUT_DIR, BASE_DIR, failure_writer, output_format='csv'):
+    """Driver side of run_task: write the BlockOutput of a finished task"""
+    output_file = open_output_file(task.chunk_file, OUTPUT_DIR, output_format)
+    write_block_output(output, output_file, os.path.basename(task.chunk_file), BASE_DIR, failure_writer)
+    profile_report.add(output.profile)
+    logger.info(f"Task {os.path.basename(task.chunk_file)} param_index [{task.param_start}, {task.param_stop}) "
+                f"init_cond_index [{task.init_cond_start}, {task.init_cond_stop}): "
+                f"{len(output.results)} rows, {len(output.failures)} failed.")
+
+def retry_rows(chunk_file, keys, engine='copasi', method='integration'):
+    """Solve the rows of some pair keys of a chunk file again (timeout retry pass)"""
+    chunk_block, par_names = load_chunk(chunk_file)
+    rows = np.flatnonzero(np.isin(pair_keys(chunk_block.param_index, chunk_block.init_cond_index), keys))
+    return solve_block(take_rows(chunk_block, rows), par_names, engine, method)
+
+def rescue_rows(chunk_file, keys, rung_time=60.0):
+    """Run the rescue ladder (solve_steadystate_rescue) on the rows of some pair
+    keys of a chunk file. Returns a BlockOutput with only the rescued rows, and
+    the rung that solved them as their path.
+    """
+    chunk_block, par_names = load_chunk(chunk_file)
+    rows = np.flatnonzero(np.isin(pair_keys(chunk_block.param_index, chunk_block.init_cond_index), keys))
+    block = take_rows(chunk_block, rows)
+    native_model = load_native_model()
+    rescue = solve_steadystate_rescue(native_model, native_model.parameter_array(par_names, block.param_values),
+                                      native_model.initial_state(block.init_cond_values), rung_time=rung_time)
+    steady_states = np.round(native_model.totals(rescue.y), 1)
+    results, paths = [], []
+    for i in np.flatnonzero(rescue.rung != RESCUE_NONE):
+        result = {'param_index': block.param_index[i], 'init_cond_index': block.init_cond_index[i]}
+        result.update(zip(steady_state_species_names, steady_states[i]))
+        results.append(result)
+        paths.append((block.param_index[i], block.init_cond_index[i], rescue_names[rescue.rung[i]],
+                      rescue.newton_iterations[i], rescue.steps[i]))
+    return BlockOutput(results, [STATUS_FOUND] * len(results), [], paths, [])
+
+def rerun_jobs(chunk_files, keys, rows_per_task):
+    """(chunk file, pair keys) jobs for the rows of keys, at most rows_per_task rows each"""
+    jobs = []
+    for chunk_file in sorted(chunk_files):
+        index = read_chunk(chunk_file, usecols=['param_index', 'init_cond_index'], dtype=np.int64)
+        chunk_keys = np.intersect1d(pair_keys(index['param_index'], index['init_cond_index']), keys)
+        jobs += [(chunk_file, chunk_keys[i:i + rows_per_task]) for i in range(0, len(chunk_keys), rows_per_task)]
+    return jobs
+
+def replace_rerun_output(jobs, outputs, keys, OUTPUT_DIR, BASE_DIR, output_format, name):
+    """Write the BlockOutputs of rows solved again over their first results:
+    result rows replaced in place, paths appended to diagnostics/, and the
+    failures of keys replaced by the new failures. Results go first, so if
+    this stops half way the rows are still listed as failed.
+    Returns the FailureWriter of the new failures.
+    """
+    by_chunk = {}
+    for (chunk_file, _), output in zip(jobs, outputs):
+        by_chunk.setdefault(chunk_file, []).append(output)
+    new_failures = []
+    for chunk_file, chunk_outputs in by_chunk.items():
+        chunk_file_name = os.path.basename(chunk_file)
+        results = [result for output in chunk_outputs for result in output.results]
+        paths = [path for output in chunk_outputs for path in output.paths]
+        new_failures += [failure for output in chunk_outputs for failure in output.failures]
+        if paths:
+            append_csv_rows(os.path.join(BASE_DIR, 'diagnostics', f'paths_{chunk_file_name}'), path_headers, paths)
+        if not results:
+            continue
+        if output_format == 'parquet':
+            steady_states = [[np.nan if result[s] == 'NA' else result[s] for s in steady_state_species_names]
+                             for result in results]
+            result_store.replace_results(os.path.join(OUTPUT_DIR, 'results.parquet'), f'{name}_{chunk_file_name}',
+                                         [result['param_index'] for result in results],
+                                         [result['init_cond_index'] for result in results], steady_states,
+                                         [code for output in chunk_outputs for code in output.status])
+        else:
+            replace_csv_rows(os.path.join(OUTPUT_DIR, f'results_{chunk_file_name}'), csv_text(results, headers))
+    drop_failures(BASE_DIR, keys)
+    failure_writer = FailureWriter(BASE_DIR)
+    failure_writer.put(new_failures)
+    return failure_writer
+
+def failed_keys(BASE_DIR, failure_class=None):
+    """Pair keys of the rows in failures.csv (only of one failure class if given)"""
+    if not os.path.exists(os.path.join(BASE_DIR, 'failures.csv')):
+        return np.empty(0, dtype=np.int64)
+    failures = load_failures(BASE_DIR)
+    if failure_class is not None:
+        failures = failures[failures['failure_class'] == failure_class]
+    return np.unique(pair_keys(failures['param_index'], failures['init_cond_index']))
+
+def retry_timeouts(chunk_files, OUTPUT_DIR, BASE_DIR, engine, method, nprox, output_format, initializer,
+                   rows_per_task=None):
+    """Low-priority pass over the rows of failures.csv that timed out: solve them
+    again (with the budget and niceness set by initializer) and replace their
+    rows in the results, failures.csv and failed_indices.txt. Rows that time
+    out again keep a timeout failure.
+    """
+    keys = failed_keys(BASE_DIR, 'timeout')
+    if not len(keys):
+        logger.info("Timeout retry: no timed-out rows.")
+        return
+    jobs = rerun_jobs(chunk_files, keys, rows_per_task or (5000 if engine == 'native' else 50))
+    logger.info(f"Timeout retry: {len(keys)} rows in {len(jobs)} tasks.")
+    with Pool(processes=nprox, initializer=initializer) as pool:
+        outputs = pool.starmap(retry_rows, [(chunk_file, chunk_keys, engine, method) for chunk_file, chunk_keys in jobs])
+    failure_writer = replace_rerun_output(jobs, outputs, keys, OUTPUT_DIR, BASE_DIR, output_format, 'retry')
+    n_failed = sum(failure_writer.counts.values())
+    logger.info(f"Timeout retry: {len(keys) - n_failed} of {len(keys)} rows solved, "
+                f"{failure_writer.counts.get('timeout', 0)} timed out again, failures: {failure_writer.counts}")
+
+def rescue_failures(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, output_format, rung_time=60.0, rows_per_task=200):
+    """Second pass over every row of failures.csv with the rescue ladder of the
+    native engine (tighter tolerances, longer horizon, LSODA, Newton polish;
+    see solve_steadystate_rescue). Rescued rows replace their 'NA' rows and
+    their failures are dropped; the rung that solved them is appended to
+    diagnostics/paths_<chunk> as their path. The other failures stay as they are.
+    """
+    keys = failed_keys(BASE_DIR)
+    if not len(keys):
+        logger.info("Rescue: no failed rows.")
+        return
+    jobs = rerun_jobs(chunk_files, keys, rows_per_task)
+    logger.info(f"Rescue: {len(keys)} failed rows in {len(jobs)} tasks.")
+    with Pool(processes=nprox) as pool:
+        outputs = pool.starmap(rescue_rows, [(chunk_file, chunk_keys, rung_time) for chunk_file, chunk_keys in jobs])
+    rescued = [(result['param_index'], result['init_cond_index']) for output in outputs for result in output.results]
+    rescued_keys = pair_keys([r[0] for r in rescued], [r[1] for r in rescued])
+    replace_rerun_output(jobs, outputs, rescued_keys, OUTPUT_DIR, BASE_DIR, output_format, 'rescue')
+    by_rung = {}
+    for output in outputs:
+        for path in output.paths:
+            by_rung[path[2]] = by_rung.get(path[2], 0) + 1
+    logger.info(f"Rescue: {len(rescued)} of {len(keys)} failed rows rescued ({by_rung}), "
+                f"{len(np.unique(key_param_index(keys)))} param_index values had failures, "
+                f"{len(np.setdiff1d(key_param_index(keys), key_param_index(failed_keys(BASE_DIR))))} "
+                f"of them have none left.")
+
+def stored_results(chunk_file, OUTPUT_DIR, output_format='csv'):
+    """Result rows of one chunk file as a DataFrame, one per pair (the last
+    one written), with NaN totals for failed rows
+    """
+    chunk_block, _ = load_chunk(chunk_file)
+    if output_format == 'parquet':
+        results = result_store.load_results(os.path.join(OUTPUT_DIR, 'results.parquet'),
+                                            (chunk_block.param_index.min(), chunk_block.param_index.max() + 1))
+        return results[np.isin(pair_keys(results['param_index'], results['init_cond_index']),
+                               pair_keys(chunk_block.param_index, chunk_block.init_cond_index))]
+    results = pd.read_csv(os.path.join(OUTPUT_DIR, f'results_{os.path.basename(chunk_file)}'))
+    return results.drop_duplicates(['param_index', 'init_cond_index'], keep='last')
+
+def stored_steady_states(chunk_file, OUTPUT_DIR, output_format='csv'):
+    """Solved rows of one chunk file in the results: param_index,
+    init_cond_index and the 5 totals, without the 'NA' rows
+    """
+    results = stored_results(chunk_file, OUTPUT_DIR, output_format).dropna(subset=steady_state_species_names)
+    return (results['param_index'].to_numpy(np.int64), results['init_cond_index'].to_numpy(np.int64),
+            results[steady_state_species_names].to_numpy(float))
+
+def chunk_rows(chunk_block, param_index, init_cond_index):
+    """Row of chunk_block of every (param_index, init_cond_index) pair, e.g. of result rows"""
+    chunk_keys = pair_keys(chunk_block.param_index, chunk_block.init_cond_index)
+    order = np.argsort(chunk_keys)
+    return order[np.searchsorted(chunk_keys, pair_keys(param_index, init_cond_index), sorter=order)]
+
+def rebuilt_steady_states(chunk_file, OUTPUT_DIR, output_format='csv', block_size=2000):
+    """Stored steady states of one chunk file, sorted by pair, with their full
+    states rebuilt from the totals (see ap1_stability.py), in blocks of
+    block_size rows; yields (param_index, init_cond_index, p, StabilityResult)
+    """
+    chunk_block, par_names = load_chunk(chunk_file)
+    param_index, init_cond_index, totals = stored_steady_states(chunk_file, OUTPUT_DIR, output_format)
+    by_pair = np.argsort(pair_keys(param_index, init_cond_index))
+    param_index, init_cond_index, totals = param_index[by_pair], init_cond_index[by_pair], totals[by_pair]
+    rows = chunk_rows(chunk_block, param_index, init_cond_index)
+    native_model = load_native_model()
+    for start in range(0, len(rows), block_size):
+        lanes = slice(start, start + block_size)
+        p = native_model.parameter_array(par_names, chunk_block.param_values[rows[lanes]])
+        yield param_index[lanes], init_cond_index[lanes], p, steady_state_stability(native_model, p, totals[lanes])
+
+def stability_rows(chunk_file, OUTPUT_DIR, output_format='csv'):
+    """Jacobian eigenvalue summary of every stored steady state of one chunk
+    file; returns the rows of diagnostics/stability_<chunk> and the number
+    of unresolved rows
+    """
+    stability, n_unresolved = [], 0
+    for param_index, init_cond_index, _, result in rebuilt_steady_states(chunk_file, OUTPUT_DIR, output_format):
+        n_unresolved += int(np.sum(~result.resolved))
+        for i, resolved in enumerate(result.resolved):
+            if resolved:
+                stability.append([param_index[i], init_cond_index[i], f'{result.max_real_eigenvalue[i]:.6g}',
+                                  int(result.stable[i]), f'{result.slowest_timescale[i]:.6g}'])
+            else:
+                stability.append([param_index[i], init_cond_index[i], 'NA', 'NA', 'NA'])
+    return stability, n_unresolved
+
+def sensitivity_rows(chunk_file, OUTPUT_DIR, output_format='csv'):
+    """d totals / d parameter for the LHS parameters of every stored steady
+    state of one chunk file (see ap1_sensitivity.py), NaN where the full
+    state could not be rebuilt; returns the table and the number of such rows
+    """
+    _, par_names = load_chunk(chunk_file)
+    native_model = load_native_model()
+    columns = [native_model.parameter_index[name] for name in par_names]
+    frames, n_unresolved = [], 0
+    for param_index, init_cond_index, p, result in rebuilt_steady_states(chunk_file, OUTPUT_DIR, output_format):
+        sensitivities = np.full((len(param_index), len(steady_state_species_names), len(columns)), np.nan)
+        resolved = result.resolved
+        sensitivities[resolved] = steady_state_sensitivities(native_model, p[resolved], result.y[resolved], columns)
+        n_unresolved += int(np.sum(~resolved))
+        frames.append(sensitivity_frame(param_index, init_cond_index, sensitivities, par_names))
+    if not frames:
+        frames.append(sensitivity_frame([], [], np.empty((0, len(steady_state_species_names), len(columns))),
+                                        par_names))
+    return pd.concat(frames, ignore_index=True), n_unresolved
+
+def stability_pass(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, output_format='csv'):
+    """Post-processing stage: classify every stored steady state as stable or
+    unstable from its Jacobian eigenvalues and write
+    diagnostics/stability_<chunk> (param_index, init_cond_index,
+    max_real_eigenvalue, stable, slowest_timescale; 'NA' where the full state
+    could not be rebuilt from the stored totals)
+    """
+    chunk_files = sorted(chunk_files)
+    with Pool(processes=nprox) as pool:
+        outputs = pool.starmap(stability_rows, [(chunk_file, OUTPUT_DIR, output_format) for chunk_file in chunk_files])
+    n_rows = n_unstable = n_unresolved = 0
+    for chunk_file, (stability, unresolved) in zip(chunk_files, outputs):
+        write_atomic(os.path.join(BASE_DIR, 'diagnostics', f'stability_{os.path.basename(chunk_file)}'),
+                     csv_text([stability_headers] + stability))
+        n_rows += len(stability)
+        n_unstable += sum(row[3] == 0 for row in stability)
+        n_unresolved += unresolved
+    logger.info(f"Stability: {n_rows} steady states, {n_unstable} unstable, {n_unresolved} not resolved "
+                f"from their totals.")
+
+def sensitivity_pass(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, output_format='csv'):
+    """Post-processing stage: local sensitivities d<total>/d<parameter> of every
+    stored steady state to the 15 LHS parameters by the implicit function
+    theorem, written to BASE_DIR/sensitivities/<chunk>.parquet
+    """
+    chunk_files = sorted(chunk_files)
+    with Pool(processes=nprox) as pool:
+        outputs = pool.starmap(sensitivity_rows, [(chunk_file, OUTPUT_DIR, output_format)
+                                                  for chunk_file in chunk_files])
+    n_rows = n_unresolved = 0
+    for chunk_file, (data, unresolved) in zip(chunk_files, outputs):
+        write_sensitivities(os.path.join(BASE_DIR, 'sensitivities'), os.path.splitext(os.path.basename(chunk_file))[0],
+                            data)
+        n_rows += len(data)
+        n_unresolved += unresolved
+    logger.info(f"Sensitivities: {n_rows} steady states, {n_unresolved} not resolved from their totals.")
+
+def run_continuation_task(task, OUTPUT_DIR, output_format, continuation_params, fold_params, max_points=500):
+    """Continuation of the stored steady states of the param_index values of
+    one SimTask (see ap1_continuation.py): every distinct steady state is
+    traced in every parameter of continuation_params over its sampled range,
+    the folds on the branches are refined, and every fold is traced in two
+    parameters with each of fold_params. Returns the tables for
+    write_continuation, or None if the task has no stored steady states.
+    """
+    chunk_block, par_names = load_chunk(task.chunk_file)
+    param_index, init_cond_index, totals = stored_steady_states(task.chunk_file, OUTPUT_DIR, output_format)
+    in_task = np.flatnonzero((param_index >= task.param_start) & (param_index < task.param_stop))
+    # one start per distinct steady state, numbered by param_index and totals
+    _, first = np.unique(np.column_stack([param_index[in_task], totals[in_task]]), axis=0, return_index=True)
+    starts = in_task[first]
+    if not starts.size:
+        return None
+    state = np.concatenate([np.arange(n) for n in np.unique(param_index[starts], return_counts=True)[1]])
+
+    native_model = load_native_model()
+    p = native_model.parameter_array(par_names, chunk_block.param_values[
+        chunk_rows(chunk_block, param_index[starts], init_cond_index[starts])])
+    stability = steady_state_stability(native_model, p, totals[starts])
+    resolved = np.flatnonzero(stability.resolved)
+    names = continuation_params or par_names
+    columns = np.array([native_model.parameter_index[name] for name in names])
+    start = np.repeat(resolved, len(names))
+    continued = np.tile(np.arange(len(names)), len(resolved))
+    branches = continue_branches(native_model, p[start], stability.y[start], columns[continued],
+                                 param_bounds(names)[continued], max_points=max_points)
+    folds = locate_folds(native_model, p[start], columns[continued], branches)
+    lane_info = (param_index[starts][start], state[start], np.array(names)[continued])
+    tables = {'branches': branch_frame(native_model, branches, *lane_info),
+              'folds': fold_frame(native_model, folds, *lane_info)}
+
+    # every converged fold with every other parameter of fold_params
+    pairs = [(i, name) for i in np.flatnonzero(folds.converged) for name in fold_params or []
+             if name != names[continued[folds.lane[i]]]]
+    if pairs:
+        fold_index = np.array([i for i, _ in pairs])
+        second = [name for _, name in pairs]
+        lane = folds.lane[fold_index]
+        p_fold = p[start[lane]]
+        p_fold[np.arange(len(lane)), columns[continued[lane]]] = folds.value[fold_index]
+        fold_columns = np.stack([columns[continued[lane]], [native_model.parameter_index[name] for name in second]],
+                                axis=-1)
+        bounds = np.stack([param_bounds(names)[continued[lane]], param_bounds(second)], axis=1)
+        curves = continue_folds(native_model, p_fold, folds.y[fold_index], fold_columns, bounds,
+                                max_points=max_points)
+        tables['fold_curves'] = fold_curve_frame(native_model, curves, *(info[lane] for info in lane_info),
+                                                 np.array(second))
+    return tables
+
+def run_continuation(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, output_format, task_params, continuation_params,
+                     fold_params, max_points, resume):
+    """Continuation mode: branches, folds and fold curves of the stored steady
+    states on the dynamic schedule, one Parquet part per task in
+    BASE_DIR/continuation/; with resume, tasks that already have their
+    branches part are skipped
+    """
+    CONTINUATION_DIR = os.path.join(BASE_DIR, 'continuation')
+    tasks = make_tasks(sorted(chunk_files), task_params)
+    if resume:
+        tasks = [task for task in tasks if not os.path.exists(os.path.join(
+            CONTINUATION_DIR, 'branches', f'{part_name(task.chunk_file, task.param_start, 0)}.parquet'))]
+    logger.info(f"Continuation: {len(tasks)} tasks on {nprox} workers.")
+
+    def on_result(task, tables):
+        if tables is None:
+            return
+        write_continuation(CONTINUATION_DIR, part_name(task.chunk_file, task.param_start, 0), tables)
+        n_curves = tables['fold_curves'][['param_index', 'state', 'parameter', 'parameter2']].drop_duplicates().shape[0] \
+            if 'fold_curves' in tables else 0
+        logger.info(f"Continuation {os.path.basename(task.chunk_file)} param_index [{task.param_start}, "
+                    f"{task.param_stop}): {len(tables['branches'])} branch points, {len(tables['folds'])} folds, "
+                    f"{n_curves} fold curves.")
+
+    report = run_dynamic(partial(run_continuation_task, OUTPUT_DIR=OUTPUT_DIR, output_format=output_format,
+                                 continuation_params=continuation_params, fold_params=fold_params,
+                                 max_points=max_points),
+                         tasks, nprox, on_result, initializer=partial(init_worker, None))
+    log_schedule_report(report, logger, os.path.join(BASE_DIR, 'diagnostics', 'worker_utilization.csv'))
+
+def run_timecourse_task(task, t_grid, block_size=2000):
+    """Time courses of the rows of one SimTask with the native engine, in
+    blocks of block_size lanes; returns (param_index, init_cond_index, TimecourseResult)
+    """
+    chunk_block, par_names = load_chunk(task.chunk_file)
+    rows = np.flatnonzero((chunk_block.param_index >= task.param_start) & (chunk_block.param_index < task.param_stop)
+                          & (chunk_block.init_cond_index >= task.init_cond_start)
+                          & (chunk_block.init_cond_index < task.init_cond_stop))
+    block = take_rows(chunk_block, rows)
+    native_model = load_native_model()
+    results = []
+    for start in range(0, len(rows), block_size):
+        lanes = slice(start, start + block_size)
+        results.append(integrate_timecourse_batch(
+            native_model, native_model.parameter_array(par_names, block.param_values[lanes]),
+            native_model.initial_state(block.init_cond_values[lanes]), t_grid, max_steps=sim_budget.steps))
+    totals = np.concatenate([result.totals for result in results])
+    status = np.concatenate([result.status for result in results])
+    steps = np.concatenate([result.steps for result in results])
+    return block.param_index, block.init_cond_index, results[0]._replace(totals=totals, status=status, steps=steps)
+
+def run_timecourses(chunk_files, BASE_DIR, nprox, t_grid, task_params, task_init_conds, resume, initializer):
+    """Time-course mode: integrate every row over t_grid with the native engine
+    on the dynamic schedule and stream every task to BASE_DIR/timecourse/ as
+    one Parquet part (see ap1_timecourse.py); with resume, tasks that already
+    have their part are skipped
+    """
+    TIMECOURSE_DIR = os.path.join(BASE_DIR, 'timecourse')
+    tasks = make_tasks(sorted(chunk_files), task_params, task_init_conds)
+    if resume:
+        tasks = [task for task in tasks if not os.path.exists(
+            os.path.join(TIMECOURSE_DIR, f'{part_name(task.chunk_file, task.param_start, task.init_cond_start)}.parquet'))]
+    logger.info(f"Time courses: {len(tasks)} tasks on {nprox} workers, {len(t_grid)} output times up to "
+                f"t = {t_grid[-1]:g}.")
+
+    def on_result(task, output):
+        param_index, init_cond_index, result = output
+        write_timecourse(TIMECOURSE_DIR, part_name(task.chunk_file, task.param_start, task.init_cond_start),
+                         param_index, init_cond_index, result)
+        n_settled = int(np.sum(result.status == STATUS_FOUND))
+        logger.info(f"Time courses {os.path.basename(task.chunk_file)} param_index [{task.param_start}, "
+                    f"{task.param_stop}): {len(param_index)} rows, {n_settled} settled before the end.")
+
+    report = run_dynamic(partial(run_timecourse_task, t_grid=t_grid), tasks, nprox, on_result,
+                         initializer=initializer)
+    log_schedule_report(report, logger, os.path.join(BASE_DIR, 'diagnostics', 'worker_utilization.csv'))
+
+def write_profile(diagnostics_dir):
+    """Write the phase timers of the run (profile.json, profile.folded) and log
+    where the sampled time went
+    """
+    report = profile_report.write(diagnostics_dir)
+    for name, phase in sorted(report['phases'].items(), key=lambda item: -item[1]['estimated_total_s']):
+        logger.info(f"Profile {name}: {phase['mean_us']:.1f} us per row, {100 * phase['share']:.1f}% of the row, "
+                    f"~{phase['estimated_total_s']:.1f} s in total.")
+    logger.info(f"Wrote the phase profile to {diagnostics_dir}/profile.json and profile.folded.")
+
+def repair_node_dir(chunk_files, NODE_DIR, output_format='csv'):
+    """prepare_resume for the output of one node directory"""
+    prepare_resume(chunk_files, os.path.join(NODE_DIR, 'output'), NODE_DIR, output_format)
+
+def run_node(chunk_files, INPUT_DIR, BASE_DIR, node_id, nprox, engine, method, ic_patience, task_params,
+             task_init_conds, output_format, lease_timeout, initializer, screen=None):
+    """One node of a distributed run (see distributed.py): claim tasks from the
+    BASE_DIR/ledger as workers free up, write to BASE_DIR/nodes/<node_id>/ and
+    mark them done; wait for the other nodes (taking over tasks of nodes that
+    stopped) and merge the node outputs if this node sees the last task done
+    Returns True if this node merged the outputs.
+    """
+    NODE_DIR = node_dir(BASE_DIR, node_id)
+    NODE_OUTPUT_DIR = os.path.join(NODE_DIR, 'output')
+    os.makedirs(NODE_OUTPUT_DIR, exist_ok=True)
+    os.makedirs(os.path.join(NODE_DIR, 'diagnostics'), exist_ok=True)
+    # the same checkpoint repair as on resume, for the files of a node that was
+    # stopped mid-write: appended to here, and merged by one node at the end
+    repair_node = partial(repair_node_dir, chunk_files, output_format=output_format)
+    repair_node(NODE_DIR)
+
+    ledger = TaskLedger(os.path.join(BASE_DIR, 'ledger'), node_id, lease_timeout)
+    # only the first node needs to read the chunk files to make the tasks
+    tasks = [] if os.path.exists(ledger.tasks_file) else screened_tasks(sorted(chunk_files), task_params,
+                                                                        task_init_conds, by_param=bool(ic_patience),
+                                                                        BASE_DIR=BASE_DIR, screen=screen)
+    tasks = ledger.publish(tasks, INPUT_DIR, SimTask)
+    logger.info(f"Node {node_id}: {len(tasks)} tasks in the ledger, {ledger.n_done()} done, {nprox} workers.")
+
+    failure_writer = FailureWriter(NODE_DIR)
+
+    def on_result(claimed, output):
+        task_id, task = claimed
+        write_task_output(task, output, NODE_OUTPUT_DIR, NODE_DIR, failure_writer, output_format)
+        ledger.complete(task_id)
+
+    ledger.start_heartbeat()
+    while True:
+        # the pool is only started when there is a task to run
+        claimed = ledger.claim()
+        if claimed is None:
+            if ledger.all_done():
+                break
+            time.sleep(min(10.0, lease_timeout / 4))
+            continue
+        report = run_dynamic(partial(run_claimed_task, engine=engine, method=method, ic_patience=ic_patience),
+                             chain([claimed], ledger.claims()), nprox, on_result, initializer=initializer)
+        log_schedule_report(report, logger, os.path.join(NODE_DIR, 'diagnostics', 'worker_utilization.csv'))
+    ledger.stop_heartbeat()
+    logger.info(f"Node {node_id}: all {len(tasks)} tasks done. Failures by class: {failure_writer.counts}")
+    if profile_report.workers:
+        write_profile(os.path.join(NODE_DIR, 'diagnostics'))
+
+    merged_file = os.path.join(ledger.ledger_dir, 'merged')
+    if os.path.exists(merged_file):
+        return False
+    if not ledger.try_lock('merge'):
+        logger.info(f"Node {node_id}: another node is merging (remove {ledger.ledger_dir}/merge.lock if it was stopped).")
+        return False
+    merged = merge_node_outputs(BASE_DIR, repair_node)
+    with open(merged_file, 'w') as f:
+        f.write(ledger.owner)
+    ledger.unlock('merge')
+    logger.info(f"Node {node_id} merged the node outputs into {BASE_DIR}: {len(merged)} files.")
+    return True
+
+def run_local_nodes(n_nodes, nprox):
+    """Stand-in for a multi-node job on one machine: run this script with the
+    same arguments as n_nodes --distributed processes, nprox // n_nodes workers each
+    """
+    argv, skip = [], False
+    for arg in sys.argv[1:]:
+        if skip or arg.startswith('--local-nodes'):
+            skip = arg == '--local-nodes'
+            continue
+        argv.append(arg)
+    env = dict(os.environ, SLURM_NPROCS=str(max(1, nprox // n_nodes)))
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv
+                                  + ['--distributed', '--node-id', f'local{i}'], env=env)
+                 for i in range(n_nodes)]
+    return [process.wait() for process in processes]
 
 if __name__ == '__main__':
 
     #INPUT_DIR = '/scratch/njr7jk/ap1_hpc/input'
     #OUTPUT_DIR = '/scratch/njr7jk/ap1_hpc/output'
-    BASE_DIR = sys.argv[1]
-    # Set up logging
-    logger = setup_logging(BASE_DIR)
+    parser = argparse.ArgumentParser(description="Run AP-1 steady state simulations for the LHS chunk files.")
+    parser.add_argument('base_dir', help="directory with the input/ folder of chunk files")
+    parser.add_argument('--mode', choices=['steadystate', 'timecourse', 'continuation'], default='steadystate',
+                        help="steadystate: one steady state per row; timecourse: trajectories of every row on an "
+                             "output grid (native engine, dynamic schedule), written to BASE_DIR/timecourse/; "
+                             "continuation: branches and folds of the stored steady states in the LHS parameters, "
+                             "written to BASE_DIR/continuation/")
+    parser.add_argument('--t-end', type=float, default=1e5,
+                        help="timecourse: last output time")
+    parser.add_argument('--n-points', type=int, default=100,
+                        help="timecourse: output times per row after t = 0")
+    parser.add_argument('--grid', choices=['log', 'linear'], default='log',
+                        help="timecourse: log-spaced output times from 0.01, or evenly spaced ones")
+    parser.add_argument('--continuation-params', nargs='+', default=None,
+                        help="continuation: parameters to continue in (default: the 15 LHS parameters)")
+    parser.add_argument('--fold-params', nargs='+', default=None,
+                        help="continuation: trace every fold in two parameters, its own and each of these")
+    parser.add_argument('--max-points', type=int, default=500,
+                        help="continuation: points per branch or fold curve and direction")
+    parser.add_argument('--engine', choices=['copasi', 'native'], default='copasi',
+                        help="copasi: one basico steady state per row; native: batched NumPy solver")
+    parser.add_argument('--method', choices=['integration', 'hybrid'], default='integration',
+                        help="native engine only. integration: integrate every row to steady state; "
+                             "hybrid: short integration, damped Newton, long integration only where Newton fails")
+    parser.add_argument('--ic-patience', type=int, default=None,
+                        help="adaptive initial conditions: stop a param_index after this many initial conditions "
+                             "in a row without a new steady state (default: run all initial conditions)")
+    parser.add_argument('--schedule', choices=['chunks', 'dynamic'], default='chunks',
+                        help="chunks: one chunk file per worker task; dynamic: small (param_index x initial "
+                             "condition) tasks handed to idle workers, with stragglers re-issued at the end")
+    parser.add_argument('--task-params', type=int, default=None,
+                        help="dynamic schedule: param_index values per task (default 5 for copasi, 50 for native)")
+    parser.add_argument('--task-init-conds', type=int, default=None,
+                        help="dynamic schedule: initial conditions per task (default 50 for copasi, all for "
+                             "native; always all with --ic-patience)")
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted run: skip (param_index, init_cond_index) pairs already "
+                             "in the results files")
+    parser.add_argument('--output-format', choices=['csv', 'parquet'], default='csv',
+                        help="csv: results_<chunk>.csv files as read by 02_process_LHS_simulations; parquet: one "
+                             "typed dataset output/results.parquet with a status column (see result_store.py)")
+    parser.add_argument('--distributed', action='store_true',
+                        help="run as one node of a multi-node job: dynamic schedule with tasks claimed from "
+                             "BASE_DIR/ledger, shared by all nodes (see distributed.py); reruns continue the ledger")
+    parser.add_argument('--node-id', default=None,
+                        help="distributed: name of this node (default: node<SLURM_ARRAY_TASK_ID or SLURM_PROCID>)")
+    parser.add_argument('--lease-timeout', type=float, default=900.0,
+                        help="distributed: seconds without a heartbeat before the tasks of a node are taken over")
+    parser.add_argument('--local-nodes', type=int, default=None,
+                        help="run the distributed mode with this many node processes on this machine, "
+                             "sharing SLURM_NPROCS workers")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="seconds per simulation before it is stopped as a timeout (status 6); copasi: checked "
+                             "between COPASI's integration stages, and a solve stuck past twice the budget has "
+                             "its COPASI process killed and replaced; native: for the whole block of rows solved "
+                             "together (default: no limit)")
+    parser.add_argument('--step-budget', type=int, default=5000,
+                        help="integration steps before a simulation is stopped as a timeout; native: per "
+                             "simulation, copasi: per DLSODA call (Max Internal Steps)")
+    parser.add_argument('--max-duration', type=float, default=None,
+                        help="copasi: model time of the steady state forward integration (default: the "
+                             "model file's setting)")
+    parser.add_argument('--retry-timeouts', action='store_true',
+                        help="after the run, solve the timed-out rows again in a low-priority pass with "
+                             "--retry-budget-factor times the budget and replace their rows "
+                             "(with --resume on a finished run: only this pass)")
+    parser.add_argument('--retry-budget-factor', type=float, default=10.0,
+                        help="budget of the timeout retry pass, relative to --time-budget, --step-budget and "
+                             "--max-duration")
+    parser.add_argument('--rescue-failures', action='store_true',
+                        help="after the run (and the timeout retry), try every failed row again with tighter "
+                             "tolerances, a longer horizon, LSODA and a Newton polish (native model for both "
+                             "engines) and replace the rescued rows; the rung used is written to "
+                             "diagnostics/paths_<chunk> (with --resume on a finished run: only this pass)")
+    parser.add_argument('--rescue-rung-time', type=float, default=60.0,
+                        help="seconds per rescue rung and task of rows")
+    parser.add_argument('--stability', action='store_true',
+                        help="after the run, classify every steady state by its Jacobian eigenvalues into "
+                             "diagnostics/stability_<chunk> (with --resume on a finished run: only this pass)")
+    parser.add_argument('--sensitivities', action='store_true',
+                        help="after the run, write d(total)/d(parameter) of every steady state for the LHS "
+                             "parameters to BASE_DIR/sensitivities/ (with --resume on a finished run: only this pass)")
+    parser.add_argument('--profile', type=int, default=None, metavar='N',
+                        help="time the phases of every Nth row (COPASI) or native block and write "
+                             "diagnostics/profile.json and profile.folded (flame graph stacks)")
+    parser.add_argument('--screen', choices=['skip', 'deprioritize'], default=None,
+                        help="apply the surrogate screen of ap1_surrogate.py (BASE_DIR/screen/): leave the "
+                             "parameter sets it rules out out of the run, or run them last (dynamic schedule)")
+    args = parser.parse_args()
+    BASE_DIR = args.base_dir
+    node_id = (args.node_id or default_node_id()) if args.distributed else None
+    # Set up logging; every node logs to its own directory
+    log_dir = node_dir(BASE_DIR, node_id) if args.distributed else BASE_DIR
+    os.makedirs(log_dir, exist_ok=True)
+    logger = setup_logging(log_dir)
 
     INPUT_DIR = os.path.join(BASE_DIR, 'input')
     OUTPUT_DIR = os.path.join(BASE_DIR, 'output')
 
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
+    os.makedirs(os.path.join(BASE_DIR, 'diagnostics'), exist_ok=True)
 
-    chunk_files = [os.path.join(INPUT_DIR, f) for f in os.listdir(INPUT_DIR) if f.startswith('chunk_')]
+    # chunk CSVs, or the chunks of an index-pair design (pair_design.py)
+    chunk_files = list_chunk_files(INPUT_DIR)
     #chunk_files = chunk_files[:2] # For testing purposes
     nprox = int(os.getenv('SLURM_NPROCS'))
 
-    # Create a multiprocessing Pool
-    with Pool(processes=nprox) as pool:
-        pool.starmap(process_chunk, [(chunk, OUTPUT_DIR, BASE_DIR) for chunk in chunk_files])
+    # COPASI workers load the model once, in the pool initializer, which also
+    # sets the simulation budget
+    cps_file = COPASI_MODEL_FILE if args.engine == 'copasi' else None
+    budget = SimBudget(args.time_budget, args.step_budget, args.max_duration)
+    initializer = partial(init_worker, cps_file, budget, profile_every=args.profile or 0)
+    factor = args.retry_budget_factor
+    retry_budget = SimBudget(None if budget.time_s is None else budget.time_s * factor, int(budget.steps * factor),
+                             None if budget.duration is None else budget.duration * factor)
+    retry_initializer = partial(init_worker, cps_file, retry_budget, 19)
+    task_params = args.task_params or (50 if args.engine == 'native' else 5)
+    task_init_conds = args.task_init_conds or (None if args.engine == 'native' else 50)
+    if args.mode == 'timecourse':
+        if args.engine != 'native':
+            logger.info("Time courses are integrated with the native engine.")
+        # --step-budget covers the whole grid of a row; rows that still oscillate
+        # at the end of it are written with status 6
+        run_timecourses(chunk_files, BASE_DIR, nprox, output_grid(args.t_end, args.n_points, args.grid),
+                        task_params, task_init_conds, args.resume, partial(init_worker, None, budget))
+        logger.info("Script completed.")
+        sys.exit(0)
+    if args.mode == 'continuation':
+        run_continuation(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, args.output_format, args.task_params or 50,
+                         args.continuation_params, args.fold_params, args.max_points, args.resume)
+        logger.info("Script completed.")
+        sys.exit(0)
+    if args.local_nodes:
+        logger.info(f"Starting {args.local_nodes} local nodes.")
+        return_codes = run_local_nodes(args.local_nodes, nprox)
+        logger.info(f"Local nodes finished with return codes {return_codes}.")
+        # a stopped node is fine as long as the others finished its tasks
+        sys.exit(0 if os.path.exists(os.path.join(BASE_DIR, 'ledger', 'merged')) else 1)
+    if args.distributed:
+        merged = run_node(chunk_files, INPUT_DIR, BASE_DIR, node_id, nprox, args.engine, args.method,
+                          args.ic_patience, task_params, None if args.ic_patience else task_init_conds,
+                          args.output_format, args.lease_timeout, initializer, args.screen)
+        # the node that merged retries on the merged files
+        if merged and args.retry_timeouts:
+            retry_timeouts(chunk_files, OUTPUT_DIR, BASE_DIR, args.engine, args.method, nprox, args.output_format,
+                           retry_initializer)
+        if merged and args.rescue_failures:
+            rescue_failures(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, args.output_format, args.rescue_rung_time)
+        if merged and args.stability:
+            stability_pass(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, args.output_format)
+        if merged and args.sensitivities:
+            sensitivity_pass(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, args.output_format)
+        logger.info("Script completed.")
+        sys.exit(0)
+
+    committed = None
+    if args.resume:
+        committed = prepare_resume(chunk_files, OUTPUT_DIR, BASE_DIR, args.output_format)
+    elif (result_store.part_files(os.path.join(OUTPUT_DIR, 'results.parquet')) if args.output_format == 'parquet'
+          else any(os.path.exists(os.path.join(OUTPUT_DIR, f'results_{os.path.basename(f)}')) for f in chunk_files)):
+        logger.warning("Results files already exist and new rows are appended to them; use --resume to skip "
+                       "the rows that are already done.")
+
+    # all failures are written by this process: FailureWriter
+    if args.schedule == 'dynamic':
+        failure_writer = FailureWriter(BASE_DIR)
+        tasks = screened_tasks(sorted(chunk_files), task_params, None if args.ic_patience else task_init_conds,
+                               committed, bool(args.ic_patience), BASE_DIR, args.screen)
+        logger.info(f"Dynamic schedule: {len(tasks)} tasks on {nprox} workers.")
+        report = run_dynamic(partial(run_task, engine=args.engine, method=args.method, ic_patience=args.ic_patience),
+                             tasks, nprox,
+                             lambda task, output: write_task_output(task, output, OUTPUT_DIR, BASE_DIR,
+                                                                    failure_writer, args.output_format),
+                             initializer=initializer)
+        log_schedule_report(report, logger, os.path.join(BASE_DIR, 'diagnostics', 'worker_utilization.csv'))
+    else:
+        # the workers send their failures through a queue to the writer thread
+        # and wait for it to write them before committing a block
+        manager = Manager()
+        failure_writer = FailureWriter(BASE_DIR, manager.Queue()).start()
+        screened = {chunk: None for chunk in chunk_files}
+        if args.screen == 'deprioritize':
+            logger.warning("--screen deprioritize needs --schedule dynamic; every row is run.")
+        elif args.screen == 'skip':
+            screened = {chunk: screen_split(chunk, BASE_DIR)[1] for chunk in chunk_files}
+            logger.info(f"Surrogate screen: {sum(len(np.unique(key_param_index(keys))) for keys in screened.values())} "
+                        f"parameter sets ruled out, skipped.")
+        # Create a multiprocessing Pool
+        with Pool(processes=nprox, initializer=initializer) as pool:
+            chunk_profiles = pool.starmap(process_chunk, [(chunk, OUTPUT_DIR, BASE_DIR, args.engine, args.method, args.ic_patience,
+                                          args.resume, args.output_format,
+                                          failure_writer.sender(manager.Queue()),
+                                          screened[chunk])
+                                         for chunk in chunk_files])
+        failure_writer.close()
+        manager.shutdown()
+        for profile in chunk_profiles:
+            profile_report.add(profile)
+    logger.info(f"Failures by class: {failure_writer.counts}")
+    if args.profile:
+        write_profile(os.path.join(BASE_DIR, 'diagnostics'))
+
+    if args.retry_timeouts:
+        retry_timeouts(chunk_files, OUTPUT_DIR, BASE_DIR, args.engine, args.method, nprox, args.output_format,
+                       retry_initializer)
+    if args.rescue_failures:
+        rescue_failures(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, args.output_format, args.rescue_rung_time)
+    if args.stability:
+        stability_pass(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, args.output_format)
+    if args.sensitivities:
+        sensitivity_pass(chunk_files, OUTPUT_DIR, BASE_DIR, nprox, args.output_format)
+
+    if args.output_format == 'parquet':
+        result_store.compact_results(os.path.join(OUTPUT_DIR, 'results.parquet'))
+        logger.info("Compacted output/results.parquet.")
     
     logger.info("Script completed.")
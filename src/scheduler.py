@@ -0,0 +1,147 @@
+"""Dynamic task scheduling for the simulation pool.
+
+Pool.starmap over whole chunk files gives every worker a fixed share of the
+work, so a chunk full of stiff or failing parameter sets keeps one core busy
+long after the others ran out. run_dynamic cuts the run into many small tasks
+and hands them out one at a time, each to the next idle worker. With a shared
+queue and tasks of unknown cost this balances the load the way work stealing
+does, without per-worker queues.
+
+Near the end, when no task is left to start, idle workers run a second copy
+of the task that has been running longest, if it has run well over the
+typical task time (speculative execution). The copy that finishes first is
+kept and the other result is dropped, so on_result sees every task once.
+Busy time per worker is recorded to show how much of the tail is idle.
+"""
+import os
+import time
+import queue
+import csv
+from collections import namedtuple
+from multiprocessing import Pool
+import numpy as np
+
+WorkerUsage = namedtuple('WorkerUsage', ['pid', 'n_tasks', 'busy_time', 'utilization'])
+ScheduleReport = namedtuple('ScheduleReport', ['workers', 'wall_time', 'tail_time', 'n_tasks',
+                                               'n_speculative', 'n_speculative_won'])
+
+
+def _timed_call(function, task_id, task):
+    """Run one task in a worker, with the worker pid and start/end times."""
+    start = time.time()
+    result = function(task)
+    return task_id, os.getpid(), start, time.time(), result
+
+
+def run_dynamic(function, tasks, processes, on_result, initializer=None, initargs=(),
+                speculate_factor=3.0, min_speculate_time=60.0, max_copies=2, poll_interval=0.5):
+    """Run function(task) for every task on a pool of processes, feeding tasks dynamically.
+
+    function: picklable function run in the workers (e.g. a functools.partial
+        of a module-level function)
+    tasks: tasks, started in this order; any iterable, read one task at a
+        time when a worker is free (e.g. a generator claiming tasks from a
+        shared ledger, see distributed.py)
+    on_result: on_result(task, result), called in this process once per task,
+        in completion order; the only place results are written
+    speculate_factor, min_speculate_time: once all tasks have started, a
+        running task gets another copy on an idle worker after running for
+        more than speculate_factor times the median task time and at least
+        min_speculate_time seconds; max_copies copies at most
+    Returns a ScheduleReport. tail_time is the time from the last task start
+    to the end of the run, when some workers have nothing left to do.
+    """
+    finished_queue = queue.Queue()
+    task_iter = iter(tasks)
+    tasks = []  # started tasks, by task_id
+    exhausted = False
+    running = {}  # task_id: [start time of the first copy, number of copies, start of the last copy]
+    finished = set()
+    durations = []
+    busy_time, n_tasks = {}, {}
+    in_flight = 0
+    n_speculative = n_speculative_won = 0
+    run_start = time.time()
+    last_start = run_start
+
+    with Pool(processes=processes, initializer=initializer, initargs=initargs) as pool:
+
+        def submit(task_id):
+            # at most one task per worker is in flight, so it starts right away
+            pool.apply_async(_timed_call, (function, task_id, tasks[task_id]),
+                             callback=finished_queue.put, error_callback=finished_queue.put)
+
+        while not exhausted or running:
+            while not exhausted and in_flight < processes:
+                task = next(task_iter, None)
+                if task is None:
+                    exhausted = True
+                    break
+                task_id = len(tasks)
+                tasks.append(task)
+                submit(task_id)
+                running[task_id] = [time.time(), 1, None]
+                in_flight += 1
+                last_start = time.time()
+
+            if exhausted and in_flight < processes and durations:
+                now = time.time()
+                threshold = max(speculate_factor * np.median(durations), min_speculate_time)
+                stragglers = [task_id for task_id, (start, copies, _) in running.items()
+                              if copies < max_copies and now - start > threshold]
+                if stragglers:
+                    task_id = min(stragglers, key=lambda t: running[t][0])
+                    submit(task_id)
+                    running[task_id][1] += 1
+                    running[task_id][2] = time.time()
+                    in_flight += 1
+                    n_speculative += 1
+                    continue
+
+            try:
+                item = finished_queue.get(timeout=poll_interval)
+            except queue.Empty:
+                continue
+            if isinstance(item, BaseException):
+                raise item
+
+            task_id, pid, start, end, result = item
+            in_flight -= 1
+            busy_time[pid] = busy_time.get(pid, 0.0) + end - start
+            n_tasks[pid] = n_tasks.get(pid, 0) + 1
+            if task_id in finished:
+                continue
+            if running[task_id][2] is not None and start >= running[task_id][2]:
+                n_speculative_won += 1
+            finished.add(task_id)
+            durations.append(end - start)
+            del running[task_id]
+            on_result(tasks[task_id], result)
+
+        # leftover speculative copies are stopped when the pool terminates
+
+    wall_time = time.time() - run_start
+    workers = [WorkerUsage(pid, n_tasks[pid], busy_time[pid], busy_time[pid] / wall_time if wall_time else 0.0)
+               for pid in sorted(busy_time)]
+    return ScheduleReport(workers, wall_time, time.time() - last_start, len(tasks),
+                          n_speculative, n_speculative_won)
+
+
+def log_schedule_report(report, logger, usage_file=None):
+    """Log the utilization of every worker and optionally write it to a csv file."""
+    utilization = [worker.utilization for worker in report.workers]
+    logger.info(f"Dynamic schedule: {report.n_tasks} tasks in {report.wall_time:.1f} s, "
+                f"tail after the last task start {report.tail_time:.1f} s, "
+                f"{report.n_speculative} speculative copies ({report.n_speculative_won} finished first).")
+    if utilization:
+        logger.info(f"Worker utilization: mean {np.mean(utilization):.3f}, min {np.min(utilization):.3f}, "
+                    f"max {np.max(utilization):.3f}")
+    for worker in report.workers:
+        logger.info(f"Worker {worker.pid}: {worker.n_tasks} tasks, busy {worker.busy_time:.1f} s "
+                    f"({worker.utilization:.3f})")
+
+    if usage_file is not None:
+        with open(usage_file, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(WorkerUsage._fields)
+            writer.writerows(report.workers)